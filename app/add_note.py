@@ -123,7 +123,7 @@ class Handler(BaseHandler):
                 spam_score=spam_score,
                 confirmed=False)
             # Write the new NoteWithBadWords to the datastore
-            db.put(note)
+            put_and_count(note)
             UserActionLog.put_new('add', note, copy_properties=False)
             # When the note is detected as spam, we do not update person record
             # or log action. We ask the note author for confirmation first.
@@ -148,7 +148,7 @@ class Handler(BaseHandler):
                 photo=photo,
                 photo_url=photo_url)
             # Write the new regular Note to the datastore
-            db.put(note)
+            put_and_count(note)
             UserActionLog.put_new('add', note, copy_properties=False)
 
         # Specially log 'believed_dead'.
@@ -169,7 +169,7 @@ class Handler(BaseHandler):
             # who subscribed to updates on this person
             subscribe.send_notifications(self, person, [note])
             # write the updated person record to datastore
-            db.put(person)
+            put_and_count(person)
 
         # If user wants to subscribe to updates, redirect to the subscribe page
         if self.params.subscribe:
@@ -19,6 +19,7 @@ import sys
 
 from model import *
 from utils import *
+import script_variant
 
 
 def encode_date(object):
@@ -112,4 +113,6 @@ class Handler(BaseHandler):
         self.render('admin_dashboard.html',
                     data_js=pack_json(json),
                     launched_repos_js=simplejson.dumps(launched_repos),
-                    active_repos_js=simplejson.dumps(active_repos))
+                    active_repos_js=simplejson.dumps(active_repos),
+                    romanization_caches=
+                        script_variant.get_romanization_cache_stats())
@@ -143,7 +143,7 @@ class Handler(utils.BaseHandler):
                     if value == 'flag':
                         note.hidden = True
                     notes.append(note)
-        db.put(notes)
+        model.put_and_count(notes)
         self.redirect('/admin/review',
                       status=self.params.status,
                       source=self.params.source,
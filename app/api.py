@@ -19,21 +19,20 @@ __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
 import calendar
 import csv
+import itertools
 import logging
 import re
-import StringIO
+import time
 import xml.dom.minidom
 
 import django.utils.html
 from google.appengine import runtime
 from google.appengine.ext import db
 from google.appengine.api import images
+from google.appengine.api import users
 
 import config
-import external_search
-import full_text_search
 import importer
-import indexing
 import model
 import pfif
 import simplejson
@@ -41,7 +40,6 @@ import subscribe
 import utils
 import xlrd
 from model import Person, Note, ApiActionLog
-from text_query import TextQuery
 from utils import Struct
 from photo import create_photo, PhotoError
 
@@ -49,6 +47,18 @@ from photo import create_photo, PhotoError
 HARD_MAX_RESULTS = 200  # Clients can ask for more, but won't get more.
 PHOTO_UPLOAD_MAX_SIZE = 10485760 # Currently 10MB is the maximum upload size
 
+# CSV imports read the uploaded file in pieces of this many bytes, and write
+# records in batches of IMPORT_BATCH_SIZE.  After IMPORT_REQUEST_SECONDS,
+# Import hands the rest of the file to ResumeImport, which works on it for
+# IMPORT_TASK_SECONDS per task.
+IMPORT_CHUNK_SIZE = 512*1024
+IMPORT_BATCH_SIZE = 100
+IMPORT_REQUEST_SECONDS = 30
+IMPORT_TASK_SECONDS = 480
+# Maximum number of notes to hold back until the end of a CSV import, in case
+# their person is in a later batch.
+IMPORT_MAX_HELD_NOTES = 1000
+
 class InputFileError(Exception):
     pass
 
@@ -156,8 +166,37 @@ def convert_time_fields(rows, default_offset=0):
             setting_names = [name.lower().strip() for name in row]
 
 
-def convert_xsl_to_csv(contents):
-    """Converts data in xsl (or xslx) format to CSV."""
+def read_chunks(file, chunk_size=IMPORT_CHUNK_SIZE):
+    """Generates the contents of a file in pieces of up to chunk_size bytes."""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def generate_lines(chunks):
+    """Generates the lines in the concatenation of the given strings without
+    their line endings, as str.splitlines() would (handling \\r, \\n, or
+    \\r\\n), without holding more than one piece of the text at a time."""
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).splitlines(True)
+        partial = ''
+        # The last line may continue in the next piece.  Even a line ending
+        # in '\r' may be followed by the '\n' of a '\r\n'.
+        if lines and not lines[-1].endswith('\n'):
+            partial = lines.pop()
+        for line in lines:
+            yield line.rstrip('\r\n')
+    if partial:
+        yield partial.rstrip('\r\n')
+
+
+def read_xsl_rows(contents):
+    """Reads the first sheet of data in xsl (or xslx) format.  Returns an
+    iterator over its rows, as lists of UTF-8 strings like csv.reader would
+    produce, and an error message (None if the data was read successfully)."""
     try:
         book = xlrd.open_workbook(file_contents=contents)
     except xlrd.XLRDError as e:
@@ -166,16 +205,18 @@ def convert_xsl_to_csv(contents):
         return None, 'The encoding of the file is unknown.'
     if book.nsheets == 0:
         return None, 'The uploaded file contains no sheets.'
-    sheet = book.sheet_by_index(0)
-    table = []
+    return generate_xsl_rows(book.sheet_by_index(0)), None
+
+
+def generate_xsl_rows(sheet):
     for row in xrange(sheet.nrows):
         table_row = []
         for col in xrange(sheet.ncols):
-            value = None
+            value = ''
             cell_value = sheet.cell_value(row, col)
             cell_type = sheet.cell_type(row, col)
             if cell_type == xlrd.XL_CELL_TEXT:
-                value = cell_value
+                value = cell_value.encode('utf-8')
             elif cell_type == xlrd.XL_CELL_NUMBER:
                 value = str(int(cell_value))
             elif cell_type == xlrd.XL_CELL_BOOLEAN:
@@ -184,12 +225,92 @@ def convert_xsl_to_csv(contents):
                 # TODO(ryok): support date type.
                 pass
             table_row.append(value)
-        table.append(table_row)
-
-    csv_output = StringIO.StringIO()
-    csv_writer = csv.writer(csv_output)
-    csv_writer.writerows(table)
-    return csv_output.getvalue(), None
+        yield table_row
+
+
+def generate_import_records(rows, format, source_domain, records_done=0):
+    """Converts CSV rows to records for importer.import_records, skipping
+    the first records_done records."""
+    records = itertools.islice(convert_time_fields(rows), records_done, None)
+    if format == 'notes':
+        records = generate_note_record_ids(records)
+    for record in importer.utf8_decoder(records):
+        yield complete_record_ids(record, source_domain)
+
+
+def make_import_stats():
+    """Returns a dictionary of empty import results for each record type."""
+    return dict((type, Struct(type=type, written=0, skipped=[], total=0))
+                for type in ['Person', 'Note'])
+
+
+def import_record_batch(job, stats, converter, records, **kwargs):
+    written, skipped, total = importer.import_records(
+        job.repo, job.source_domain, converter, records, **kwargs)
+    stats.written += written
+    stats.skipped += skipped
+    stats.total += total
+
+
+def import_batches(job, records, stats, deadline):
+    """Imports records for an ImportJob in batches of IMPORT_BATCH_SIZE,
+    until they run out or the time passes the deadline (a time.time() value).
+    The records should start after the first job.records_done records of the
+    file; job.records_done is advanced after each batch (and saved, if the
+    job is stored), and the results are added to stats (from
+    make_import_stats).  Returns True if all the records have been imported.
+
+    In the 'persons' format, a skipped note whose person isn't in its batch
+    is held in job.held_notes and retried after the last batch, in case its
+    person comes later in the file."""
+    is_not_empty = lambda x: (x or '').strip()
+    held_notes = simplejson.loads(job.held_notes or '[]')
+    while True:
+        batch = list(itertools.islice(records, IMPORT_BATCH_SIZE))
+        if not batch:
+            if held_notes:
+                # These notes were already counted in the total when they
+                # were held.
+                written, skipped, total = importer.import_records(
+                    job.repo, job.source_domain, importer.create_note,
+                    held_notes,
+                    believed_dead_permission=job.believed_dead_permission)
+                stats['Note'].written += written
+                stats['Note'].skipped += skipped
+                job.held_notes = None
+            return True
+        if job.format == 'notes':
+            import_record_batch(
+                job, stats['Note'], importer.create_note, batch,
+                believed_dead_permission=job.believed_dead_permission,
+                omit_duplicate_notes=True)
+        else:
+            # Import each batch's persons before its notes, so that notes
+            # can be on separate rows after their persons.
+            person_records = [
+                r for r in batch if is_not_empty(r.get('full_name'))]
+            import_record_batch(
+                job, stats['Person'], importer.create_person, person_records)
+            person_record_ids = set(
+                r.get('person_record_id') for r in person_records)
+            written, skipped, total = importer.import_records(
+                job.repo, job.source_domain, importer.create_note,
+                [r for r in batch if is_not_empty(r.get('note_record_id'))],
+                believed_dead_permission=job.believed_dead_permission)
+            stats['Note'].written += written
+            stats['Note'].total += total
+            for error, record in skipped:
+                if (record.get('person_record_id') not in person_record_ids
+                    and len(held_notes) < IMPORT_MAX_HELD_NOTES):
+                    held_notes.append(record)
+                else:
+                    stats['Note'].skipped.append((error, record))
+            job.held_notes = held_notes and simplejson.dumps(held_notes) or None
+        job.records_done += len(batch)
+        if job.is_saved():
+            job.put()
+        if time.time() > deadline:
+            return False
 
 
 class Import(utils.BaseHandler):
@@ -206,100 +327,123 @@ class Import(utils.BaseHandler):
             self.error(403, message='Missing or invalid authorization key.')
             return
 
-        content = self.request.get('content')
-        if not content:
+        upload = self.request.POST.get('content')
+        file = getattr(upload, 'file', None)
+        if not (file and file.read(1)):
             self.error(400, message='Please specify at least one CSV file.')
             return
+        file.seek(0)
+
+        job = model.ImportJob(
+            repo=self.repo,
+            source_domain=self.auth.domain_write_permission,
+            format=self.request.get('format') == 'notes' and 'notes'
+                or 'persons',
+            is_excel=bool(re.search('\.xlsx?$', upload.filename)),
+            believed_dead_permission=bool(
+                self.auth.believed_dead_permission))
 
         # Handle Excel sheets.
-        filename = self.request.POST['content'].filename
-        if re.search('\.xlsx?$', filename):
-            content, error = convert_xsl_to_csv(content)
+        if job.is_excel:
+            content = file.read()
+            rows, error = read_xsl_rows(content)
             if error:
                 self.response.set_status(400)
                 self.write(error)
                 return
+            content_chunks = [content]
+        else:
+            # TODO(ryok): support non-UTF8 encodings.
+            rows = csv.reader(generate_lines(read_chunks(file)))
 
+        stats = make_import_stats()
         try:
-            lines = content.splitlines()  # handles \r, \n, or \r\n
-            if self.request.get('format') == 'notes':
-                self.import_notes(lines)
-            else:
-                self.import_persons(lines)
+            done = import_batches(
+                job, generate_import_records(rows, job.format,
+                                             job.source_domain),
+                stats, time.time() + IMPORT_REQUEST_SECONDS)
         except InputFileError, e:
             self.error(400, message='Problem in the uploaded file: %s' % e)
+            return
+        except csv.Error, e:
+            self.error(400, message=
+                'The CSV file is formatted incorrectly. (%s)' % e)
+            return
         except runtime.DeadlineExceededError, e:
             self.error(400, message=
                 'Sorry, the uploaded file is too large. Try splitting it into '
                 'smaller files (keeping the header rows in each file) and '
                 'uploading each part separately.')
-
-    def import_notes(self, lines):
-        source_domain = self.auth.domain_write_permission
-        records = importer.utf8_decoder(generate_note_record_ids(
-            convert_time_fields(csv.reader(lines))))
-        try:
-            records = [complete_record_ids(r, source_domain) for r in records]
-        except csv.Error, e:
-            self.error(400, message=
-                'The CSV file is formatted incorrectly. (%s)' % e)
             return
 
-        notes_written, notes_skipped, notes_total = importer.import_records(
-            self.repo, source_domain, importer.create_note, records,
-            believed_dead_permission=self.auth.believed_dead_permission,
-            omit_duplicate_notes=True)
+        if not done:
+            # Store the file and continue from the checkpoint in a task.
+            job.put()
+            if not job.is_excel:
+                file.seek(0)
+                content_chunks = read_chunks(file)
+            job.save_content(content_chunks)
+            self.add_task_for_repo(self.repo, 'resume-import',
+                                   ResumeImport.ACTION, id=job.key().id())
 
         utils.log_api_action(self, ApiActionLog.WRITE,
-                             0, notes_written, 0, len(notes_skipped))
+                             stats['Person'].written, stats['Note'].written,
+                             len(stats['Person'].skipped),
+                             len(stats['Note'].skipped))
 
+        types = job.format == 'notes' and ['Note'] or ['Person', 'Note']
         self.render('import.html',
                     formats=get_requested_formats(self.env.path),
-                    stats=[
-                        Struct(type='Note',
-                               written=notes_written,
-                               skipped=notes_skipped,
-                               total=notes_total)],
+                    stats=[stats[type] for type in types],
+                    continuing=not done,
                     **get_tag_params(self))
 
-    def import_persons(self, lines):
-        # TODO(ryok): support non-UTF8 encodings.
 
-        source_domain = self.auth.domain_write_permission
-        records = importer.utf8_decoder(convert_time_fields(csv.reader(lines)))
-        try:
-            records = [complete_record_ids(r, source_domain) for r in records]
-        except csv.Error, e:
-            self.error(400, message=
-                'The CSV file is formatted incorrectly. (%s)' % e)
-            return
-
-        is_not_empty = lambda x: (x or '').strip()
-        persons = [r for r in records if is_not_empty(r.get('full_name'))]
-        notes = [r for r in records if is_not_empty(r.get('note_record_id'))]
-
-        people_written, people_skipped, people_total = importer.import_records(
-            self.repo, source_domain, importer.create_person, persons)
-        notes_written, notes_skipped, notes_total = importer.import_records(
-            self.repo, source_domain, importer.create_note, notes,
-            believed_dead_permission=self.auth.believed_dead_permission)
+class ResumeImport(utils.BaseHandler):
+    """Continues an import that Import didn't finish within its request,
+    starting from the checkpoint stored in the ImportJob.  Each task works
+    for IMPORT_TASK_SECONDS and then queues up another task if necessary."""
+    ACTION = 'tasks/resume_import'
 
-        utils.log_api_action(self, ApiActionLog.WRITE,
-                             people_written, notes_written,
-                             len(people_skipped), len(notes_skipped))
+    def get(self):
+        if 'X-AppEngine-TaskName' not in self.request.headers:
+            self.error(403)
+            return
+        job = model.ImportJob.get_by_id(int(self.request.get('id', 0)))
+        if not (job and job.repo == self.repo):
+            logging.warning('Import job not found: %r' % self.request.get('id'))
+            return
 
-        self.render('import.html',
-                    formats=get_requested_formats(self.env.path),
-                    stats=[
-                        Struct(type='Person',
-                               written=people_written,
-                               skipped=people_skipped,
-                               total=people_total),
-                        Struct(type='Note',
-                               written=notes_written,
-                               skipped=notes_skipped,
-                               total=notes_total)],
-                    **get_tag_params(self))
+        if job.is_excel:
+            rows, error = read_xsl_rows(''.join(job.get_content_chunks()))
+            if error:
+                logging.error('Import job %d could not read its file: %s' %
+                              (job.key().id(), error))
+                job.delete_with_content()
+                return
+        else:
+            rows = csv.reader(generate_lines(job.get_content_chunks()))
+        stats = make_import_stats()
+        try:
+            done = import_batches(
+                job, generate_import_records(rows, job.format,
+                                             job.source_domain,
+                                             job.records_done),
+                stats, time.time() + IMPORT_TASK_SECONDS)
+        except (InputFileError, csv.Error), e:
+            logging.error('Import job %d stopped after %d records: %s' %
+                          (job.key().id(), job.records_done, e))
+            done = True
+
+        for type in ['Person', 'Note']:
+            logging.info('Import job %d: %s records imported %d of %d' % (
+                job.key().id(), type, stats[type].written, stats[type].total))
+        if done:
+            job.delete_with_content()
+        else:
+            job.put()
+            self.add_task_for_repo(self.repo, 'resume-import', self.ACTION,
+                                   id=job.key().id())
 
 
 class Read(utils.BaseHandler):
@@ -395,39 +539,80 @@ class Write(utils.BaseHandler):
             return
 
         source_domain = self.auth.domain_write_permission
-        try:
-            person_records, note_records = \
-                pfif.parse_file(self.request.body_file)
-        except Exception, e:
-            self.info(400, message='Invalid XML: %s' % e, style='plain')
-            return
-
         mark_notes_reviewed = bool(self.auth.mark_notes_reviewed)
         believed_dead_permission = bool(
             self.auth.believed_dead_permission)
 
+        people_written, people_skipped, people_total = 0, [], 0
+        notes_written, notes_skipped, notes_total = 0, [], 0
+        # The person_record_ids of the persons in the document so far, and
+        # the skipped notes whose person wasn't among them.  Those notes are
+        # retried at the end, in case their person comes later in the file.
+        person_record_ids = set()
+        held_notes = []
+
+        # Import the records in batches as they are parsed, so that we never
+        # hold all the records in a large document at once.
+        batches = pfif.parse_file_in_batches(self.request.body_file)
+        while True:
+            try:
+                person_records, note_records = batches.next()
+            except StopIteration:
+                break
+            except Exception, e:
+                message = 'Invalid XML: %s' % e
+                if people_total or notes_total:
+                    message += (' (after writing %d person and %d note '
+                                'records)' % (people_written, notes_written))
+                self.info(400, message=message, style='plain')
+                return
+
+            person_record_ids.update(
+                record.get('person_record_id') for record in person_records)
+            written, skipped, total = importer.import_records(
+                self.repo, source_domain, importer.create_person,
+                person_records)
+            people_written += written
+            people_skipped += skipped
+            people_total += total
+
+            written, skipped, total = importer.import_records(
+                self.repo, source_domain, importer.create_note, note_records,
+                mark_notes_reviewed, believed_dead_permission, self)
+            notes_written += written
+            notes_total += total
+            for error, record in skipped:
+                if record.get('person_record_id') in person_record_ids:
+                    notes_skipped.append((error, record))
+                else:
+                    held_notes.append((error, record))
+
+        retry_records = []
+        for error, record in held_notes:
+            if record.get('person_record_id') in person_record_ids:
+                retry_records.append(record)
+            else:
+                notes_skipped.append((error, record))
+        if retry_records:
+            written, skipped, total = importer.import_records(
+                self.repo, source_domain, importer.create_note,
+                retry_records, mark_notes_reviewed, believed_dead_permission,
+                self)
+            notes_written += written
+            notes_skipped += skipped
+
         self.response.headers['Content-Type'] = 'application/xml'
         self.write('<?xml version="1.0"?>\n')
         self.write('<status:status>\n')
-
-        create_person = importer.create_person
-        num_people_written, people_skipped, total = importer.import_records(
-            self.repo, source_domain, create_person, person_records)
         self.write_status(
-            'person', num_people_written, people_skipped, total, 
+            'person', people_written, people_skipped, people_total,
             'person_record_id')
-
-        create_note = importer.create_note
-        num_notes_written, notes_skipped, total = importer.import_records(
-            self.repo, source_domain, create_note, note_records,
-            mark_notes_reviewed, believed_dead_permission, self)
-
         self.write_status(
-            'note', num_notes_written, notes_skipped, total, 'note_record_id')
-
+            'note', notes_written, notes_skipped, notes_total,
+            'note_record_id')
         self.write('</status:status>\n')
-        utils.log_api_action(self, ApiActionLog.WRITE,          
-                             num_people_written, num_notes_written,  
+        utils.log_api_action(self, ApiActionLog.WRITE,
+                             people_written, notes_written,
                              len(people_skipped), len(notes_skipped))
 
 
@@ -479,6 +664,10 @@ class Search(utils.BaseHandler):
             if person:
                 results = [person]
         elif query_string:
+            # The search modules are imported here so that the other API
+            # actions don't have to load them.
+            import external_search, full_text_search, indexing
+            from text_query import TextQuery
             # Search by query words.
             if self.config.external_search_backends:
                 query = TextQuery(query_string)
@@ -502,10 +691,14 @@ class Search(utils.BaseHandler):
         records = [pfif_version.person_to_dict(result) for result in results]
         utils.optionally_filter_sensitive_fields(records, self.auth)
 
+        # Fetch the notes for all the results at once, rather than making a
+        # query for each person while writing the response.
+        notes_by_person = model.Note.get_by_person_record_ids(
+            self.repo, [record['person_record_id'] for record in records])
+
         # Define the function to retrieve notes for a person.
         def get_notes_for_person(person):
-            notes = model.Note.get_by_person_record_id(
-                self.repo, person['person_record_id'])
+            notes = notes_by_person[person['person_record_id']]
             notes = [note for note in notes if not note.hidden]
             records = map(pfif_version.note_to_dict, notes)
             utils.optionally_filter_sensitive_fields(records, self.auth)
@@ -566,6 +759,14 @@ def fetch_all(query):
     return results
 
 
+# The datastore filters for each of the note review-state counts.
+NOTE_REVIEW_STATE_QUERIES = {
+    'hidden=FALSE,reviewed=FALSE': [('reviewed =', False), ('hidden =', False)],
+    'hidden=FALSE,reviewed=TRUE': [('reviewed =', True), ('hidden =', False)],
+    'hidden=TRUE': [('hidden =', True)],
+}
+
+
 class Stats(utils.BaseHandler):
     def get(self):
         if not (self.auth and self.auth.stats_permission):
@@ -577,31 +778,38 @@ class Stats(utils.BaseHandler):
 
         person_counts = model.Counter.get_all_counts(self.repo, 'person')
         note_counts = model.Counter.get_all_counts(self.repo, 'note')
-
-        # unreviewed
-        note_counts['hidden=FALSE,reviewed=FALSE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('reviewed =', False
-            ).filter('hidden =', False
-            ).order('-entry_date')))
-        # accepted
-        note_counts['hidden=FALSE,reviewed=TRUE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('reviewed =', True
-            ).filter('hidden =', False
-            ).order('-entry_date')))
-        # flagged
-        note_counts['hidden=TRUE'] = len(fetch_all(
-            model.Note.all(keys_only=True
-            ).filter('repo =', self.repo
-            ).filter('hidden =', True
-            ).order('-entry_date')))
+        # The note review-state counts are kept up to date as Notes are
+        # written (see model.Note.get_count_names); fill in zeroes for any
+        # that haven't been counted yet.
+        for name in NOTE_REVIEW_STATE_QUERIES:
+            note_counts.setdefault(name, 0)
+        result = {'person': person_counts, 'note': note_counts}
+
+        if self.params.recount:
+            # Check the counters against a scan of the notes (admins only,
+            # because this scans every note in the repository).
+            if not users.is_current_user_admin():
+                return self.info(
+                    403, message='Recounting requires an administrator',
+                    style='plain')
+            mismatches = {}
+            for name, filters in NOTE_REVIEW_STATE_QUERIES.items():
+                query = model.Note.all(keys_only=True
+                    ).filter('repo =', self.repo)
+                for filter, value in filters:
+                    query.filter(filter, value)
+                scanned = len(fetch_all(query))
+                if scanned != note_counts[name]:
+                    logging.warning(
+                        'Counter note.%s is %d in repo %s but a scan found %d'
+                        % (name, note_counts[name], self.repo, scanned))
+                    mismatches[name] = {'counter': note_counts[name],
+                                        'scan': scanned}
+                note_counts[name] = scanned
+            result['recount_mismatches'] = mismatches
 
         self.response.headers['Content-Type'] = 'application/json'
-        self.write(simplejson.dumps({'person': person_counts,
-                                     'note': note_counts}))
+        self.write(simplejson.dumps(result))
 
 
 class HandleSMS(utils.BaseHandler):
@@ -658,6 +866,8 @@ class HandleSMS(utils.BaseHandler):
         search_m = re.search(r'^search\s+(.+)$', message_text.strip(), re.I)
         add_self_m = re.search(r'^i am\s+(.+)$', message_text.strip(), re.I)
         if search_m:
+            import indexing
+            from text_query import TextQuery
             query_string = search_m.group(1).strip()
             query = TextQuery(query_string)
             persons = indexing.search(repo, query, HandleSMS.MAX_RESULTS)
@@ -680,7 +890,7 @@ class HandleSMS(utils.BaseHandler):
                 full_name=name_string,
                 family_name='',
                 given_name='')
-            person.update_index(['old', 'new'])
+            person.update_index(['old', 'new'], token_stats=True)
             note = Note.create_original(
                 repo,
                 entry_date=utils.get_utcnow(),
@@ -690,10 +900,10 @@ class HandleSMS(utils.BaseHandler):
                 author_made_contact=True,
                 status='is_note_author',
                 text=message_text)
-            db.put(note)
+            model.put_and_count(note)
             model.UserActionLog.put_new('add', note, copy_properties=False)
             person.update_from_note(note)
-            db.put(person)
+            model.put_and_count(person)
             model.UserActionLog.put_new('add', person, copy_properties=False)
             responses.append('Added record for found person: %s' % name_string)
         else:
@@ -23,11 +23,18 @@ from const import ROOT_URL
 from pfif import format_boolean, format_utc_datetime, xml_escape
 from utils import format_utc_timestamp
 
+def format_element(tag, contents, indent=''):
+    """Formats a single XML element with the given contents, or returns an
+    empty string if the contents are empty."""
+    if contents:
+        return indent + '<%s>%s</%s>\n' % (
+            tag, xml_escape(contents).encode('utf-8'), tag)
+    return ''
+
 def write_element(file, tag, contents, indent=''):
     """Writes a single XML element with the given contents, if non-empty."""
     if contents:
-        file.write(indent + '<%s>%s</%s>\n' %
-                   (tag, xml_escape(contents).encode('utf-8'), tag))
+        file.write(format_element(tag, contents, indent))
 
 def format_float(value):
     return ('%f' % value).rstrip('0').rstrip('.')
@@ -116,29 +123,32 @@ class AtomPfifVersion:
     def write_person_entry(self, file, person, notes, feed_title, indent=''):
         """Writes a PFIF Atom entry, given a person record and a list of its
         note records.  'feed_title' is the title of the containing feed."""
-        file.write(indent + '<entry>\n')
+        parts = [indent, '<entry>\n']
         indent += '  '
-        self.pfif_version.write_person(file, person, notes, indent)
-        write_element(file, 'id', 'pfif:' + person['person_record_id'], indent)
+        self.pfif_version.append_person(parts, person, notes, indent)
         title = person.get('full_name', '').split('\n')[0]
-        write_element(file, 'title', title, indent)
-        file.write(indent + '<author>\n')
-        write_element(file, 'name', person.get('author_name'), indent + '  ')
-        write_element(file, 'email', person.get('author_email'), indent + '  ')
-        file.write(indent + '</author>\n')
-        write_element(file, 'updated', person.get('source_date'), indent)
-        file.write(indent + '<source>\n')
-        write_element(file, 'title', feed_title, indent + '  ')
-        file.write(indent + '</source>\n')
-        write_element(file, 'content', title, indent)
-        indent = indent[2:]
-        file.write(indent + '</entry>\n')
+        parts += [
+            format_element('id', 'pfif:' + person['person_record_id'], indent),
+            format_element('title', title, indent),
+            indent, '<author>\n',
+            format_element('name', person.get('author_name'), indent + '  '),
+            format_element('email', person.get('author_email'), indent + '  '),
+            indent, '</author>\n',
+            format_element('updated', person.get('source_date'), indent),
+            indent, '<source>\n',
+            format_element('title', feed_title, indent + '  '),
+            indent, '</source>\n',
+            format_element('content', title, indent),
+            indent[2:], '</entry>\n'
+        ]
+        file.write(''.join(parts))
 
     def write_person_feed(self, file, persons, get_notes_for_person,
-                          url, title, subtitle, updated):
+                          url, title, subtitle, updated, next_url=None):
         """Takes a list of person records and a function that gets the list
         of note records for each person, and writes a PFIF Atom feed to the
-        given file."""
+        given file.  If next_url is given, the feed links to it as the next
+        page."""
         file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         file.write('<feed xmlns="http://www.w3.org/2005/Atom"\n')
         file.write('      xmlns:pfif="%s">\n' % self.pfif_version.ns)
@@ -147,6 +157,8 @@ class AtomPfifVersion:
         write_element(file, 'subtitle', subtitle, '  ')
         write_element(file, 'updated', format_utc_datetime(updated), '  ')
         file.write('  <link rel="self">%s</link>\n' % xml_escape(url))
+        if next_url:
+            file.write('  <link rel="next">%s</link>\n' % xml_escape(next_url))
         for person in persons:
             self.write_person_entry(
                 file, person, get_notes_for_person(person), title, '  ')
@@ -154,22 +166,26 @@ class AtomPfifVersion:
 
     def write_note_entry(self, file, note, indent=''):
         """Writes a PFIF Atom entry, given a note record."""
-        file.write(indent + '<entry>\n')
+        parts = [indent, '<entry>\n']
         indent += '  '
-        self.pfif_version.write_note(file, note, indent)
-        write_element(file, 'id', 'pfif:%s' % note['note_record_id'], indent)
-        write_element(file, 'title', note.get('text', '')[:140], indent)
-        file.write(indent + '<author>\n')
-        write_element(file, 'name', note.get('author_name'), indent + '  ')
-        write_element(file, 'email', note.get('author_email'), indent + '  ')
-        file.write(indent + '</author>\n')
-        write_element(file, 'updated', note.get('entry_date'), indent)
-        write_element(file, 'content', note.get('text'), indent)
-        indent = indent[2:]
-        file.write(indent + '</entry>\n')
-
-    def write_note_feed(self, file, notes, url, title, subtitle, updated):
-        """Takes a list of notes and writes a PFIF Atom feed to a file."""
+        self.pfif_version.append_note(parts, note, indent)
+        parts += [
+            format_element('id', 'pfif:%s' % note['note_record_id'], indent),
+            format_element('title', note.get('text', '')[:140], indent),
+            indent, '<author>\n',
+            format_element('name', note.get('author_name'), indent + '  '),
+            format_element('email', note.get('author_email'), indent + '  '),
+            indent, '</author>\n',
+            format_element('updated', note.get('entry_date'), indent),
+            format_element('content', note.get('text'), indent),
+            indent[2:], '</entry>\n'
+        ]
+        file.write(''.join(parts))
+
+    def write_note_feed(self, file, notes, url, title, subtitle, updated,
+                        next_url=None):
+        """Takes a list of notes and writes a PFIF Atom feed to a file.  If
+        next_url is given, the feed links to it as the next page."""
         file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
         file.write('<feed xmlns="http://www.w3.org/2005/Atom"\n')
         file.write('      xmlns:pfif="%s">\n' % self.pfif_version.ns)
@@ -178,6 +194,8 @@ class AtomPfifVersion:
         write_element(file, 'subtitle', subtitle, '  ')
         write_element(file, 'updated', format_utc_datetime(updated), '  ')
         file.write('  <link rel="self">%s</link>\n' % xml_escape(url))
+        if next_url:
+            file.write('  <link rel="next">%s</link>\n' % xml_escape(next_url))
         for note in notes:
             self.write_note_entry(file, note, '  ')
         file.write('</feed>\n')
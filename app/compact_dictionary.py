@@ -0,0 +1,178 @@
+#!/usr/bin/python2.7
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A read-only dictionary from unicode strings to sets of unicode strings,
+stored in a precompiled file that is looked up in place.
+
+Loading a large dictionary into Python dicts and sets costs time on every
+instance start and tens of MB of per-object overhead.  A CompactDictionary
+keeps the whole file in a single buffer (memory-mapped where the runtime
+allows it) and searches it in place, so only the entries that are actually
+looked up are ever decoded.
+
+File format (all integers are unsigned 32-bit little-endian):
+    MAGIC
+    count: the number of keys
+    block_count: the number of blocks the entries are divided into
+    block_keys_size: the size of the block keys section
+    block keys: the first key of each block, separated by '\\n'
+    offsets[block_count + 1]: the start of each block relative to the start
+        of the entries, followed by the end of the last block
+    entries: for each key in order of its UTF-8 encoding, a line with the
+        UTF-8 key and then its UTF-8 values, each followed by '\\t' (the last
+        value is followed by '\\n' instead)
+
+Only the block keys are loaded into memory.  A lookup bisects them to find
+the block, then searches that block's bytes for the key.
+"""
+
+import bisect
+import os
+import struct
+
+try:
+    import mmap
+except ImportError:
+    # Not available in the App Engine sandbox.
+    mmap = None
+
+MAGIC = 'PFDICT02'
+HEADER = struct.Struct('<8sIII')
+OFFSET = struct.Struct('<I')
+
+# Number of entries per block.  Bigger blocks mean fewer block keys in
+# memory but more bytes to search in each lookup.
+BLOCK_SIZE = 32
+
+
+class FormatError(Exception):
+    pass
+
+
+class CompactDictionary(object):
+    """A read-only mapping from unicode keys to sets of unicode values that
+    looks up entries directly in a buffer in the format described above."""
+
+    def __init__(self, buffer):
+        if len(buffer) < HEADER.size:
+            raise FormatError('dictionary file is truncated')
+        magic, self.count, block_count, block_keys_size = HEADER.unpack_from(
+            buffer, 0)
+        if magic != MAGIC:
+            raise FormatError('not a compact dictionary file')
+        self.buffer = buffer
+        self.block_keys = (
+            buffer[HEADER.size:HEADER.size + block_keys_size].split('\n')
+            if block_count else [])
+        self.offsets_start = HEADER.size + block_keys_size
+        self.entries_start = (
+            self.offsets_start + OFFSET.size * (block_count + 1))
+        if (len(self.block_keys) != block_count or
+            len(buffer) < self.entries_start or
+            len(buffer) != self.entries_start + self.get_offset(block_count)):
+            raise FormatError('dictionary file is truncated')
+
+    def get_offset(self, block):
+        return OFFSET.unpack_from(
+            self.buffer, self.offsets_start + OFFSET.size * block)[0]
+
+    def get_block_range(self, block):
+        """Returns the start and end positions in the buffer of the entries
+        in the given block."""
+        return (self.entries_start + self.get_offset(block),
+                self.entries_start + self.get_offset(block + 1))
+
+    def find(self, key):
+        """Returns the encoded values for the key as a '\\t'-separated byte
+        string, or None if the key isn't in the dictionary.  Keys are in
+        order of their UTF-8 encoding, which is also the order of their code
+        points."""
+        encoded_key = key.encode('utf-8')
+        block = bisect.bisect_right(self.block_keys, encoded_key) - 1
+        if block < 0:
+            return None
+        start, end = self.get_block_range(block)
+        if self.block_keys[block] == encoded_key:
+            start += len(encoded_key) + 1
+        else:
+            start = self.buffer.find('\n' + encoded_key + '\t', start, end)
+            if start < 0:
+                return None
+            start += len(encoded_key) + 2
+        return self.buffer[start:self.buffer.find('\n', start, end)]
+
+    def get(self, key, default=None):
+        values = self.find(key)
+        if values is None:
+            return default
+        return set(value.decode('utf-8') for value in values.split('\t')
+                   if value)
+
+    def __getitem__(self, key):
+        values = self.get(key)
+        if values is None:
+            raise KeyError(key)
+        return values
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for block in xrange(len(self.block_keys)):
+            start, end = self.get_block_range(block)
+            for entry in self.buffer[start:end - 1].split('\n'):
+                yield entry.split('\t', 1)[0].decode('utf-8')
+
+
+def load(file_name):
+    """Opens the dictionary in the given file, or returns an empty dict if
+    the file doesn't exist."""
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, 'rb') as f:
+        if mmap:
+            try:
+                # The mapping stays valid after the file is closed.
+                return CompactDictionary(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except EnvironmentError:
+                pass
+        return CompactDictionary(f.read())
+
+
+def write(dictionary, f):
+    """Writes a dictionary from unicode keys to iterables of unicode values
+    to the file object f in the compact format.  Keys and values must not
+    contain tab or newline characters."""
+    entries = sorted(
+        (key.encode('utf-8'),
+         sorted(value.encode('utf-8') for value in values))
+        for key, values in dictionary.iteritems())
+    blocks = [entries[i:i + BLOCK_SIZE]
+              for i in xrange(0, len(entries), BLOCK_SIZE)]
+    block_keys = '\n'.join(block[0][0] for block in blocks)
+    f.write(HEADER.pack(MAGIC, len(entries), len(blocks), len(block_keys)))
+    f.write(block_keys)
+    blocks = [''.join(key + '\t' + '\t'.join(values) + '\n'
+                      for key, values in block) for block in blocks]
+    offset = 0
+    f.write(OFFSET.pack(offset))
+    for block in blocks:
+        offset += len(block)
+        f.write(OFFSET.pack(offset))
+    f.writelines(blocks)
@@ -38,7 +38,7 @@ class Handler(utils.BaseHandler):
 
         #Update the notes_disabled flag in person record.
         person.notes_disabled = False
-        db.put([person])
+        model.put_and_count([person])
 
         record_url = self.get_url(
             '/view', id=person.record_id, repo=person.repo)
@@ -72,7 +72,7 @@ class Handler(utils.BaseHandler):
 
         # Update the notes_disabled flag in person record.
         person.notes_disabled = False
-        db.put([person])
+        model.put_and_count([person])
 
         record_url = self.get_url(
             '/view', id=person.record_id, repo=person.repo)
@@ -143,4 +143,4 @@ class Handler(utils.BaseHandler):
             entities_to_put.append(person)
 
         # Write one or both entities to the store.
-        db.put(entities_to_put)
+        model.put_and_count(entities_to_put)
@@ -159,7 +159,7 @@ class Handler(BaseHandler):
             photo=photo,
             photo_url=photo_url
         )
-        person.update_index(['old', 'new'])
+        person.update_index(['old', 'new'], token_stats=True)
 
         if self.params.add_note:
             spam_detector = SpamDetector(self.config.bad_words)
@@ -185,10 +185,10 @@ class Handler(BaseHandler):
                     confirmed=False)
 
                 # Write the new NoteWithBadWords to the datastore
-                db.put(note)
+                put_and_count(note)
                 UserActionLog.put_new('add', note, copy_properties=False)
                 # Write the person record to datastore before redirect
-                db.put(person)
+                put_and_count(person)
                 UserActionLog.put_new('add', person, copy_properties=False)
 
                 # When the note is detected as spam, we do not update person
@@ -217,7 +217,7 @@ class Handler(BaseHandler):
                     photo_url=note_photo_url)
 
                 # Write the new Note to the datastore
-                db.put(note)
+                put_and_count(note)
                 UserActionLog.put_new('add', note, copy_properties=False)
                 person.update_from_note(note)
 
@@ -228,14 +228,14 @@ class Handler(BaseHandler):
                     self.request.remote_addr)
 
         # Write the person record to datastore
-        db.put(person)
+        put_and_count(person)
         UserActionLog.put_new('add', person, copy_properties=False)
 
         # TODO(ryok): we could do this earlier so we don't neet to db.put twice.
         if not person.source_url and not self.params.clone:
             # Put again with the URL, now that we have a person_record_id.
             person.source_url = self.get_url('/view', id=person.record_id)
-            db.put(person)
+            put_and_count(person)
 
         # TODO(ryok): batch-put person, note, photo, note_photo here.
 
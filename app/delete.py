@@ -30,28 +30,35 @@ EXPIRED_TTL_DAYS = 3
 
 def send_delete_notice(handler, person):
     """Notify concerned folks about the potential deletion."""
+    for to, subject, body in make_delete_notices(handler, person):
+        handler.send_mail(to=to, subject=subject, body=body)
+
+def make_delete_notices(handler, person, notes=None):
+    """Renders the messages for send_delete_notice(), as a list of (to,
+    subject, body) tuples, so that callers handling many deletions can send
+    them in batches with handler.send_mails().  'notes' can be given to avoid
+    a query, as for Person.get_associated_emails()."""
     # i18n: Subject line of an e-mail message notifying a user
     # i18n: that a person record has been deleted
     subject = _('[Person Finder] Deletion notice for "%(full_name)s"'
             ) % {'full_name': person.primary_full_name}
 
     # Send e-mail to all the addresses notifying them of the deletion.
-    for email in person.get_associated_emails():
+    notices = []
+    for email in person.get_associated_emails(notes):
         if email == person.author_email:
             template_name = 'deletion_email_for_person_author.txt'
         else:
             template_name = 'deletion_email_for_note_author.txt'
-        handler.send_mail(
-            subject=subject,
-            to=email,
-            body=handler.render_to_string(
-                template_name,
-                full_name=person.primary_full_name,
-                site_url=handler.get_url('/'),
-                days_until_deletion=EXPIRED_TTL_DAYS,
-                restore_url=get_restore_url(handler, person)
-            )
+        body = handler.render_to_string(
+            template_name,
+            full_name=person.primary_full_name,
+            site_url=handler.get_url('/'),
+            days_until_deletion=EXPIRED_TTL_DAYS,
+            restore_url=get_restore_url(handler, person)
         )
+        notices.append((email, subject, body))
+    return notices
 
 def get_restore_url(handler, person, ttl=3*24*3600):
     """Returns a URL to be used for restoring a deleted person record.
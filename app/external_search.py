@@ -124,14 +124,14 @@ def search(repo, query_obj, max_results, backends):
     logging.debug('external_search.search matches name: %d, all: %d' %
                   (len(name_matches), len(address_matches)))
 
-    name_matches.sort(indexing.CmpResults(query_obj))
+    name_matches.sort(key=indexing.RankingKey(query_obj))
     # address_matches may include search results where the query matched only
     # the home address and not the person's name.  We need to remove those.
     address_matches = remove_non_name_matches(address_matches, query_obj)
     logging.debug('address_matches after remove_non_name_matches: %d' %
                   len(address_matches))
     if address_matches:
-        address_matches.sort(indexing.CmpResults(query_obj))
+        address_matches.sort(key=indexing.RankingKey(query_obj))
         for address_match in address_matches:
             address_match.is_address_match = True
     all_matches = name_matches + address_matches
@@ -17,6 +17,8 @@
 
 __author__ = 'kpy@google.com (Ka-Ping Yee)'
 
+from google.appengine.api import datastore_errors
+
 import atom
 import config
 import datetime
@@ -28,6 +30,10 @@ HARD_MAX_RESULTS = 200  # Clients can ask for more, but won't get more.
 PERSON_SUBTITLE_BASE = "PFIF Person Feed generated by Person Finder at "
 NOTE_SUBTITLE_BASE = "PFIF Note Feed generated by Person Finder at "
 
+# Raised when the cursor parameter is malformed or belongs to another query.
+INVALID_CURSOR_ERRORS = (datastore_errors.BadValueError,
+                         datastore_errors.BadRequestError)
+
 def get_latest_entry_date(entities):
     if entities:
         return max(entity.entry_date for entity in entities)
@@ -42,6 +48,23 @@ def make_hidden_notes_blank(notes):
         if note.hidden:
             note.text = ''
 
+def fetch_page(handler, query, max_results):
+    """Fetches a page of a feed, starting at the position given by the
+    'cursor' parameter (or else after the number of results given by the
+    'skip' parameter).  Returns the results and the URL of the next page,
+    or None if this is the last page.  Unlike an offset, a cursor costs the
+    same no matter how deep into the feed the page is."""
+    if handler.params.cursor:
+        results = query.with_cursor(handler.params.cursor).fetch(max_results)
+    else:
+        results = query.fetch(max_results, offset=handler.params.skip or 0)
+    next_url = None
+    if len(results) == max_results:
+        next_url = utils.set_url_param(
+            utils.set_url_param(handler.request.url, 'skip', None),
+            'cursor', query.cursor())
+    return results, next_url
+
 
 class Repo(utils.BaseHandler):
     TITLE = 'Person Finder Repository Feed'
@@ -77,24 +100,6 @@ class Person(utils.BaseHandler):
         atom_version = atom.ATOM_PFIF_VERSIONS.get(pfif_version.version)
 
         max_results = min(self.params.max_results or 10, HARD_MAX_RESULTS)
-        skip = self.params.skip or 0
-
-        # We use a member because a var can't be modified inside the closure.
-        self.num_notes = 0
-        def get_notes_for_person(person):
-            notes = model.Note.get_by_person_record_id(
-                self.repo, person['person_record_id'])
-            # Show hidden notes as blank in the Person feed (melwitt)
-            # http://code.google.com/p/googlepersonfinder/issues/detail?id=58
-            make_hidden_notes_blank(notes)
-
-            records = map(pfif_version.note_to_dict, notes)
-            utils.optionally_filter_sensitive_fields(records, self.auth)
-            self.num_notes += len(notes)
-            return records
-
-        if self.params.omit_notes:  # Return only the person records.
-            get_notes_for_person = lambda person: []
 
         query = model.Person.all_in_repo(self.repo, filter_expired=False)
         if self.params.min_entry_date:  # Scan forward.
@@ -103,9 +108,35 @@ class Person(utils.BaseHandler):
         else:  # Show recent entries, scanning backward.
             query = query.order('-entry_date')
 
-        persons = query.fetch(max_results, offset=skip)
+        try:
+            persons, next_url = fetch_page(self, query, max_results)
+        except INVALID_CURSOR_ERRORS:
+            self.response.set_status(400)
+            self.write('Invalid cursor\n')
+            return
         updated = get_latest_entry_date(persons)
 
+        # We use a member because a var can't be modified inside the closure.
+        self.num_notes = 0
+        if self.params.omit_notes:  # Return only the person records.
+            get_notes_for_person = lambda person: []
+        else:
+            # Fetch the notes for all the persons at once, rather than making
+            # a query for each person while writing the feed.
+            notes_by_person = model.Note.get_by_person_record_ids(
+                self.repo, [person.record_id for person in persons])
+
+            def get_notes_for_person(person):
+                notes = notes_by_person[person['person_record_id']]
+                # Show hidden notes as blank in the Person feed (melwitt)
+                # http://code.google.com/p/googlepersonfinder/issues/detail?id=58
+                make_hidden_notes_blank(notes)
+
+                records = map(pfif_version.note_to_dict, notes)
+                utils.optionally_filter_sensitive_fields(records, self.auth)
+                self.num_notes += len(notes)
+                return records
+
         self.response.headers['Content-Type'] = 'application/xml'
         records = [pfif_version.person_to_dict(person, person.is_expired)
                    for person in persons]
@@ -113,7 +144,7 @@ class Person(utils.BaseHandler):
         atom_version.write_person_feed(
             self.response.out, records, get_notes_for_person,
             self.request.url, self.env.netloc, PERSON_SUBTITLE_BASE +
-            self.env.netloc, updated)
+            self.env.netloc, updated, next_url)
         utils.log_api_action(self, model.ApiActionLog.READ, len(records),
                              self.num_notes)
 
@@ -141,7 +172,6 @@ class Note(utils.BaseHandler):
         pfif_version = self.params.version
         atom_version = atom.ATOM_PFIF_VERSIONS.get(pfif_version.version)
         max_results = min(self.params.max_results or 10, HARD_MAX_RESULTS)
-        skip = self.params.skip or 0
 
         query = model.Note.all_in_repo(self.repo)
         if self.params.min_entry_date:  # Scan forward.
@@ -154,7 +184,12 @@ class Note(utils.BaseHandler):
             query = query.filter('person_record_id =',
                                  self.params.person_record_id)
 
-        notes = query.fetch(max_results, offset=skip)
+        try:
+            notes, next_url = fetch_page(self, query, max_results)
+        except INVALID_CURSOR_ERRORS:
+            self.response.set_status(400)
+            self.write('Invalid cursor\n')
+            return
         updated = get_latest_entry_date(notes)
 
         # Show hidden notes as blank in the Note feed (melwitt)
@@ -166,5 +201,6 @@ class Note(utils.BaseHandler):
         utils.optionally_filter_sensitive_fields(records, self.auth)
         atom_version.write_note_feed(
             self.response.out, records, self.request.url,
-            self.env.netloc, NOTE_SUBTITLE_BASE + self.env.netloc, updated)
+            self.env.netloc, NOTE_SUBTITLE_BASE + self.env.netloc, updated,
+            next_url)
         utils.log_api_action(self, model.ApiActionLog.READ, 0, len(records))
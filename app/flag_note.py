@@ -56,7 +56,7 @@ class Handler(utils.BaseHandler):
             now = utils.get_utcnow()
             note.source_date = now
             note.entry_date = now
-            db.put(note)
+            model.put_and_count(note)
 
             model.UserActionLog.put_new(
                 (note.hidden and 'hide') or 'unhide',
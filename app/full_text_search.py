@@ -26,8 +26,17 @@ import script_variant
 # This index contains person name and location.
 PERSON_LOCATION_FULL_TEXT_INDEX_NAME = 'person_location_information'
 
-# This is for ranking (person name match higher than location)
-REPEAT_COUNT_FOR_RANK = 5
+# Fields holding the person's names as entered.
+NAME_FIELD_NAMES = ['given_name', 'family_name', 'full_name', 'alternate_names']
+
+# Applies two methods because kanji is used in Chinese and Japanese,
+# and romanizing in chinese and japanese is different.
+ROMANIZE_METHODS = [script_variant.romanize_word_by_unidecode,
+                    script_variant.romanize_japanese_word]
+
+# Fields holding all the romanized names of the person, one per method.
+ROMANIZED_NAME_FIELD_NAMES = ['names_romanized_by_' + method.__name__
+                              for method in ROMANIZE_METHODS]
 
 def make_or_regexp(query_txt):
     """
@@ -95,13 +104,14 @@ def create_non_romanized_query(query_txt):
     return ' '.join(enclose_in_double_quotes(word) for word in query_words)
 
 
-def create_romanized_query_txt(query_txt):
+def create_romanized_query_clauses(query_txt):
     """
     Applies romanization to each word in query_txt.
     Args:
         query_txt: Search query
     Returns:
-        script varianted query_txt
+        ['"romanized_word1" OR "romanized_word1_2"', ...]
+        (one clause for each query word)
     """
     query_words = query_txt.split(' ')
     query_list = []
@@ -110,10 +120,53 @@ def create_romanized_query_txt(query_txt):
         romanized_word = ' OR '.join(enclose_in_double_quotes(word)
                                      for word in romanized_word_list)
         query_list.append(romanized_word)
-    romanized_query = ','.join([word for word in query_list])
+    return query_list
+
+
+def create_romanized_query_txt(query_txt):
+    """
+    Applies romanization to each word in query_txt.
+    Args:
+        query_txt: Search query
+    Returns:
+        script varianted query_txt
+    """
+    romanized_query = ','.join(create_romanized_query_clauses(query_txt))
     return enclose_in_parenthesis(romanized_query)
 
 
+def restrict_to_fields(clauses, field_names):
+    """
+    Creates a query that requires every clause to match in at least one of
+    the given fields.
+    Args:
+        clauses: a list of query clauses
+        field_names: a list of field names
+    Returns:
+        '(field1:(clause1) OR field2:(clause1)) AND (field1:(clause2) ...'
+    """
+    return ' AND '.join(
+        '(' + ' OR '.join('%s:(%s)' % (field_name, clause)
+                          for field_name in field_names) + ')'
+        for clause in clauses if clause)
+
+
+def create_name_queries(query_txt):
+    """
+    Creates queries that match only on the person's names, to rank name
+    matches higher than matches that need the location fields.
+    Args:
+        query_txt: Search query
+    Returns:
+        [non romanized name query, romanized name query]
+    """
+    non_romanized_clauses = [enclose_in_double_quotes(word)
+                             for word in query_txt.split(' ') if word]
+    return [restrict_to_fields(non_romanized_clauses, NAME_FIELD_NAMES),
+            restrict_to_fields(create_romanized_query_clauses(query_txt),
+                               ROMANIZED_NAME_FIELD_NAMES)]
+
+
 def get_person_ids_from_results(romanized_query, results_list):
     """
     Returns person record_id of persons
@@ -128,6 +181,7 @@ def get_person_ids_from_results(romanized_query, results_list):
     """
     regexp = make_or_regexp(romanized_query)
     index_results = []
+    seen_ids = set()
     for results in results_list:
         for document in results:
             romanized_jp_names = ''
@@ -139,11 +193,12 @@ def get_person_ids_from_results(romanized_query, results_list):
                 if field.name == 'names_romanized_by_romanize_japanese_word':
                     romanized_jp_names = field.value
             
-            if id in index_results:
+            if id in seen_ids:
                 continue
 
             if regexp.search(names) or regexp.search(romanized_jp_names):
                 index_results.append(id)
+                seen_ids.add(id)
     return index_results
 
 
@@ -170,6 +225,8 @@ def search(repo, query_txt, max_results):
 
     # Remove double quotes so that we can safely apply enclose_in_double_quotes().
     query_txt = re.sub('"', '', query_txt)
+    if not query_txt.strip():
+        return []
     romanized_query = create_romanized_query_txt(query_txt)
     non_romanized_query = create_non_romanized_query(query_txt)
 
@@ -187,57 +244,32 @@ def search(repo, query_txt, max_results):
                          'names_romanized_by_romanize_word_by_unidecode',
                          'names_romanized_by_romanize_japanese_word'])
 
-    # enclose_in_double_quotes is used for avoiding query_txt
-    # which specifies index field name, contains special symbol, ...
-    # (e.g., "repo: repository_name", "test: test", "test AND test").
-    and_query = romanized_query + ' AND (repo: ' + repo + ')'
-    person_location_index_results = person_location_index.search(
-        appengine_search.Query(
-            query_string=and_query, options=options))
-
-    # To rank exact matches higher than non-exact matches with the same romanization.
-    non_romanized_and_query = non_romanized_query + ' AND (repo: ' + repo + ')'
-    non_romanized_person_location_index_results = person_location_index.search(
-        appengine_search.Query(
-            query_string=non_romanized_and_query, options=options)
-    )
-
-    results_list = [non_romanized_person_location_index_results,
-                    person_location_index_results]
+    def search_index_async(query_string):
+        # enclose_in_double_quotes is used for avoiding query_txt
+        # which specifies index field name, contains special symbol, ...
+        # (e.g., "repo: repository_name", "test: test", "test AND test").
+        and_query = '(' + query_string + ') AND (repo: ' + repo + ')'
+        return person_location_index.search_async(
+            appengine_search.Query(query_string=and_query, options=options))
+
+    # Search the names first, so that records whose names match the whole
+    # query rank higher than records that also need a location match.
+    # In each pass, the non romanized query comes first to rank exact matches
+    # higher than non-exact matches with the same romanization.
+    # All the queries are issued at once so that they run concurrently.
+    name_futures = [search_index_async(query)
+                    for query in create_name_queries(query_txt)]
+    all_fields_futures = [search_index_async(non_romanized_query),
+                          search_index_async(romanized_query)]
+    results_list = [future.get_result() for future in name_futures]
     index_results = get_person_ids_from_results(query_txt, results_list)
+    if len(index_results) < max_results:
+        results_list += [future.get_result() for future in all_fields_futures]
+        index_results = get_person_ids_from_results(query_txt, results_list)
 
-    results = []
-    for id in index_results:
-        result = model.Person.get(repo, id, filter_expired=True)
-        if result:
-            results.append(result)
-    return results
-
-def create_fields_for_rank(field_name, values):
-    """
-    Creates fields for ranking. (person name match > location match)
-    MatchScorer class(assigns score) doesn't support to assign
-    a score based on term frequency in a field.
-    So we add 5 fields for each name params.
-    Args:
-        field_name: field name
-        values: field values
-    Returns:
-        array of appengine_search.TextField(name=field_name, value=value)
-           (length: REPEAT_COUNT_FOR_RANK)
-    """
-    if not values:
-        return []
-
-    fields = []
-    for index, value in enumerate(values):
-        for x in xrange(REPEAT_COUNT_FOR_RANK):
-            fields.append(
-                appengine_search.TextField(name='%s_%d_for_rank_%d' % (
-                    field_name, index, x),
-                    value=value))
-    return fields
-
+    # Fetch all the Persons with a single batch get.
+    persons = model.Person.get_all(repo, index_results[:max_results])
+    return [person for person in persons if not person.is_expired]
 
 def create_full_name_list_without_space(given_names, family_names):
     """
@@ -254,58 +286,30 @@ def create_full_name_list_without_space(given_names, family_names):
     return full_names
 
 
-def create_full_name_without_space_fields(romanize_method, given_name, family_name):
-    """
-    Creates fields with the full name without white spaces.
-    Returns:
-        fullname fields, romanized_name_list: (for check)
-    """
-    fields = []
-    romanized_name_list = []
-    romanized_given_names = romanize_method(given_name)
-    romanized_family_names = romanize_method(family_name)
-    romanize_method_name = romanize_method.__name__
-    full_names = create_full_name_list_without_space(
-        romanized_given_names, romanized_family_names)
-    for index, full_name in enumerate(full_names):
-        fields.append(appengine_search.TextField(
-            name='no_space_full_name_romanized_by_%s_%d' % (
-                romanize_method_name, index),
-            value=full_name))
-        romanized_name_list.append(full_name)
-    return fields, romanized_name_list
-
-
 def create_romanized_name_fields(romanize_method, **kwargs):
     """
     Creates romanized name fields (romanized by romanize_method)
     for full text search.
+    All the romanized names, including the full names without white spaces,
+    go in a single field, which the name-only queries are restricted to.
+    Returns:
+        [appengine_search.TextField(name='names_romanized_by_...', value=...)]
     """
-    fields = []
     romanized_names_list = []
-    romanize_method_name = romanize_method.__name__
-
     for field_name, field_value in kwargs.iteritems():
-        romanized_names = romanize_method(field_value)
-        for index, romanized_name in enumerate(romanized_names):
-            fields.extend(create_fields_for_rank('%s_romanized_by_%s_%d' %
-                                                 (field_name,
-                                                  romanize_method_name, index),
-                                                 romanized_name))
-        romanized_names_list.extend(romanized_names)
-
-    full_name_fields, romanized_full_names = \
-            create_full_name_without_space_fields(
-        romanize_method, kwargs['given_name'], kwargs['family_name'])
-    fields.extend(full_name_fields)
-    romanized_names_list.extend(romanized_full_names)
-
-    names = ':'.join([name for name in romanized_names_list if name])
-    fields.append(
-        appengine_search.TextField(name='names_romanized_by_'+romanize_method_name,
-                                   value=names))
+        romanized_names_list.extend(romanize_method(field_value))
+    romanized_names_list.extend(create_full_name_list_without_space(
+        romanize_method(kwargs['given_name']),
+        romanize_method(kwargs['family_name'])))
 
-    return fields
+    # Each name appears once; the search API tokenizes on white space.
+    names = []
+    for name in romanized_names_list:
+        if name and name not in names:
+            names.append(name)
+    return [appengine_search.TextField(
+        name='names_romanized_by_' + romanize_method.__name__,
+        value=' '.join(names))]
 
 
 def create_romanized_location_fields(romanize_method, **kwargs):
@@ -367,12 +371,7 @@ def create_document(person):
             home_neighborhood=person.home_neighborhood,
             home_country=person.home_country))
 
-    # Applies two methods because kanji is used in Chinese and Japanese,
-    # and romanizing in chinese and japanese is different.
-    romanize_methods = [script_variant.romanize_word_by_unidecode,
-                        script_variant.romanize_japanese_word]
-
-    for romanize_method in romanize_methods:
+    for romanize_method in ROMANIZE_METHODS:
         fields.extend(create_romanized_name_fields(
             romanize_method,
             given_name=person.given_name,
@@ -403,6 +402,40 @@ def add_record_to_index(person):
     person_location_index.put(create_document(person))
 
 
+def add_records_to_index(persons):
+    """
+    Adds person records to index, putting as many documents as the search
+    API allows in each request.
+    Args:
+        persons: a list of Persons to index
+    Returns:
+        A list of (record_id, error_message) pairs for the Persons that
+        could not be indexed.
+    """
+    person_location_index = appengine_search.Index(
+        name=PERSON_LOCATION_FULL_TEXT_INDEX_NAME)
+    documents = [(person.record_id, create_document(person))
+                 for person in persons]
+    batch_size = appengine_search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+    errors = []
+    for start in xrange(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        try:
+            results = person_location_index.put(
+                [document for record_id, document in batch])
+        except appengine_search.PutError, e:
+            # Some of the documents failed; e.results has one result for
+            # each document in the batch.
+            results = e.results
+        except appengine_search.Error, e:
+            errors.extend((record_id, str(e)) for record_id, document in batch)
+            continue
+        for (record_id, document), result in zip(batch, results):
+            if result.code != appengine_search.OperationResult.OK:
+                errors.append((record_id, result.message))
+    return errors
+
+
 def delete_record_from_index(person):
     """
     Deletes person record from index.
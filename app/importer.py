@@ -22,8 +22,9 @@ __author__ = 'kpy@google.com (Ka-Ping Yee) and many other Googlers'
 
 import datetime
 import logging
+import random
 import re
-import sys
+import time
 
 from google.appengine.api import datastore_errors
 
@@ -34,6 +35,15 @@ from utils import validate_sex, validate_status, validate_approximate_date, \
 
 DEFAULT_PUT_RETRIES = 3
 MAX_PUT_BATCH = 100
+# Number of batch puts to keep running at once.
+MAX_PUTS_IN_FLIGHT = 4
+# Maximum delay in seconds before the first retry of a failed put; the maximum
+# doubles with each attempt.
+PUT_RETRY_DELAY = 0.5
+# Errors after which a put is worth retrying.
+TRANSIENT_PUT_ERRORS = (datastore_errors.Timeout,
+                        datastore_errors.TransactionFailedError,
+                        datastore_errors.InternalError)
 
 def utf8_decoder(dict_reader):
     """Yields a dictionary where all string values are converted to Unicode.
@@ -51,16 +61,63 @@ def utf8_decoder(dict_reader):
                 record[key] = value.decode('utf-8')
         yield record
 
-def put_batch(batch, retries=DEFAULT_PUT_RETRIES):
-    for attempt in range(retries):
+def put_batches(batches, on_success=None, retries=DEFAULT_PUT_RETRIES):
+    """Stores a list of batches of entities, keeping up to MAX_PUTS_IN_FLIGHT
+    puts running at once.  A batch that fails with a transient error is
+    retried after a randomized, exponentially increasing delay; a batch that
+    fails otherwise, or more than 'retries' times, is skipped.  Only the put
+    itself is retried; the counts are updated once, after it succeeds.
+    on_success is called with each batch that was stored, in order of
+    completion.
+
+    Returns:
+        The number of entities stored, and a list of the number of seconds
+        each stored batch took.
+    """
+    pending = [(batch, 0) for batch in batches]  # (batch, attempt) pairs
+    in_flight = []  # (batch, attempt, start_time, rpc) tuples
+    written = 0
+    latencies = []
+    while pending or in_flight:
+        while pending and len(in_flight) < MAX_PUTS_IN_FLIGHT:
+            batch, attempt = pending.pop(0)
+            try:
+                rpc = put_and_count_async(batch)
+            except Exception, e:
+                logging.warn('Skipping batch: %s' % e)
+                continue
+            in_flight.append((batch, attempt, time.time(), rpc))
+        if not in_flight:
+            break
+        batch, attempt, start_time, rpc = in_flight.pop(0)
         try:
-            db.put(batch)
-            logging.info('Imported records: %d' % len(batch))
-            return len(batch)
-        except:
-            type, value, traceback = sys.exc_info()
-            logging.warn('Retrying batch: %s' % value)
-    return 0
+            rpc.get_keys()
+        except TRANSIENT_PUT_ERRORS, e:
+            if attempt + 1 < retries:
+                logging.warn('Retrying batch: %s' % e)
+                time.sleep(random.uniform(0, PUT_RETRY_DELAY * 2**attempt))
+                pending.insert(0, (batch, attempt + 1))
+            else:
+                logging.warn('Skipping batch after %d attempts: %s' %
+                             (retries, e))
+            continue
+        except Exception, e:
+            logging.warn('Skipping batch: %s' % e)
+            continue
+        latency = time.time() - start_time
+        logging.info('Imported records: %d (%.3f s)' % (len(batch), latency))
+        # The batch is stored now, so a failure here must not cause a retry:
+        # the stored count names have already moved on, and the next counting
+        # scan will correct the counts.
+        try:
+            rpc.update_counts()
+        except Exception, e:
+            logging.warn('Failed to update counts for batch: %s' % e)
+        written += len(batch)
+        latencies.append(latency)
+        if on_success:
+            on_success(batch)
+    return written, latencies
 
 date_re = re.compile(r'^(\d\d\d\d)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z$')
 
@@ -171,15 +228,18 @@ def create_note(repo, fields):
     else:  # create a new original record
         return Note.create_original(repo, **note_fields)
 
+# The field that holds the record ID in the records for each converter.  A
+# record without one becomes a new original record, which needs a UniqueId.
+RECORD_ID_FIELDS = {create_person: 'person_record_id',
+                    create_note: 'note_record_id'}
+
 def filter_new_notes(entities, repo):
-    """Filter the notes which are new."""
-    notes = []
-    for entity in entities:
-        # Send an an email notification for new notes only
-        if isinstance(entity, Note):
-            if not Note.get(repo, entity.get_note_record_id()):
-                notes.append(entity)
-    return notes
+    """Filter the notes which are new (or replace expired notes), checking
+    for existing notes with one batch get."""
+    load_stored_count_names(entities)
+    # Send an an email notification for new notes only
+    return [entity for entity in entities
+            if isinstance(entity, Note) and not entity.stored_count_names]
 
 
 def send_notifications(handler, persons, notes):
@@ -196,12 +256,19 @@ def send_notifications(handler, persons, notes):
         subscribe.send_notifications(handler, person, [note])
 
 
+# The fields that must be equal for two notes to be duplicates.
+NOTE_MATCH_FIELDS = [
+    'person_record_id', 'author_name', 'author_email', 'author_phone',
+    'source_date', 'status', 'author_made_contact', 'email_of_found_person',
+    'phone_of_found_person', 'last_known_location', 'text', 'photo_url']
+
+def get_note_fingerprint(note):
+    """Gets a hashable value that is equal for two notes if and only if they
+    match (see notes_match)."""
+    return tuple(getattr(note, f) for f in NOTE_MATCH_FIELDS)
+
 def notes_match(a, b):
-    fields = ['person_record_id', 'author_name', 'author_email', 'author_phone',
-              'source_date', 'status', 'author_made_contact',
-              'email_of_found_person', 'phone_of_found_person',
-              'last_known_location', 'text', 'photo_url']
-    return [getattr(a, f) for f in fields] == [getattr(b, f) for f in fields]
+    return get_note_fingerprint(a) == get_note_fingerprint(b)
 
 
 def import_records(repo, domain, converter, records,
@@ -242,6 +309,14 @@ def import_records(repo, domain, converter, records,
     skipped = []  # entities skipped due to an error
     total = 0  # total number of entities for which conversion was attempted
 
+    # Reserve the IDs for all the new original records in one datastore call.
+    # The records may come from a generator, so read them into a list first.
+    records = list(records)
+    id_field = RECORD_ID_FIELDS.get(converter)
+    if id_field:
+        UniqueId.reserve(len([fields for fields in records
+                              if not strip(fields.get(id_field))]))
+
     for fields in records:
         total += 1
         try:
@@ -255,11 +330,14 @@ def import_records(repo, domain, converter, records,
                 ('Not in authorized domain: %r' % entity.record_id, fields))
             continue
         if isinstance(entity, Person):
-            entity.update_index(['old', 'new'])
             persons[entity.record_id] = entity
         if isinstance(entity, Note):
             input_notes_with_fields.append((entity, fields))
 
+    # Index all the Persons at once, so that the full-text search index is
+    # updated in batches rather than once per Person.
+    Person.update_indexes(persons.values(), ['old', 'new'])
+
     # Note entities to write
     notes = {}
     # Updated Persons other than those being imported.
@@ -271,18 +349,36 @@ def import_records(repo, domain, converter, records,
     # produce a count of records written that only counts 'persons'.
     extra_persons = {}
 
+    # Fetch all the other Persons that the Notes belong to in one batch.
+    other_person_ids = set(note.person_record_id
+                           for note, fields in input_notes_with_fields
+                           if note.person_record_id not in persons)
+    other_persons = dict(
+        (person.record_id, person)
+        for person in Person.get_all(repo, list(other_person_ids))
+        if not person.is_expired)
+
+    # Fetch the existing Notes on all those Persons at once, and keep just
+    # their fingerprints, so each duplicate check is a set lookup.
+    existing_note_fingerprints = set()
+    if omit_duplicate_notes:
+        person_ids = list(set(note.person_record_id
+                              for note, fields in input_notes_with_fields))
+        for i in range(0, len(person_ids), MAX_PUT_BATCH):
+            for existing_notes in Note.get_by_person_record_ids(
+                repo, person_ids[i:i + MAX_PUT_BATCH],
+                filter_expired=False).values():
+                existing_note_fingerprints.update(
+                    get_note_fingerprint(note) for note in existing_notes)
+
     for (note, fields) in input_notes_with_fields:
         if note.person_record_id in persons:
             # This Note belongs to a Person that is being imported.
             person = persons[note.person_record_id]
-        elif note.person_record_id in extra_persons:
-            # This Note belongs to some other Person that is not part of this
-            # import and is already being updated due to another Note.
-            person = extra_persons[note.person_record_id]
         else:
             # This Note belongs to some other Person that is not part of this
-            # import and this is the first such Note in this import.
-            person = Person.get(repo, note.person_record_id)
+            # import.
+            person = other_persons.get(note.person_record_id)
 
         if not person:
             skipped.append(
@@ -305,9 +401,7 @@ def import_records(repo, domain, converter, records,
             continue
         # Check whether the note is a duplicate.
         if omit_duplicate_notes:
-            other_notes = Note.get_by_person_record_id(
-                repo, note.person_record_id, filter_expired=False)
-            if any(notes_match(note, other_note) for other_note in other_notes):
+            if get_note_fingerprint(note) in existing_note_fingerprints:
                 skipped.append(
                     ('This is a duplicate of an existing note', fields))
                 continue
@@ -327,25 +421,34 @@ def import_records(repo, domain, converter, records,
     # Now store the imported Persons and Notes, and count them.
     entities = persons.values() + notes.values()
     all_persons = dict(persons, **extra_persons)
-    written = 0
-    while entities:
-        # The presence of a handler indicates we should notify subscribers 
-        # for any new notes being written. We do not notify on 
-        # "re-imported" existing notes to avoid spamming subscribers.
-        new_notes = []
-        if handler:
-            new_notes = filter_new_notes(entities[:MAX_PUT_BATCH], repo)
-        written_batch = put_batch(entities[:MAX_PUT_BATCH])
-        written += written_batch
-        # If we have new_notes and results did not fail then send notifications.
-        if new_notes and written_batch:
+    batches = [entities[i:i + MAX_PUT_BATCH]
+               for i in range(0, len(entities), MAX_PUT_BATCH)]
+
+    # The presence of a handler indicates we should notify subscribers
+    # for any new notes being written. We do not notify on
+    # "re-imported" existing notes to avoid spamming subscribers.
+    new_note_ids = set()
+    if handler:
+        for batch in batches:
+            new_note_ids.update(
+                note.record_id for note in filter_new_notes(batch, repo))
+
+    def notify_subscribers(batch):
+        new_notes = [entity for entity in batch if isinstance(entity, Note)
+                     and entity.record_id in new_note_ids]
+        if new_notes:
             send_notifications(handler, all_persons, new_notes)
-        entities[:MAX_PUT_BATCH] = []
+
+    written, latencies = put_batches(
+        batches, on_success=handler and notify_subscribers or None)
+    if latencies:
+        logging.info('Put %d batches in %.3f s each on average (max %.3f s)' %
+                     (len(latencies), sum(latencies) / len(latencies),
+                      max(latencies)))
 
     # Also store the other updated Persons, but don't count them.
     entities = extra_persons.values()
-    while entities:
-        put_batch(entities[:MAX_PUT_BATCH])
-        entities[:MAX_PUT_BATCH] = []
+    put_batches([entities[i:i + MAX_PUT_BATCH]
+                 for i in range(0, len(entities), MAX_PUT_BATCH)])
 
     return written, skipped, total
@@ -34,20 +34,36 @@ but will not be retrieved by:
 
 from text_query import TextQuery
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
+import bisect
+import datetime
 import unicodedata
 import logging
+import config
 import model
 import re
 import jautils
 
 
-def update_index_properties(entity):
-    """Finds and updates all prefix-related properties on the given entity."""
+# Splits out each CJK ideograph as its own word, as TextQuery does.
+CJK_CHAR_RE = re.compile(ur'([\u3400-\u9fff])')
+CJK_NAME_RE = re.compile(ur'^[\u3400-\u9fff]+$')
+
+
+def update_index_properties(entity, token_stats=False):
+    """Finds and updates all prefix-related properties on the given entity.
+    If token_stats is True, also updates the TokenStats for the entity's
+    repository; write paths that store the entity should ask for this (or
+    update the TokenStats themselves)."""
+    old_names_prefixes = entity.names_prefixes
+    text_queries = dict((property, TextQuery(getattr(entity, property)))
+                        for property in entity._fields_to_index_properties)
+
     # Using set to make sure I'm not adding the same string more than once.
     names_prefixes = set()
     for property in entity._fields_to_index_properties:
-        for value in TextQuery(getattr(entity, property)).query_words:
+        for value in text_queries[property].query_words:
             if property in entity._fields_to_index_by_prefix_properties:
                 for n in xrange(1,len(value)+1):
                     pref = value[:n]
@@ -61,7 +77,8 @@ def update_index_properties(entity):
     # of alternate names so that we can keep the index size small.
     # TODI(ryok): This strategy works well for Japanese, but how about other
     # languages?
-    names_prefixes |= get_alternate_name_tokens(entity)
+    alternate_names = TextQuery(entity.alternate_names)
+    names_prefixes |= get_alternate_name_tokens(entity, alternate_names)
 
     # Put a cap on the number of tokens, just as a precaution.
     MAX_TOKENS = 100
@@ -69,131 +86,130 @@ def update_index_properties(entity):
     if len(names_prefixes) > MAX_TOKENS:
         logging.debug('MAX_TOKENS exceeded for %s' %
                       ' '.join(list(names_prefixes)))
+    if token_stats:
+        update_token_stats(
+            [(entity.repo, old_names_prefixes, entity.names_prefixes)])
+
+    # Store the normalized names so that ranking doesn't have to normalize
+    # them again for every search.
+    entity.ranking_names = [text_queries['given_name'].normalized,
+                            text_queries['family_name'].normalized,
+                            text_queries['full_name'].normalized,
+                            alternate_names.normalized]
 
 
-def get_alternate_name_tokens(person):
+def get_alternate_name_tokens(person, alternate_names=None):
     """Returns alternate name tokens and their variations."""
-    tokens = set(TextQuery(person.alternate_names).query_words)
+    alternate_names = alternate_names or TextQuery(person.alternate_names)
+    tokens = set(alternate_names.query_words)
     # This is no-op for non-Japanese.
     tokens |= set(jautils.get_additional_tokens(tokens))
     return tokens
 
 
-class CmpResults():
-    def __init__(self, query):
-        self.query = query
-        self.query_words_set = set(query.words)
+def split_words(normalized):
+    """Splits a string normalized by TextQuery into words, the same way as
+    TextQuery.words."""
+    return CJK_CHAR_RE.sub(r' \1 ', normalized).split()
 
-    def __call__(self, p1, p2):
-        if ((p1.primary_full_name and
-             p1.primary_full_name == p2.primary_full_name) or
-            ((p1.given_name or p1.family_name) and
-             p1.given_name == p2.given_name and
-             p1.family_name == p2.family_name)):
-            return 0
-        self.set_ranking_attr(p1)
-        self.set_ranking_attr(p2)
-        r1 = self.rank(p1)
-        r2 = self.rank(p2)
-
-        if r1 == r2:
-            # if rank is the same sort by name so same names will be together
-            return cmp(p1._normalized_full_name.normalized,
-                       p2._normalized_full_name.normalized)
+
+class RankingNames(object):
+    """The normalized names of a Person, as used for ranking.  These come from
+    the ranking_names stored by update_index_properties(), or are computed
+    on the fly for Persons that haven't been re-indexed since it was added."""
+
+    def __init__(self, person):
+        if len(person.ranking_names or []) == 4:
+            given, family, full, alternate = person.ranking_names
         else:
-            return cmp(r2, r1)
+            given = TextQuery(person.given_name).normalized
+            family = TextQuery(person.family_name).normalized
+            full = TextQuery(person.full_name).normalized
+            alternate = TextQuery(person.alternate_names).normalized
+        self.given_normalized = given
+        self.family_normalized = family
+        self.full_normalized = full
+        self.given_words = split_words(given)
+        self.family_words = split_words(family)
+        self.name_words = set(split_words(full))
+        self.alt_name_words = set(split_words(alternate))
+
+
+class RankingKey():
+    """A sort key function that orders Persons by how well they match the
+    query, best first, and then by name so that same names stay together."""
 
+    def __init__(self, query):
+        self.query = query
+        self.query_words_set = set(query.words)
+        # The normalized query words, in the order as entered.
+        self.ordered_words = query.normalized.split()
 
-    def set_ranking_attr(self, person):
-        """Consider save these into to db"""
-        if not hasattr(person, '_normalized_given_name'):
-            person._normalized_given_name = TextQuery(person.given_name)
-            person._normalized_family_name = TextQuery(person.family_name)
-            person._normalized_full_name = TextQuery(person.full_name)
-            person._name_words = set(person._normalized_full_name.words)
-            person._alt_name_words = set(
-                    TextQuery(person.alternate_names).words)
+    def __call__(self, person):
+        names = RankingNames(person)
+        return (-self.rank(person, names), names.full_normalized)
 
     # TODO(ryok): re-consider the ranking putting more weight on full_name (a
     # required field) instead of given name and family name pair (optional).
-    def rank(self, person):
-        # The normalized query words, in the order as entered.
-        ordered_words = self.query.normalized.split()
+    def rank(self, person, names):
+        ordered_words = self.ordered_words
+        given_name = person.given_name or ''
+        family_name = person.family_name or ''
 
-        if (ordered_words ==
-            person._normalized_given_name.words +
-            person._normalized_family_name.words):
+        if ordered_words == names.given_words + names.family_words:
             # Matches a Latin name exactly (given name followed by surname).
             return 10
 
-        if (re.match(ur'^[\u3400-\u9fff]$', person.family_name) and
+        if (CJK_NAME_RE.match(family_name) and
             ordered_words in [
-                [person.family_name + person.given_name],
-                [person.family_name, person.given_name]
-            ]):
-            # Matches a CJK name exactly (surname followed by given name).
-            return 10
-
-        if (re.match(ur'^[\u3400-\u9fff]+$', person.family_name) and
-            ordered_words in [
-                [person.family_name + person.given_name],
-                [person.family_name, person.given_name]
+                [family_name + given_name],
+                [family_name, given_name]
             ]):
             # Matches a CJK name exactly (surname followed by given name).
             # A multi-character surname is uncommon, so it is ranked a bit lower.
-            return 9.5
+            return 10 if len(family_name) == 1 else 9.5
 
-        if (ordered_words ==
-            person._normalized_family_name.words +
-            person._normalized_given_name.words):
+        if ordered_words == names.family_words + names.given_words:
             # Matches a Latin name with given and family name switched.
             return 9
 
-        if (re.match(ur'^[\u3400-\u9fff]$', person.given_name) and
+        if (CJK_NAME_RE.match(given_name) and
             ordered_words in [
-                    [person.given_name + person.family_name],
-                    [person.given_name, person.family_name]
-            ]):
-            # Matches a CJK name with surname and given name switched.
-            return 9
-
-        if (re.match(ur'^[\u3400-\u9fff]+$', person.given_name) and
-            ordered_words in [
-                    [person.given_name + person.family_name],
-                    [person.given_name, person.family_name]
+                    [given_name + family_name],
+                    [given_name, family_name]
             ]):
             # Matches a CJK name with surname and given name switched.
             # A multi-character surname is uncommon, so it's ranked a bit lower.
-            return 8.5
+            return 9 if len(given_name) == 1 else 8.5
 
-        if person._name_words == self.query_words_set:
+        if names.name_words == self.query_words_set:
             # Matches all the words in the given and family name, out of order.
             return 8
 
         if self.query.normalized in [
-            person._normalized_given_name.normalized,
-            person._normalized_family_name.normalized,
+            names.given_normalized,
+            names.family_normalized,
         ]:
             # Matches the given name exactly or the family name exactly.
             return 7
 
-        if person._name_words.issuperset(self.query_words_set):
+        if names.name_words.issuperset(self.query_words_set):
             # All words in the query appear somewhere in the name.
             return 6
 
         # Count the number of words in the query that appear in the name and
         # also in the alternate names.
-        matched_words = person._name_words.union(
-            person._alt_name_words).intersection(self.query_words_set)
+        matched_words = names.name_words.union(
+            names.alt_name_words).intersection(self.query_words_set)
         return min(5, 1 + len(matched_words))
 
 
 def rank_and_order(results, query, max_results):
-    results.sort(CmpResults(query))
+    results.sort(key=RankingKey(query))
     return results[:max_results]
 
 
-def sort_query_words(query_words):
+def sort_query_words(query_words, token_stats=None):
     """Sort query_words so that the query filters created from query_words are
     more effective and consistent when truncated due to NeedIndexError, and
     return the sorted list."""
@@ -206,7 +222,266 @@ def sort_query_words(query_words):
     sorted_query_words = jautils.sorted_by_popularity(sorted_query_words)
     #   (3) Sort them according to the lengths so that longer query words,
     #       which are usually more effective filters, come first.
-    return sorted(sorted_query_words, key=len, reverse=True)
+    sorted_query_words = sorted(sorted_query_words, key=len, reverse=True)
+    #   (4) If we know how many Persons in the repository have each word,
+    #       sort them by that, so that the most selective filters come first.
+    if token_stats:
+        sorted_query_words.sort(key=token_stats.get_sort_key)
+    return sorted_query_words
+
+
+class TokenStats(object):
+    """Document frequencies of names_prefixes tokens in one repository: for
+    each token, the number of Persons that have it.  These are kept in
+    memcache and updated incrementally by update_token_stats() whenever
+    Persons are indexed, so they are approximate: entries can be evicted, and
+    Persons indexed before the statistics existed aren't counted until they
+    are re-indexed (see tasks.Reindex).
+
+    Search uses them only to order its filters, which matters only when some
+    of the filters have to be dropped because of NeedIndexError."""
+
+    # Memcache key prefix for the statistics, followed by the repo name and
+    # a colon.  The number of indexed Persons is kept under DOCUMENTS_KEY and
+    # the count for each token under 'token:' + the token.
+    KEY_PREFIX = 'token_stats:'
+    DOCUMENTS_KEY = 'documents'
+
+    # The statistics aren't worth using for repositories smaller than this.
+    MIN_DOCUMENTS = 100
+
+    def __init__(self, documents, frequencies):
+        self.documents = documents
+        self.frequencies = frequencies  # token -> number of Persons
+
+    @staticmethod
+    def get_key_prefix(repo):
+        return TokenStats.KEY_PREFIX + repo + ':'
+
+    @staticmethod
+    def get_token_key(token):
+        return 'token:' + token.encode('utf-8')
+
+    @classmethod
+    def get_document_count(cls, repo):
+        """Returns the number of Persons counted in the statistics."""
+        return memcache.get(
+            cls.get_key_prefix(repo) + cls.DOCUMENTS_KEY) or 0
+
+    @classmethod
+    def load(cls, repo, tokens):
+        """Gets the statistics for the given tokens in a single memcache
+        call.  Returns None if the repository has too few indexed Persons."""
+        keys = dict((cls.get_token_key(token), token) for token in tokens)
+        values = memcache.get_multi(
+            keys.keys() + [cls.DOCUMENTS_KEY],
+            key_prefix=cls.get_key_prefix(repo))
+        documents = values.pop(cls.DOCUMENTS_KEY, 0)
+        if documents < cls.MIN_DOCUMENTS:
+            return None
+        return cls(documents, dict(
+            (keys[key], count) for key, count in values.iteritems()))
+
+    def get_sort_key(self, token):
+        """Sorts tokens by their document frequencies.  A token with no
+        count is most likely in no Person at all (counts for common tokens
+        are updated often, so they are the last to be evicted), so it goes
+        first."""
+        return self.frequencies.get(token, 0)
+
+
+def update_token_stats(changes):
+    """Updates the TokenStats for changes in the indexed tokens of some
+    Persons.  'changes' is a list of (repo, old_tokens, new_tokens) triples,
+    one for each Person; an empty list of tokens means the Person wasn't (or
+    is no longer) indexed.  Makes one memcache call for each repository."""
+    deltas_by_repo = {}
+    for repo, old_tokens, new_tokens in changes:
+        old_tokens, new_tokens = set(old_tokens or []), set(new_tokens or [])
+        deltas = deltas_by_repo.setdefault(repo, {})
+        for token in new_tokens - old_tokens:
+            key = TokenStats.get_token_key(token)
+            deltas[key] = deltas.get(key, 0) + 1
+        for token in old_tokens - new_tokens:
+            key = TokenStats.get_token_key(token)
+            deltas[key] = deltas.get(key, 0) - 1
+        documents = bool(new_tokens) - bool(old_tokens)
+        if documents:
+            key = TokenStats.DOCUMENTS_KEY
+            deltas[key] = deltas.get(key, 0) + documents
+    for repo, deltas in deltas_by_repo.iteritems():
+        deltas = dict((key, delta) for key, delta in deltas.iteritems()
+                      if delta)
+        if deltas:
+            memcache.offset_multi(deltas, key_prefix=TokenStats.get_key_prefix(
+                repo), initial_value=0)
+
+
+class InvertedIndex(object):
+    """An in-process inverted index over the names_prefixes of the Persons in
+    one repository.  Each token maps to a sorted list of record IDs (a postings
+    list), so a query can be answered by intersecting postings lists without
+    running any datastore queries.
+
+    The index lives in instance memory and is only used for repositories with
+    the 'enable_inverted_index' config setting.  It is built by scanning the
+    repository a few batches per request, and then kept up to date by
+    Person.update_index() for writes in this process and by sync() for writes
+    in other processes.  Postings for Persons deleted in other processes are
+    dropped when a search finds them missing (see search_inverted_index)."""
+
+    # Records modified up to this long before the last sync are scanned
+    # again on the next sync, to tolerate clock skew between instances.
+    SYNC_OVERLAP = datetime.timedelta(seconds=10)
+
+    # Number of Persons to fetch per batch while syncing.
+    SYNC_BATCH_SIZE = 500
+
+    # Maximum number of batches that get_inverted_index() fetches in one
+    # request, so that no single search pays for building the whole index.
+    SYNC_MAX_BATCHES = 2
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.postings = {}  # token -> sorted list of record IDs
+        self.tokens = {}  # record ID -> list of tokens currently indexed
+        self.synced_until = None  # last_modified of the newest synced Person
+        self.sync_started = None  # when the sync in progress started
+        self.sync_since = None  # last_modified bound of the sync in progress
+        self.sync_cursor = None  # where the sync in progress left off
+        self.complete = False  # True once a sync has reached the end
+
+    def add(self, person):
+        """Adds or replaces the postings for the given Person."""
+        record_id = person.record_id
+        self.remove(record_id)
+        if person.is_expired:
+            return
+        tokens = set(person.names_prefixes)
+        for token in tokens:
+            bisect.insort(self.postings.setdefault(token, []), record_id)
+        self.tokens[record_id] = list(tokens)
+
+    def remove(self, record_id):
+        """Removes any postings for the given record ID."""
+        for token in self.tokens.pop(record_id, []):
+            postings = self.postings[token]
+            i = bisect.bisect_left(postings, record_id)
+            if i < len(postings) and postings[i] == record_id:
+                del postings[i]
+            if not postings:
+                del self.postings[token]
+
+    def sync(self, max_batches=None):
+        """Applies changes to Persons written since the last sync, fetching
+        at most max_batches batches (or all of them, if max_batches is None).
+        A sync that stops early is continued by the next call."""
+        if not self.sync_cursor:
+            self.sync_started = datetime.datetime.utcnow()
+            self.sync_since = (self.synced_until and
+                               self.synced_until - self.SYNC_OVERLAP)
+        query = model.Person.all_in_repo(self.repo, filter_expired=False)
+        if self.sync_since:
+            query.filter('last_modified >', self.sync_since)
+        query.order('last_modified')
+        if self.sync_cursor:
+            query.with_cursor(self.sync_cursor)
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            persons = query.fetch(self.SYNC_BATCH_SIZE)
+            batches += 1
+            for person in persons:
+                self.add(person)
+                if person.last_modified:
+                    self.synced_until = max(
+                        self.synced_until, person.last_modified)
+            if len(persons) < self.SYNC_BATCH_SIZE:
+                # Don't rescan the whole repository next time if it has no
+                # Persons with a last_modified time.
+                self.synced_until = self.synced_until or self.sync_started
+                self.sync_cursor = None
+                self.complete = True
+                return
+            self.sync_cursor = query.cursor()
+            query.with_cursor(self.sync_cursor)
+
+    def lookup(self, words, limit=None):
+        """Returns up to 'limit' record IDs (or all of them, if limit is None)
+        whose tokens include all of the given words, starting the
+        intersection from the shortest postings."""
+        postings_lists = []
+        for word in set(words):
+            if word not in self.postings:
+                return []
+            postings_lists.append(self.postings[word])
+        if not postings_lists:
+            return []
+        postings_lists.sort(key=len)
+        matched = postings_lists[0]
+        for postings in postings_lists[1:]:
+            matched = [id for id in matched if contains(postings, id)]
+            if not matched:
+                break
+        return matched[:limit]
+
+
+def contains(sorted_list, value):
+    """Returns True if value is in sorted_list, using a binary search."""
+    i = bisect.bisect_left(sorted_list, value)
+    return i < len(sorted_list) and sorted_list[i] == value
+
+
+# Per-process inverted indexes, keyed by repository name.
+_inverted_indexes = {}
+
+
+def get_inverted_index(repo):
+    """Returns the InvertedIndex for the given repository, after syncing it
+    for up to InvertedIndex.SYNC_MAX_BATCHES batches, or None if the
+    repository doesn't use one or its index hasn't been fully built yet."""
+    if not config.get_for_repo(repo, 'enable_inverted_index'):
+        return None
+    index = _inverted_indexes.get(repo)
+    if index is None:
+        index = _inverted_indexes[repo] = InvertedIndex(repo)
+    index.sync(InvertedIndex.SYNC_MAX_BATCHES)
+    return index.complete and index or None
+
+
+def update_inverted_index(person):
+    """Updates the Person's postings in this process's InvertedIndex for its
+    repository, if one has already been built."""
+    index = _inverted_indexes.get(person.repo)
+    if index:
+        index.add(person)
+
+
+def remove_from_inverted_index(person):
+    """Removes the Person from this process's InvertedIndex for its
+    repository, if one has already been built."""
+    index = _inverted_indexes.get(person.repo)
+    if index:
+        index.remove(person.record_id)
+
+
+def search_inverted_index(index, query_words, fetch_limit):
+    """Returns up to fetch_limit Persons whose names_prefixes include all the
+    query_words.  Postings for Persons that turn out to be deleted or expired
+    are removed from the index, and more Persons are fetched in their place,
+    so that they don't use up the fetch_limit."""
+    record_ids = index.lookup(query_words)
+    persons = []
+    while record_ids and len(persons) < fetch_limit:
+        batch_size = fetch_limit - len(persons)
+        batch, record_ids = record_ids[:batch_size], record_ids[batch_size:]
+        key_names = [index.repo + ':' + id for id in batch]
+        for id, person in zip(
+            batch, model.Person.get_by_key_name(key_names)):
+            if person and not person.is_expired:
+                persons.append(person)
+            else:
+                index.remove(id)
+    return persons
 
 
 def search(repo, query_obj, max_results):
@@ -215,7 +490,13 @@ def search(repo, query_obj, max_results):
     # potentially matter.  In particular, this is the case for most Japanese
     # names, many of which consist of 4 to 6 Chinese characters, each
     # coresponding to an additional filter.
-    query_words = sort_query_words(query_obj.query_words)
+    #
+    # The TokenStats tell us how selective each query word actually is, so
+    # we use them to order the filters.  Every query word is still used as a
+    # filter, so that the fetch_limit isn't used up by Persons that match
+    # only some of them.
+    token_stats = TokenStats.load(repo, query_obj.query_words)
+    query_words = sort_query_words(query_obj.query_words, token_stats)
     logging.debug('query_words: %r' % query_words)
 
     # First try the query with all the filters, and then keep backing off
@@ -223,6 +504,10 @@ def search(repo, query_obj, max_results):
     fetch_limit = 400
     fetched = []
     filters_to_try = len(query_words)
+    index = get_inverted_index(repo)
+    if index:
+        fetched = search_inverted_index(index, query_words, fetch_limit)
+        filters_to_try = 0
     while filters_to_try:
         query = model.Person.all_in_repo(repo)
         for word in query_words[:filters_to_try]:
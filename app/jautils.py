@@ -314,6 +314,18 @@ HIRAGANA_TO_ROMAJI_POST_PROCESS = [
     [r'OO', u'O'], [r'OU', u'O'],
 ]
 
+# HIRAGANA_TO_ROMAJI as a dictionary from hiragana to (romaji, next), for
+# finding the longest match with one lookup per candidate length.  Where the
+# table has several entries for the same hiragana, the first one wins.
+HIRAGANA_TO_ROMAJI_MAP = dict((hira, (rom, next)) for (hira, rom, next)
+                              in reversed(HIRAGANA_TO_ROMAJI))
+HIRAGANA_TO_ROMAJI_MAX_LENGTH = max(
+    len(hira) for hira in HIRAGANA_TO_ROMAJI_MAP)
+
+# HIRAGANA_TO_ROMAJI_POST_PROCESS only ever rewrites runs of vowels, so
+# the romaji is scanned once for those runs and the rules are applied to each.
+HIRAGANA_TO_ROMAJI_POST_PROCESS_RE = re.compile(r'[AIUEO]{2,}')
+
 
 # Katakana to hiragana.
 KATAKANA_TO_HIRAGANA = {
@@ -542,24 +554,31 @@ def hiragana_to_romaji(string):
         The replaced string.
     """
     remaining = string
-    result = u''
+    result = []
     while remaining:
-        longest = 0
-        longest_data = None
-        for (hira, rom, next) in HIRAGANA_TO_ROMAJI:
-            if remaining.startswith(hira) and len(hira) > longest:
-                longest_data = (hira, rom, next)
-                longest = len(hira)
-        if longest == 0:
+        # Find the longest prefix of remaining that is in the table.
+        for length in xrange(
+                min(HIRAGANA_TO_ROMAJI_MAX_LENGTH, len(remaining)), 0, -1):
+            data = HIRAGANA_TO_ROMAJI_MAP.get(remaining[:length])
+            if data:
+                rom, next = data
+                result.append(rom)
+                remaining = next + remaining[length:]
+                break
+        else:
             # erroneous info
-            result += remaining[0]
+            result.append(remaining[0])
             remaining = remaining[1:]
-        else:
-            result += longest_data[1]
-            remaining = longest_data[2] + remaining[len(longest_data[0]):]
+    return HIRAGANA_TO_ROMAJI_POST_PROCESS_RE.sub(
+        post_process_romaji_vowels, u''.join(result))
+
+
+def post_process_romaji_vowels(match):
+    """Applies HIRAGANA_TO_ROMAJI_POST_PROCESS, in order, to a run of vowels."""
+    vowels = match.group()
     for (pat, rep) in HIRAGANA_TO_ROMAJI_POST_PROCESS:
-        result = re.sub(pat, rep, result)
-    return result
+        vowels = re.sub(pat, rep, vowels)
+    return vowels
 
 
 def get_additional_tokens(tokens):
@@ -101,9 +101,15 @@ HANDLER_CLASSES['tasks/count/note'] = 'tasks.CountNote'
 HANDLER_CLASSES['tasks/count/person'] = 'tasks.CountPerson'
 HANDLER_CLASSES['tasks/count/reindex'] = 'tasks.Reindex'
 HANDLER_CLASSES['tasks/count/update_dead_status'] = 'tasks.UpdateDeadStatus'
+HANDLER_CLASSES['tasks/count/update_duplicate_clusters'] = \
+    'tasks.UpdateDuplicateClusters'
 HANDLER_CLASSES['tasks/count/update_status'] = 'tasks.UpdateStatus'
 HANDLER_CLASSES['tasks/delete_expired'] = 'tasks.DeleteExpired'
 HANDLER_CLASSES['tasks/delete_old'] = 'tasks.DeleteOld'
+HANDLER_CLASSES['tasks/update_pending_status'] = 'tasks.UpdatePendingStatus'
+HANDLER_CLASSES['tasks/update_pending_clusters'] = \
+    'tasks.UpdatePendingClusters'
+HANDLER_CLASSES['tasks/resume_import'] = 'api.ResumeImport'
 HANDLER_CLASSES['tasks/clean_up_in_test_mode'] = 'tasks.CleanUpInTestMode'
 
 def is_development_server():
@@ -18,15 +18,14 @@
 __author__ = 'kpy@google.com (Ka-Ping Yee) and many other Googlers'
 
 from datetime import timedelta
+import logging
+import random
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.ext import db
-from google.appengine.api import search
 
 import config
-import full_text_search
-import indexing
 import pfif
 import prefix
 from const import HOME_DOMAIN
@@ -154,6 +153,35 @@ class Base(db.Model):
     # NOTE: is_expired should ONLY be modified in Person.put_expiry_flags().
     is_expired = db.BooleanProperty(required=False, default=False)
 
+    # The name of the Counter scan that counts entities of this kind, or None
+    # if they aren't counted.  Entities that are counted keep the live counts
+    # up to date whenever they are written (see put_and_count).
+    COUNTER_SCAN_NAME = None
+
+    def __init__(self, *args, **kwargs):
+        db.Model.__init__(self, *args, **kwargs)
+        # The count names (see get_count_names) of this entity as it is
+        # stored in the datastore: [] if it isn't stored, or None if we don't
+        # know yet (e.g. a clone that may overwrite an existing record).
+        self.stored_count_names = None
+        if kwargs.get('_from_entity'):
+            self.stored_count_names = self.get_count_names()
+
+    def get_count_names(self):
+        """Returns the names of the Counter accumulators that this entity
+        adds 1 to.  Subclasses with a COUNTER_SCAN_NAME should override this."""
+        return []
+
+    def put(self, **kwargs):
+        """Stores this entity and updates the live counts."""
+        load_stored_count_names([self])
+        key = db.Model.put(self, **kwargs)
+        updates = make_pending_updates([self])
+        if updates:
+            db.put(updates)
+        apply_count_changes([self])
+        return key
+
     @classmethod
     def all(cls, keys_only=False, filter_expired=True):
         """Returns a query for all records of this kind; by default this
@@ -220,7 +248,9 @@ class Base(db.Model):
         # which is more consitent with repo id format.
         record_id = '%s.%s/%s.%d' % (
             repo, HOME_DOMAIN, cls.__name__.lower(), UniqueId.create_id())
-        return cls(key_name=repo + ':' + record_id, repo=repo, **kwargs)
+        entity = cls(key_name=repo + ':' + record_id, repo=repo, **kwargs)
+        entity.stored_count_names = []  # the record ID is new
+        return entity
 
     @classmethod
     def create_clone(cls, repo, record_id, **kwargs):
@@ -315,6 +345,8 @@ class Person(Base):
 
     # attributes used by indexing.py
     names_prefixes = db.StringListProperty()
+    # Normalized given, family, full and alternate names, for ranking.
+    ranking_names = db.StringListProperty(indexed=False)
     # TODO(ryok): index address components.
     _fields_to_index_properties = ['given_name', 'family_name', 'full_name']
     _fields_to_index_by_prefix_properties = ['given_name', 'family_name',
@@ -366,6 +398,31 @@ class Person(Base):
         import utils
         return utils.strip_url_scheme(self.photo_url)
 
+    COUNTER_SCAN_NAME = 'person'
+
+    def get_count_names(self):
+        """Returns the names of the accumulators in the 'person' Counter that
+        this Person adds 1 to, except for those that depend on its Notes
+        (num_notes and linked_persons), which only tasks.CountPerson counts."""
+        if self.is_expired:
+            return []
+        found = ''
+        if self.latest_found is not None:
+            found = self.latest_found and 'TRUE' or 'FALSE'
+
+        names = ['all',
+                 'original_domain=' + (self.original_domain or ''),
+                 'sex=' + (self.sex or ''),
+                 'home_country=' + (self.home_country or ''),
+                 'photo=' + (self.photo_url and 'present' or ''),
+                 'status=' + (self.latest_status or ''),
+                 'found=' + found]
+        if self.author_email:  # author e-mail address present?
+            names.append('author_email')
+        if self.author_phone:  # author phone number present?
+            names.append('author_phone')
+        return names
+
     def get_notes(self, filter_expired=True):
         """Returns a list of all the Notes on this Person, omitting expired
         Notes by default."""
@@ -389,30 +446,26 @@ class Person(Base):
                               self.get_linked_person_ids(note_limit))
 
     def get_all_linked_persons(self):
-        """Retrieves all Persons transitively linked to this Person."""
-        linked_person_ids = set([self.record_id])
-        linked_persons = []
-        # Maintain a list of ids of duplicate persons that have not
-        # yet been processed.
-        new_person_ids = set(self.get_linked_person_ids())
-        # Iteratively process all new_person_ids by retrieving linked
-        # duplicates and storing those not yet processed.
-        # Processed ids are stored in the linked_person_ids set, and
-        # their corresponding records are in the linked_persons list.
-        while new_person_ids:
-            linked_person_ids.update(new_person_ids)
-            new_persons = Person.get_all(self.repo, list(new_person_ids))
-            for person in new_persons:
-                new_person_ids.update(person.get_linked_person_ids())
-            linked_persons += new_persons
-            new_person_ids -= linked_person_ids
-        return linked_persons
-
-    def get_associated_emails(self):
+        """Retrieves all Persons transitively linked to this Person, using
+        the DuplicateCluster that it belongs to."""
+        cluster_id = DuplicateCluster.get_cluster_ids(
+            self.repo, [self.record_id])[self.record_id]
+        if not cluster_id:
+            return []
+        record_ids = [id for id in DuplicateCluster.get_member_ids(
+                          self.repo, [cluster_id])
+                      if id != self.record_id]
+        return [person for person in Person.get_all(self.repo, record_ids)
+                if not person.is_expired]
+
+    def get_associated_emails(self, notes=None):
         """Gets a set of all the e-mail addresses to notify when this record
-        is changed."""
-        email_addresses = set([note.author_email for note in self.get_notes()
-                               if note.author_email])
+        is changed.  'notes' can be given to avoid a query, if the Notes on
+        this Person have already been fetched; expired ones are skipped."""
+        if notes is None:
+            notes = self.get_notes()
+        email_addresses = set([note.author_email for note in notes
+                               if note.author_email and not note.is_expired])
         if self.author_email:
             email_addresses.add(self.author_email)
         return email_addresses
@@ -442,6 +495,16 @@ class Person(Base):
         """Updates the is_expired flags on this Person and related Notes to
         make them consistent with the effective_expiry_date() on this Person,
         and commits the changes to the datastore."""
+        entities = self.update_expiry_flags()
+        if entities:
+            put_and_count(entities)
+            # TODO(lschumacher): photos don't have expiration currently.
+
+    def update_expiry_flags(self, notes=None):
+        """Updates the is_expired flags like put_expiry_flags(), but returns
+        the changed entities instead of storing them.  'notes' can be given to
+        avoid a query, if all the Notes on this Person (including expired
+        ones) have already been fetched."""
         import utils
         now = utils.get_utcnow()
         expired = self.get_effective_expiry_date() <= now
@@ -463,13 +526,12 @@ class Person(Base):
             self.entry_date = now
 
             # All the Notes on the Person also expire or unexpire, to match.
-            notes = self.get_notes(filter_expired=False)
+            if notes is None:
+                notes = self.get_notes(filter_expired=False)
             for note in notes:
                 note.is_expired = expired
-
-            # Store these changes in the datastore.
-            db.put(notes + [self])
-            # TODO(lschumacher): photos don't have expiration currently.
+            return notes + [self]
+        return []
 
     def wipe_contents(self):
         """Sets all the content fields to None (leaving timestamps and the
@@ -483,29 +545,49 @@ class Person(Base):
         # Permanently delete all related Photos and Notes, but not self.
         self.delete_related_entities()
 
+        self.clear_contents()
+        self.put()  # Store the empty placeholder record.
+
+    def clear_contents(self):
+        """Sets all the content fields to None like wipe_contents(), without
+        storing anything."""
+        assert self.is_expired
         for name, property in self.properties().items():
             # Leave the repo, is_expired flag, and timestamps untouched.
             if name not in ['repo', 'is_expired', 'original_creation_date',
                             'source_date', 'entry_date', 'expiry_date']:
                 setattr(self, name, property.default)
-        self.put()  # Store the empty placeholder record.
 
     def delete_related_entities(self, delete_self=False):
         """Permanently delete all related Photos and Notes, and also self if
         delete_self is True."""
-        # Delete all related Notes.
-        notes = self.get_notes(filter_expired=False)
+        entities_to_delete = self.get_related_entities()
+        if delete_self:
+            entities_to_delete.append(self)
+            self.remove_from_indexes()
+        delete_and_count(entities_to_delete)
+
+    def get_related_entities(self, notes=None):
+        """Returns all the related Notes and the keys of the related Photos,
+        to be deleted.  'notes' can be given to avoid a query, if all the
+        Notes on this Person (including expired ones) have already been
+        fetched."""
+        if notes is None:
+            notes = self.get_notes(filter_expired=False)
         # Delete the locally stored Photos.  We use get_value_for_datastore to
         # get just the keys and prevent auto-fetching the Photo data.
         photo = Person.photo.get_value_for_datastore(self)
         note_photos = [Note.photo.get_value_for_datastore(n) for n in notes]
+        return filter(None, notes + [photo] + note_photos)
 
-        entities_to_delete = filter(None, notes + [photo] + note_photos)
-        if delete_self:
-            entities_to_delete.append(self)
-            if config.get('enable_fulltext_search'):
-                full_text_search.delete_record_from_index(self)
-        db.delete(entities_to_delete)
+    def remove_from_indexes(self):
+        """Removes this Person from the search indexes, before it's
+        permanently deleted."""
+        import full_text_search, indexing
+        indexing.remove_from_inverted_index(self)
+        indexing.update_token_stats([(self.repo, self.names_prefixes, [])])
+        if config.get('enable_fulltext_search'):
+            full_text_search.delete_record_from_index(self)
 
     def update_from_note(self, note):
         """Updates any necessary fields on the Person to reflect a new Note."""
@@ -523,30 +605,67 @@ class Person(Base):
                 self.latest_status = note.status
                 self.latest_status_source_date = note.source_date
 
-    def update_index(self, which_indexing):
+    def update_index(self, which_indexing, full_text=True, token_stats=False):
         #setup new indexing
         if 'new' in which_indexing:
-            indexing.update_index_properties(self)
-            if config.get('enable_fulltext_search'):
+            import full_text_search, indexing
+            indexing.update_index_properties(self, token_stats)
+            indexing.update_inverted_index(self)
+            if full_text and config.get('enable_fulltext_search'):
                 full_text_search.add_record_to_index(self)
         # setup old indexing
         if 'old' in which_indexing:
             prefix.update_prefix_properties(self)
 
+    @staticmethod
+    def update_indexes(persons, which_indexing):
+        """Calls update_index() on each of the given Persons, but adds them to
+        the full-text search index and updates the token statistics in
+        batches.  Returns a list of (record_id, error_message) pairs for the
+        Persons that couldn't be added to the full-text search index; these
+        errors are also logged."""
+        old_names_prefixes = [person.names_prefixes for person in persons]
+        for person in persons:
+            person.update_index(which_indexing, full_text=False,
+                                token_stats=False)
+        if 'new' in which_indexing:
+            import indexing
+            indexing.update_token_stats([
+                (person.repo, old, person.names_prefixes)
+                for person, old in zip(persons, old_names_prefixes)])
+        errors = []
+        if 'new' in which_indexing and config.get('enable_fulltext_search'):
+            import full_text_search
+            errors = full_text_search.add_records_to_index(persons)
+            for record_id, message in errors:
+                logging.error('Failed to add %s to the full-text index: %s' %
+                              (record_id, message))
+        return errors
+
     def update_latest_status(self, modified_note=None):
         """Scans all notes on this Person and fixes latest_status if needed."""
+        notes = self.get_notes()
+        if modified_note:
+            notes = [modified_note.note_record_id == note.record_id and
+                     modified_note or note for note in notes]
+        if self.set_latest_status_from_notes(notes):
+            self.put()
+
+    def set_latest_status_from_notes(self, notes):
+        """Sets latest_status from the last non-hidden Note with a status,
+        given all the unexpired Notes on this Person in order of source_date,
+        without storing anything.  Returns True if latest_status changed."""
         status = None
         status_source_date = None
-        for note in self.get_notes():
-            if modified_note and modified_note.note_record_id == note.record_id:
-                note = modified_note
+        for note in notes:
             if note.status and not note.hidden:
                 status = note.status
                 status_source_date = note.source_date
         if status != self.latest_status:
             self.latest_status = status
             self.latest_status_source_date = status_source_date
-            self.put()
+            return True
+        return False
 
 
 # Old indexing
@@ -608,6 +727,39 @@ class Note(Base):
         import utils
         return utils.strip_url_scheme(self.photo_url)
 
+    COUNTER_SCAN_NAME = 'note'
+
+    def get_count_names(self):
+        """Returns the names of the accumulators in the 'note' Counter that
+        this Note adds 1 to."""
+        if self.is_expired:
+            return []
+        author_made_contact = ''
+        if self.author_made_contact is not None:
+            author_made_contact = self.author_made_contact and 'TRUE' or 'FALSE'
+
+        names = ['all',
+                 'status=' + (self.status or ''),
+                 'original_domain=' + (self.original_domain or ''),
+                 'author_made_contact=' + author_made_contact]
+        if self.last_known_location:  # last known location specified?
+            names.append('last_known_location')
+        if self.author_email:  # author e-mail address present?
+            names.append('author_email')
+        if self.author_phone:  # author phone number present?
+            names.append('author_phone')
+        if self.linked_person_record_id:  # linked to another person?
+            names.append('linked_person')
+        # Review state, as shown in admin_review and api.Stats.  Notes that
+        # predate the 'reviewed' property have reviewed=None and aren't
+        # counted until tasks.AddReviewedProperty sets it.
+        if self.hidden is True:
+            names.append('hidden=TRUE')
+        elif self.hidden is False and self.reviewed is not None:
+            names.append('hidden=FALSE,reviewed=%s' %
+                          (self.reviewed and 'TRUE' or 'FALSE'))
+        return names
+
     @staticmethod
     def get_by_person_record_id(
         repo, person_record_id, filter_expired=True):
@@ -629,7 +781,49 @@ class Note(Base):
             query.with_cursor(query.cursor())  # Continue where fetch left off.
             notes = query.fetch(Note.FETCH_LIMIT)
 
+    @staticmethod
+    def get_by_person_record_ids(
+        repo, person_record_ids, filter_expired=True):
+        """Gets a dictionary that maps each of the given person_record_ids
+        to the list of Notes on that Person, ordered by source_date.  The
+        queries for all the Persons are started at once and run in parallel,
+        so this takes about as long as a single get_by_person_record_id()."""
+        results = [(person_record_id, Note.all_in_repo(
+                        repo, filter_expired=filter_expired
+                    ).filter('person_record_id =', person_record_id
+                    ).order('source_date'
+                    ).run(batch_size=Note.FETCH_LIMIT))
+                   for person_record_id in person_record_ids]
+        return dict((person_record_id, list(notes))
+                    for person_record_id, notes in results)
+
+    @staticmethod
+    def get_by_person_record_id_range(
+        repo, first_record_id, last_record_id, filter_expired=True):
+        """Gets a dictionary that maps each person_record_id from
+        first_record_id to last_record_id (inclusive) to the list of Notes on
+        that Person, using a single query.  This is much cheaper than calling
+        get_by_person_record_id() for each of a batch of Persons, if their
+        record IDs are in a narrow range (e.g. a batch of Persons in key
+        order)."""
+        query = Note.all_in_repo(repo, filter_expired=filter_expired
+            ).filter('person_record_id >=', first_record_id
+            ).filter('person_record_id <=', last_record_id
+            ).order('person_record_id')
+        notes_by_person = {}
+        notes = query.fetch(Note.FETCH_LIMIT)
+        while notes:
+            for note in notes:
+                notes_by_person.setdefault(
+                    note.person_record_id, []).append(note)
+            query.with_cursor(query.cursor())  # Continue where fetch left off.
+            notes = query.fetch(Note.FETCH_LIMIT)
+        return notes_by_person
+
 class NoteWithBadWords(Note):
+    # These are a separate kind, which isn't counted.
+    COUNTER_SCAN_NAME = None
+
     # Spam score given by SpamDetector
     spam_score = db.FloatProperty(default=0)
     # True is the note is confirmed by its author through email
@@ -639,6 +833,188 @@ class NoteWithBadWords(Note):
     # delete the notes with bad words, even when they are confirmed.
     confirmed_copy_id = db.StringProperty(default='')
 
+class DuplicateCluster(db.Model):
+    """The cluster of Persons that a Person belongs to, where two Persons are
+    in the same cluster if they are transitively linked as duplicates by
+    unhidden, unexpired Notes.  Each cluster is named by the smallest record
+    ID among its members (at the time the cluster was formed), so looking up
+    a cluster is a single query (see Person.get_all_linked_persons).
+    Persons with no duplicates have no DuplicateCluster.  All the
+    DuplicateClusters in a repository are in one entity group, whose parent
+    is the Repo key, so that clusters are read with strongly consistent
+    ancestor queries and changed in transactions.  Key name: repo + ':' +
+    person_record_id.
+
+    Writing a Person or Note that adds or removes a link or a member leaves
+    PendingClusterUpdates (see put_and_count), and tasks.UpdatePendingClusters
+    brings the affected clusters up to date.  tasks.UpdateDuplicateClusters
+    builds them for existing records."""
+    repo = db.StringProperty(required=True)
+    cluster_id = db.StringProperty(required=True)
+
+    @property
+    def person_record_id(self):
+        return self.key().name().split(':', 1)[1]
+
+    @staticmethod
+    def get_parent_key(repo):
+        return db.Key.from_path(Repo.kind(), repo)
+
+    @staticmethod
+    def create(repo, record_id, cluster_id):
+        return DuplicateCluster(
+            parent=DuplicateCluster.get_parent_key(repo),
+            key_name=repo + ':' + record_id, repo=repo, cluster_id=cluster_id)
+
+    @staticmethod
+    def is_link(count_names):
+        """Returns True if a Note with the given count names (see
+        Note.get_count_names) links two Persons as duplicates."""
+        return ('linked_person' in count_names and
+                'hidden=TRUE' not in count_names)
+
+    @staticmethod
+    def get_cluster_ids(repo, record_ids):
+        """Gets a dictionary mapping each of the given record IDs to the ID
+        of the cluster that the Person belongs to, or None if it has no
+        duplicates."""
+        clusters = DuplicateCluster.get_by_key_name(
+            [repo + ':' + id for id in record_ids],
+            parent=DuplicateCluster.get_parent_key(repo))
+        return dict((id, cluster and cluster.cluster_id)
+                    for id, cluster in zip(record_ids, clusters))
+
+    @staticmethod
+    def get_member_ids(repo, cluster_ids):
+        """Gets the record IDs of all the Persons in the given clusters."""
+        member_ids = set()
+        for cluster_id in cluster_ids:
+            query = DuplicateCluster.all(keys_only=True).ancestor(
+                DuplicateCluster.get_parent_key(repo)
+            ).filter('cluster_id =', cluster_id)
+            member_ids.update(key.name().split(':', 1)[1] for key in query)
+        return member_ids
+
+    @staticmethod
+    def get_links(repo, record_ids):
+        """Gets the duplicate links (as pairs of record IDs) from Notes on the
+        given Persons, or on other Persons to them, running the queries for
+        all the Persons in parallel."""
+        links = []
+        for notes in Note.get_by_person_record_ids(repo, record_ids).values():
+            links += [(note.person_record_id, note.linked_person_record_id)
+                      for note in notes
+                      if DuplicateCluster.is_link(note.get_count_names())]
+        queries = [Note.all_in_repo(repo).filter('linked_person_record_id =', id
+                       ).run(batch_size=Note.FETCH_LIMIT)
+                   for id in record_ids]
+        for notes in queries:
+            links += [(note.person_record_id, note.linked_person_record_id)
+                      for note in notes
+                      if DuplicateCluster.is_link(note.get_count_names())]
+        return links
+
+    @staticmethod
+    def merge(repo, links):
+        """Merges the clusters of the Persons joined by the given links."""
+        if not links:
+            return
+        record_ids = list(set(id for link in links for id in link))
+        existing_ids = set(person.record_id for person in
+                           Person.get_all(repo, record_ids)
+                           if not person.is_expired)
+        record_ids = [id for id in record_ids if id in existing_ids]
+
+        def merge_in_transaction():
+            cluster_ids = DuplicateCluster.get_cluster_ids(repo, record_ids)
+
+            # Union-find over the cluster IDs (a Person with no duplicates is
+            # its own cluster), keeping the smallest ID as the root.
+            parents = {}
+            def find(cluster_id):
+                while parents.get(cluster_id, cluster_id) != cluster_id:
+                    cluster_id = parents[cluster_id]
+                return cluster_id
+            merged = set()
+            for id1, id2 in links:
+                if id1 in existing_ids and id2 in existing_ids:
+                    root1 = find(cluster_ids[id1] or id1)
+                    root2 = find(cluster_ids[id2] or id2)
+                    if root1 != root2:
+                        parents[max(root1, root2)] = min(root1, root2)
+                        merged.update([root1, root2])
+
+            # Move the members of each cluster that was merged into another
+            # one, and add the Persons that weren't in a cluster yet.
+            new_cluster_ids = {}
+            for cluster_id in parents:
+                for id in DuplicateCluster.get_member_ids(repo, [cluster_id]):
+                    new_cluster_ids[id] = find(cluster_id)
+            for id in record_ids:
+                cluster_id = cluster_ids[id] or id
+                if cluster_id in merged and cluster_ids[id] != find(cluster_id):
+                    new_cluster_ids[id] = find(cluster_id)
+            db.put([DuplicateCluster.create(repo, id, cluster_id)
+                    for id, cluster_id in new_cluster_ids.items()])
+
+        if record_ids:
+            db.run_in_transaction(merge_in_transaction)
+
+    @staticmethod
+    def split(repo, cluster_ids):
+        """Recomputes the given clusters from the links among their members,
+        after a link or a member has gone away."""
+        if not cluster_ids:
+            return
+
+        def split_in_transaction(member_ids, links):
+            # Start over if the clusters have changed since we read them.
+            if DuplicateCluster.get_member_ids(repo, cluster_ids) != member_ids:
+                return False
+            parents = {}
+            def find(id):
+                while parents.get(id, id) != id:
+                    id = parents[id]
+                return id
+            for id1, id2 in links:
+                root1, root2 = find(id1), find(id2)
+                if root1 != root2:
+                    parents[max(root1, root2)] = min(root1, root2)
+            new_cluster_ids = dict((id, find(id))
+                                   for link in links for id in link)
+            db.delete([db.Key.from_path(
+                           DuplicateCluster.kind(), repo + ':' + id,
+                           parent=DuplicateCluster.get_parent_key(repo))
+                       for id in member_ids if id not in new_cluster_ids])
+            db.put([DuplicateCluster.create(repo, id, cluster_id)
+                    for id, cluster_id in new_cluster_ids.items()])
+            return True
+
+        while True:
+            member_ids = DuplicateCluster.get_member_ids(repo, cluster_ids)
+            existing_ids = set(person.record_id for person in
+                               Person.get_all(repo, list(member_ids))
+                               if not person.is_expired)
+            links = []
+            for notes in Note.get_by_person_record_ids(
+                repo, list(existing_ids)).values():
+                links += [(note.person_record_id, note.linked_person_record_id)
+                          for note in notes
+                          if note.linked_person_record_id in existing_ids and
+                          DuplicateCluster.is_link(note.get_count_names())]
+            if db.run_in_transaction(split_in_transaction, member_ids, links):
+                return
+
+    @staticmethod
+    def update(repo, record_ids):
+        """Brings the clusters of the given Persons up to date with the
+        Persons that exist and the links to and from them."""
+        cluster_ids = DuplicateCluster.get_cluster_ids(repo, record_ids)
+        DuplicateCluster.split(repo, set(filter(None, cluster_ids.values())))
+        DuplicateCluster.merge(
+            repo, DuplicateCluster.get_links(repo, record_ids))
+
+
 class Photo(db.Model):
     """An uploaded image file.  Key name: repo + ':' + photo_id."""
 
@@ -748,6 +1124,119 @@ class ApiKeyManagementLog(db.Model):
     def authorization(self):
         return Authorization.get(self.repo, self.api_key)
 
+def load_stored_count_names(entities):
+    """Fills in stored_count_names for any counted entities whose stored
+    state isn't known yet, with a single batch get."""
+    unknown = [entity for entity in entities
+               if getattr(entity, 'COUNTER_SCAN_NAME', None) and
+               entity.stored_count_names is None]
+    if unknown:
+        stored_entities = db.get([entity.key() for entity in unknown])
+        for entity, stored in zip(unknown, stored_entities):
+            entity.stored_count_names = (
+                stored and stored.stored_count_names or [])
+
+
+def apply_count_changes(entities, deleted=False):
+    """Adds the changes in the count names of the given entities, which
+    have just been stored (or deleted, if 'deleted' is True), to the live
+    counts in CounterShards."""
+    deltas_by_scan = {}  # (repo, scan_name) -> {count_name: delta}
+    for entity in entities:
+        if not getattr(entity, 'COUNTER_SCAN_NAME', None):
+            continue
+        old_names = entity.stored_count_names or []
+        new_names = [] if deleted else entity.get_count_names()
+        if old_names != new_names:
+            deltas = deltas_by_scan.setdefault(
+                (entity.repo, entity.COUNTER_SCAN_NAME), {})
+            for name in old_names:
+                deltas[name] = deltas.get(name, 0) - 1
+            for name in new_names:
+                deltas[name] = deltas.get(name, 0) + 1
+        entity.stored_count_names = new_names
+    for (repo, scan_name), deltas in deltas_by_scan.items():
+        CounterShard.apply_deltas(repo, scan_name, deltas)
+
+
+def make_pending_updates(entities, deleted=False):
+    """Makes the PendingStatusUpdates and PendingClusterUpdates for storing
+    (or deleting, if 'deleted' is True) the given entities.  This must be
+    called before apply_count_changes(), which updates their
+    stored_count_names."""
+    return (PendingStatusUpdate.make_updates(entities, deleted) +
+            PendingClusterUpdate.make_updates(entities, deleted))
+
+
+def put_and_count(entities):
+    """Stores entities like db.put(), and updates the live counts and makes
+    the PendingStatusUpdates and PendingClusterUpdates for any Persons and
+    Notes among them.  Use this instead of db.put() for Persons and Notes,
+    so that the counts on the dashboard and in api.Stats don't have to wait
+    for the next counting scan."""
+    return put_and_count_async(entities).get_result()
+
+
+def put_and_count_async(entities):
+    """Starts storing entities like put_and_count(), and returns an object
+    whose get_result() method waits for the put to finish, updates the live
+    counts, and returns the keys.  This lets the
+    caller keep several puts in flight at once."""
+    entity_list = entities if isinstance(entities, list) else [entities]
+    if not entity_list:
+        return AsyncPutAndCount(entities, entity_list, None)
+    load_stored_count_names(entity_list)
+    # Store the pending updates in the same batch as the entities.
+    updates = make_pending_updates(entity_list)
+    return AsyncPutAndCount(
+        entities, entity_list, db.put_async(entity_list + updates))
+
+
+class AsyncPutAndCount(object):
+    """A put started by put_and_count_async()."""
+
+    def __init__(self, entities, entity_list, rpc):
+        self.entities = entities
+        self.entity_list = entity_list
+        self.rpc = rpc
+
+    def get_result(self):
+        keys = self.get_keys()
+        self.update_counts()
+        return keys
+
+    def get_keys(self):
+        """Waits for the put to finish and returns the keys, without updating
+        the counts.  Errors raised here come from the put alone, so a caller
+        that retries the put on them should call update_counts() only once
+        the put has succeeded."""
+        if not self.rpc:  # There was nothing to put.
+            return []
+        keys = self.rpc.get_result()[:len(self.entity_list)]
+        return isinstance(self.entities, list) and keys or keys[0]
+
+    def update_counts(self):
+        """Updates the live counts for the stored entities.  Call this once,
+        after get_keys() has returned."""
+        if self.rpc:
+            apply_count_changes(self.entity_list)
+
+
+def delete_and_count(entities):
+    """Deletes entities like db.delete(), and updates the live counts and
+    makes the PendingStatusUpdates and PendingClusterUpdates for any Persons
+    and Notes among them."""
+    entity_list = entities if isinstance(entities, list) else [entities]
+    if not entity_list:
+        return
+    load_stored_count_names(entity_list)
+    db.delete(entities)
+    updates = make_pending_updates(entity_list, deleted=True)
+    if updates:
+        db.put(updates)
+    apply_count_changes(entity_list, deleted=True)
+
+
 def encode_count_name(count_name):
     """Encode a name to printable ASCII characters so it can be safely
     used as an attribute name for the datastore."""
@@ -823,6 +1312,10 @@ class Counter(db.Expando):
     scan_name = db.StringProperty()
     repo = db.StringProperty()
     last_key = db.StringProperty(default='')  # if non-empty, count is partial
+    # The CounterShard generation that was started when this scan started.
+    # The changes in this and later generations are live changes on top of
+    # this scan's counts (see CounterShard).
+    generation = db.IntegerProperty(default=0)
 
     # Each Counter also has a dynamic property for each accumulator; all such
     # properties are named "count_" followed by a count_name.  The count_name
@@ -838,21 +1331,25 @@ class Counter(db.Expando):
 
     @classmethod
     def get_count(cls, repo, name):
-        """Gets the latest finished count for the given repository and name.
+        """Gets the live count for the given repository and name.
         'name' should be in the format scan_name + '.' + count_name."""
         scan_name, count_name = name.split('.')
         count_name = encode_count_name(count_name)
         return cls.get_all_counts(repo, scan_name).get(count_name, 0)
 
+    # Number of seconds to cache the live counts in memcache.
+    LIVE_COUNTS_CACHE_SECONDS = 10
+
     @classmethod
     def get_all_counts(cls, repo, scan_name):
-        """Gets a dictionary of all the counts for the last completed scan
-        for the given repository and scan name."""
+        """Gets a dictionary of all the live counts for the given repository
+        and scan name: the counts from the last completed scan, plus the
+        changes since then (see CounterShard)."""
         counter_key = repo + ':' + scan_name
 
         # Get the counts from memcache, loading from datastore if necessary.
         counter_dict = memcache.get(counter_key)
-        if not counter_dict:
+        if counter_dict is None:
             try:
                 # Get the latest completed counter with this scan_name.
                 counter = cls.all().filter('repo =', repo
@@ -867,11 +1364,14 @@ class Counter(db.Expando):
 
             counter_dict = {}
             if counter:
-                # Cache the counter's contents in memcache for one minute.
                 counter_dict = dict((name[6:], getattr(counter, name))
                                     for name in counter.dynamic_properties()
                                     if name.startswith('count_'))
-                memcache.set(counter_key, counter_dict, 60)
+            for name, delta in CounterShard.get_deltas(
+                repo, scan_name, counter and counter.generation or 0).items():
+                counter_dict[name] = counter_dict.get(name, 0) + delta
+            memcache.set(counter_key, counter_dict,
+                         cls.LIVE_COUNTS_CACHE_SECONDS)
 
         # Return the dictionary of counts for this scan.
         return counter_dict
@@ -891,10 +1391,270 @@ class Counter(db.Expando):
                           ).filter('scan_name =', scan_name
                           ).order('-timestamp').get()
         if not counter or not counter.last_key:
-            counter = Counter(repo=repo, scan_name=scan_name)
+            counter = Counter(
+                repo=repo, scan_name=scan_name,
+                generation=CounterShard.start_generation(repo, scan_name))
         return counter
 
 
+class CounterShard(db.Expando):
+    """Changes to the Counter accumulators since the last completed scan,
+    applied as Persons and Notes are written (see put_and_count), so that the
+    counts are live without rescanning the repository.  The changes are
+    spread over NUM_SHARDS entities, so that concurrent writes rarely contend
+    for the same entity.  Key name: repo + ':' + scan_name + ':' + generation
+    + ':' + shard number (or just repo + ':' + scan_name + ':' + shard number
+    for generation 0).
+
+    Each scan starts a new generation, and changes made while it runs go
+    into that generation.  A completed scan's counts replace only the
+    changes in earlier generations, so no change made during the scan is
+    lost; a change to an entity that the scan hadn't reached yet is counted
+    by both, until the next scan.  The current generation and the first
+    generation that hasn't been discarded are kept in a CounterShard with
+    the key name repo + ':' + scan_name + ':generation'.
+
+    Like Counter, each CounterShard has a dynamic property named 'count_' +
+    encode_count_name(count_name) for each accumulator, holding the net
+    change to the accumulator (which may be negative)."""
+    NUM_SHARDS = 20
+
+    repo = db.StringProperty()
+    scan_name = db.StringProperty()
+
+    @classmethod
+    def get_key_names(cls, repo, scan_name, generation=0):
+        if generation:
+            return ['%s:%s:%d:%d' % (repo, scan_name, generation, shard)
+                    for shard in range(cls.NUM_SHARDS)]
+        return ['%s:%s:%d' % (repo, scan_name, shard)
+                for shard in range(cls.NUM_SHARDS)]
+
+    @classmethod
+    def get_generation_entity(cls, repo, scan_name):
+        key_name = '%s:%s:generation' % (repo, scan_name)
+        return (cls.get_by_key_name(key_name) or
+                cls(key_name=key_name, repo=repo, scan_name=scan_name,
+                    generation=0, first_generation=0))
+
+    @classmethod
+    def get_generation(cls, repo, scan_name):
+        """Gets the generation that changes are currently applied to."""
+        memcache_key = '%s:%s:generation' % (repo, scan_name)
+        generation = memcache.get(memcache_key)
+        if generation is None:
+            generation = cls.get_generation_entity(repo, scan_name).generation
+            memcache.set(memcache_key, generation)
+        return generation
+
+    @classmethod
+    def start_generation(cls, repo, scan_name):
+        """Starts a new generation for the changes, when a scan starts, and
+        returns its number."""
+        def increment():
+            entity = cls.get_generation_entity(repo, scan_name)
+            entity.generation += 1
+            entity.put()
+            return entity.generation
+        generation = db.run_in_transaction(increment)
+        memcache.set('%s:%s:generation' % (repo, scan_name), generation)
+        return generation
+
+    @classmethod
+    def apply_deltas(cls, repo, scan_name, deltas):
+        """Adds the given changes ({count_name: delta}) to a random shard in
+        the current generation."""
+        deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+        if not deltas:
+            return
+        key_name = random.choice(cls.get_key_names(
+            repo, scan_name, cls.get_generation(repo, scan_name)))
+        def increment():
+            shard = (cls.get_by_key_name(key_name) or
+                     cls(key_name=key_name, repo=repo, scan_name=scan_name))
+            for name, delta in deltas.items():
+                prop_name = 'count_' + encode_count_name(name)
+                setattr(shard, prop_name, getattr(shard, prop_name, 0) + delta)
+            shard.put()
+        db.run_in_transaction(increment)
+
+    @classmethod
+    def get_deltas(cls, repo, scan_name, first_generation=0):
+        """Gets the net changes in first_generation and later generations,
+        summed over all shards, as a dictionary keyed by encoded count name
+        like the one from get_all_counts()."""
+        key_names = []
+        for generation in range(first_generation,
+                                cls.get_generation(repo, scan_name) + 1):
+            key_names += cls.get_key_names(repo, scan_name, generation)
+        deltas = {}
+        for shard in cls.get_by_key_name(key_names):
+            for name in (shard and shard.dynamic_properties() or []):
+                if name.startswith('count_'):
+                    deltas[name[6:]] = (deltas.get(name[6:], 0) +
+                                        getattr(shard, name))
+        return deltas
+
+    @classmethod
+    def discard_before(cls, repo, scan_name, generation):
+        """Deletes the changes in the generations before the given one, when
+        a scan that started that generation has counted them."""
+        entity = cls.get_generation_entity(repo, scan_name)
+        key_names = []
+        for old_generation in range(entity.first_generation, generation):
+            key_names += cls.get_key_names(repo, scan_name, old_generation)
+        db.delete([db.Key.from_path(cls.kind(), key_name)
+                   for key_name in key_names])
+        def update():
+            entity = cls.get_generation_entity(repo, scan_name)
+            # Changes are still being applied to the current generation.
+            entity.first_generation = max(entity.first_generation,
+                                          min(generation, entity.generation))
+            entity.put()
+        db.run_in_transaction(update)
+        memcache.delete(repo + ':' + scan_name)
+
+    @classmethod
+    def reset(cls, repo, scan_name):
+        """Clears all the changes for a scan."""
+        cls.discard_before(
+            repo, scan_name, cls.get_generation(repo, scan_name) + 1)
+
+
+class PendingStatusUpdate(db.Model):
+    """A Person whose latest_status may be out of date, because a Note on it
+    with a status was written, hidden, unhidden, expired or deleted.  These
+    are made as Notes are written (see put_and_count), and processed by
+    tasks.UpdatePendingStatus, so that latest_status is only recomputed for
+    the Persons whose Notes changed.  Key name: repo + ':' + person_record_id.
+    """
+    repo = db.StringProperty(required=True)
+    timestamp = db.DateTimeProperty(auto_now=True)
+
+    @property
+    def person_record_id(self):
+        return self.key().name().split(':', 1)[1]
+
+    @staticmethod
+    def get_status(count_names):
+        """Gets the status that a Note with the given count names (see
+        Note.get_count_names) contributes to its Person's latest_status, or
+        None if it is expired, hidden or has no status."""
+        if 'hidden=TRUE' not in count_names:
+            for name in count_names:
+                if name.startswith('status=') and name != 'status=':
+                    return name[7:]
+
+    @staticmethod
+    def make_updates(entities, deleted=False):
+        """Makes PendingStatusUpdates for the Persons whose latest_status may
+        be affected by storing (or deleting, if 'deleted' is True) the given
+        entities.  This must be called before apply_count_changes(), which
+        updates their stored_count_names."""
+        # Persons that are expiring or being deleted don't need a status.
+        removed_person_keys = set(
+            entity.key().name() for entity in entities
+            if getattr(entity, 'COUNTER_SCAN_NAME', None) == 'person' and
+            (deleted or not entity.get_count_names()))
+        updates = {}
+        for entity in entities:
+            if getattr(entity, 'COUNTER_SCAN_NAME', None) != 'note':
+                continue
+            old_names = entity.stored_count_names or []
+            new_names = [] if deleted else entity.get_count_names()
+            key_name = entity.repo + ':' + entity.person_record_id
+            if (key_name not in removed_person_keys and
+                PendingStatusUpdate.get_status(old_names) !=
+                PendingStatusUpdate.get_status(new_names)):
+                updates[key_name] = PendingStatusUpdate(
+                    key_name=key_name, repo=entity.repo)
+        return updates.values()
+
+
+class PendingClusterUpdate(db.Model):
+    """A Person whose DuplicateCluster may be out of date, because the Person
+    appeared or disappeared, or a Note linking it to another Person was
+    written, hidden, unhidden, expired or deleted.  These are made as Persons
+    and Notes are written (see put_and_count), and processed by
+    tasks.UpdatePendingClusters, so that the queries and transactions for
+    updating clusters happen outside the requests that write the records.
+    Key name: repo + ':' + person_record_id."""
+    repo = db.StringProperty(required=True)
+    timestamp = db.DateTimeProperty(auto_now=True)
+
+    @property
+    def person_record_id(self):
+        return self.key().name().split(':', 1)[1]
+
+    @staticmethod
+    def make_updates(entities, deleted=False):
+        """Makes PendingClusterUpdates for the Persons whose clusters may be
+        affected by storing (or deleting, if 'deleted' is True) the given
+        entities.  This must be called before apply_count_changes(), which
+        updates their stored_count_names."""
+        updates = {}
+        for entity in entities:
+            scan_name = getattr(entity, 'COUNTER_SCAN_NAME', None)
+            if not scan_name:
+                continue
+            old_names = entity.stored_count_names or []
+            new_names = [] if deleted else entity.get_count_names()
+            record_ids = []
+            if scan_name == 'person':
+                if bool(old_names) != bool(new_names):
+                    record_ids = [entity.record_id]
+            elif scan_name == 'note':
+                if (DuplicateCluster.is_link(old_names) !=
+                    DuplicateCluster.is_link(new_names)):
+                    record_ids = [entity.person_record_id,
+                                  entity.linked_person_record_id]
+            for record_id in record_ids:
+                key_name = entity.repo + ':' + record_id
+                updates[key_name] = PendingClusterUpdate(
+                    key_name=key_name, repo=entity.repo)
+        return updates.values()
+
+
+class ImportJob(db.Model):
+    """A CSV import through api.Import that didn't finish within the request,
+    and is continued by api.ResumeImport tasks.  The uploaded file is stored
+    in ImportJobChunks, and records_done is the checkpoint: the number of
+    records from the file that have already been imported."""
+    repo = db.StringProperty(required=True)
+    source_domain = db.StringProperty(required=True)
+    format = db.StringProperty(required=True)  # 'persons' or 'notes'
+    is_excel = db.BooleanProperty(default=False)
+    believed_dead_permission = db.BooleanProperty(default=False)
+    records_done = db.IntegerProperty(default=0)
+    # Notes held back until the end of the file (see api.import_batches), as
+    # a JSON list of records.
+    held_notes = db.TextProperty()
+    created = db.DateTimeProperty(auto_now_add=True)
+
+    def save_content(self, chunks):
+        """Stores the uploaded file, given as an iterable of strings.  Each
+        piece is written separately, so the whole file is never in memory."""
+        for i, chunk in enumerate(chunks):
+            ImportJobChunk(parent=self, key_name='%08d' % i,
+                           data=db.Blob(chunk)).put()
+
+    def get_content_chunks(self):
+        """Generates the pieces of the uploaded file in order."""
+        query = ImportJobChunk.all().ancestor(self).order('__key__')
+        for chunk in query.run(batch_size=2):
+            yield chunk.data
+
+    def delete_with_content(self):
+        db.delete(list(ImportJobChunk.all(keys_only=True).ancestor(self)) +
+                  [self.key()])
+
+
+class ImportJobChunk(db.Model):
+    """A piece of the file uploaded for an ImportJob.  Parent: the ImportJob.
+    Key name: the position of the piece, as an 8-digit number."""
+    data = db.BlobProperty()
+
+
 class Subscription(db.Model):
     """Subscription to notifications when a note is added to a person record"""
     repo = db.StringProperty(required=True)
@@ -984,11 +1744,37 @@ class SiteMapPingStatus(db.Model):
 
 
 class UniqueId(db.Model):
-    """This entity is used just to generate unique numeric IDs."""
+    """This kind is used just to generate unique numeric IDs.  No entities are
+    stored: IDs are reserved from the datastore's ID space for this kind in
+    blocks, and handed out from a pool in each process, so most calls to
+    create_id() don't need any datastore operation at all."""
+
+    # Number of IDs to reserve at a time when the pool runs out.
+    BLOCK_SIZE = 100
+
+    # The pool of reserved IDs is the range [next_id, end_id).
+    next_id = 0
+    end_id = 0
+
+    @staticmethod
+    def reserve(count):
+        """Ensures that at least 'count' IDs are in this process's pool,
+        reserving more from the datastore in a single call if necessary."""
+        if UniqueId.end_id - UniqueId.next_id < count:
+            start, end = db.allocate_ids(
+                db.Key.from_path(UniqueId.kind(), 1),
+                max(count, UniqueId.BLOCK_SIZE))
+            if start != UniqueId.end_id:
+                # The new range isn't contiguous with the pool, so the
+                # leftover IDs are dropped (which is fine, as IDs need only
+                # be unique, not consecutive).
+                UniqueId.next_id = start
+            UniqueId.end_id = end + 1
+
     @staticmethod
     def create_id():
         """Gets an integer ID that is guaranteed to be different from any ID
-        previously returned by this static method."""
-        unique_id = UniqueId()
-        unique_id.put()
-        return unique_id.key().id()
+        previously returned by this static method, in any process."""
+        UniqueId.reserve(1)
+        UniqueId.next_id += 1
+        return UniqueId.next_id - 1
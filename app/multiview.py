@@ -121,5 +121,5 @@ class Handler(BaseHandler):
                 subscribe.send_notifications(self, person, person_notes, False)
                 notes += person_notes
             # Write all notes to store
-            db.put(notes)
+            put_and_count(notes)
         self.redirect('/view', id=self.params.id1)
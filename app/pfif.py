@@ -69,10 +69,23 @@ RENAMED_FIELDS = {
 
 DESCRIPTION_FIELD_LABEL = 'description:'
 
+# parse_file_in_batches reads PFIF documents in pieces of PARSE_CHUNK_SIZE
+# bytes, and generates batches of up to PARSE_BATCH_SIZE records.
+PARSE_CHUNK_SIZE = 64*1024
+PARSE_BATCH_SIZE = 100
+
+# XML may only contain the following characters (even after entity
+# references are expanded).  See: http://www.w3.org/TR/REC-xml/#charsets
+XML_INVALID_CHARS_RE = re.compile(
+    ur'''[^\x09\x0a\x0d\x20-\ud7ff\ue000-\ufffd]''')
+# Matches any character that xml_escape would remove or escape.
+XML_SPECIAL_CHARS_RE = re.compile(
+    ur'''[^\x09\x0a\x0d\x20-\ud7ff\ue000-\ufffd]|[&<>]''')
+
 def xml_escape(s):
-    # XML may only contain the following characters (even after entity
-    # references are expanded).  See: http://www.w3.org/TR/REC-xml/#charsets
-    s = re.sub(ur'''[^\x09\x0a\x0d\x20-\ud7ff\ue000-\ufffd]''', '', s)
+    if not XML_SPECIAL_CHARS_RE.search(s):
+        return s  # Most values need no changes, so check that first.
+    s = XML_INVALID_CHARS_RE.sub('', s)
     return s.replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
 
 def convert_description_to_other(desc):
@@ -118,6 +131,12 @@ class PfifVersion:
         self.mandatory_fields = mandatory_fields
         # A dict mapping field names to serializer functions.
         self.serializers = serializers
+        # A dict mapping each record type to a list of (field, start tag,
+        # end tag) for its fields, so the tags aren't formatted per record.
+        self.field_tags = dict(
+            (type, [(field, '<pfif:%s>' % field, '</pfif:%s>\n' % field)
+                    for field in type_fields])
+            for type, type_fields in fields.items())
 
     def check_tag(self, (ns, local), parent=None):
         """Given a namespace-qualified tag and its parent, returns the PFIF
@@ -127,27 +146,47 @@ class PfifVersion:
             if not parent or local in self.fields[parent]:
                 return local
 
+    def append_fields(self, parts, type, record, indent=''):
+        """Appends the PFIF tags for a record's fields to the list parts."""
+        mandatory_fields = self.mandatory_fields[type]
+        for field, start_tag, end_tag in self.field_tags[type]:
+            if record.get(field) or field in mandatory_fields:
+                escaped_value = xml_escape(record.get(field, ''))
+                parts += [indent, start_tag, escaped_value.encode('utf-8'),
+                          end_tag]
+
+    def append_person(self, parts, person, notes=[], indent=''):
+        """Appends the PFIF for a person record and a list of its note
+        records to the list parts."""
+        parts += [indent, '<pfif:person>\n']
+        self.append_fields(parts, 'person', person, indent + '  ')
+        for note in notes:
+            self.append_note(parts, note, indent + '  ')
+        parts += [indent, '</pfif:person>\n']
+
+    def append_note(self, parts, note, indent=''):
+        """Appends the PFIF for a note record to the list parts."""
+        parts += [indent, '<pfif:note>\n']
+        self.append_fields(parts, 'note', note, indent + '  ')
+        parts += [indent, '</pfif:note>\n']
+
     def write_fields(self, file, type, record, indent=''):
         """Writes PFIF tags for a record's fields."""
-        for field in self.fields[type]:
-            if record.get(field) or field in self.mandatory_fields[type]:
-                escaped_value = xml_escape(record.get(field, ''))
-                file.write(indent + '<pfif:%s>%s</pfif:%s>\n' %
-                           (field, escaped_value.encode('utf-8'), field))
+        parts = []
+        self.append_fields(parts, type, record, indent)
+        file.write(''.join(parts))
 
     def write_person(self, file, person, notes=[], indent=''):
         """Writes PFIF for a person record and a list of its note records."""
-        file.write(indent + '<pfif:person>\n')
-        self.write_fields(file, 'person', person, indent + '  ')
-        for note in notes:
-            self.write_note(file, note, indent + '  ')
-        file.write(indent + '</pfif:person>\n')
+        parts = []
+        self.append_person(parts, person, notes, indent)
+        file.write(''.join(parts))
 
     def write_note(self, file, note, indent=''):
         """Writes PFIF for a note record."""
-        file.write(indent + '<pfif:note>\n')
-        self.write_fields(file, 'note', note, indent + '  ')
-        file.write(indent + '</pfif:note>\n')
+        parts = []
+        self.append_note(parts, note, indent)
+        file.write(''.join(parts))
 
     def write_file(self, file, persons, get_notes_for_person=lambda p: []):
         """Takes a list of person records and a function that gets the list
@@ -416,12 +455,26 @@ PFIF_DEFAULT_VERSION = '1.4'
 
 assert PFIF_DEFAULT_VERSION in PFIF_VERSIONS
 
+# The namespaces of all the PFIF versions.
+PFIF_NAMESPACES = set(version.ns for version in PFIF_VERSIONS.values())
+
+# A dict mapping (namespace, local name, parent type) to the field name for
+# every field tag in every PFIF version, so that check_pfif_tag can look up
+# a tag instead of trying each version in turn.
+PFIF_FIELD_TAGS = dict(
+    ((version.ns, field, type), field)
+    for version in PFIF_VERSIONS.values()
+    for type, fields in version.fields.items()
+    for field in fields)
+
 def check_pfif_tag(name, parent=None):
-    """Recognizes a PFIF XML tag from any version of PFIF."""
-    return PFIF_1_4.check_tag(name, parent) or \
-        PFIF_1_3.check_tag(name, parent) or \
-        PFIF_1_2.check_tag(name, parent) or \
-        PFIF_1_1.check_tag(name, parent)
+    """Recognizes a PFIF XML tag from any version of PFIF.  Given a
+    namespace-qualified tag and its parent, returns the PFIF type or field
+    name if the tag is valid, or None if the tag is not recognized."""
+    ns, local = name
+    if not parent:
+        return ns in PFIF_NAMESPACES and local or None
+    return PFIF_FIELD_TAGS.get((ns, local, parent))
 
 
 class Handler(xml.sax.handler.ContentHandler):
@@ -432,33 +485,49 @@ class Handler(xml.sax.handler.ContentHandler):
         self.tags = []
         self.person = {}
         self.note = {}
+        self.in_person = False
         self.enclosed_notes = []  # Notes enclosed by the current <person>.
+        # Completed records.  Notes enclosed by a <person> are added when the
+        # person ends, once they have its person_record_id.
         self.person_records = []
         self.note_records = []
 
     def startElementNS(self, tag, qname, attrs):
-        self.tags.append(tag)
-        if check_pfif_tag(tag) == 'person':
+        # Each tag on the stack is kept with its PFIF type and, if it's in a
+        # <person> or <note>, its field name, so each is looked up only once.
+        type = check_pfif_tag(tag)
+        parent_type = self.tags and self.tags[-1][1]
+        field = None
+        if parent_type in ['person', 'note']:
+            field = check_pfif_tag(tag, parent_type)
+        self.tags.append((tag, type, field))
+        if type == 'person':
             self.person = {}
+            self.in_person = True
             self.enclosed_notes = []
-        elif check_pfif_tag(tag) == 'note':
+        elif type == 'note':
             self.note = {}
 
     def endElementNS(self, tag, qname):
-        assert self.tags.pop() == tag
-        if check_pfif_tag(tag) == 'person':
+        start_tag, type, field = self.tags.pop()
+        assert start_tag == tag
+        if type == 'person':
             self.person_records.append(self.person)
             if 'person_record_id' in self.person:
                 # Copy the person's person_record_id to any enclosed notes.
                 for note in self.enclosed_notes:
                     note['person_record_id'] = self.person['person_record_id']
-        elif check_pfif_tag(tag) == 'note':
+            self.note_records += self.enclosed_notes
+            self.in_person = False
+            self.enclosed_notes = []
+        elif type == 'note':
             # Save all parsed notes (whether or not enclosed in <person>).
-            self.note_records.append(self.note)
-            self.enclosed_notes.append(self.note)
+            if self.in_person:
+                self.enclosed_notes.append(self.note)
+            else:
+                self.note_records.append(self.note)
 
-    def append_to_field(self, record, tag, parent, content):
-        field = check_pfif_tag(tag, parent)
+    def append_to_field(self, record, tag, field, content):
         if field:
             record[field] = record.get(field, u'') + content
         elif content.strip():
@@ -466,11 +535,29 @@ class Handler(xml.sax.handler.ContentHandler):
 
     def characters(self, content):
         if content and len(self.tags) >= 2:
-            parent, tag = self.tags[-2], self.tags[-1]
-            if check_pfif_tag(parent) == 'person':
-                self.append_to_field(self.person, tag, 'person', content)
-            elif check_pfif_tag(parent) == 'note':
-                self.append_to_field(self.note, tag, 'note', content)
+            parent_type = self.tags[-2][1]
+            tag, type, field = self.tags[-1]
+            if parent_type == 'person':
+                self.append_to_field(self.person, tag, field, content)
+            elif parent_type == 'note':
+                self.append_to_field(self.note, tag, field, content)
+
+    def take_records(self, limit):
+        """Removes and returns up to limit of the completed person records
+        and then completed note records, as a list of person records and a
+        list of note records.  Persons are taken before notes so that no note
+        is returned before a person that preceded it in the document."""
+        person_records = self.person_records[:limit]
+        del self.person_records[:limit]
+        note_records = self.note_records[:limit - len(person_records)]
+        del self.note_records[:len(note_records)]
+        if self.rename_fields:
+            for record in person_records + note_records:
+                rename_fields_to_latest(record)
+        return person_records, note_records
+
+    def count_records(self):
+        return len(self.person_records) + len(self.note_records)
 
 
 def rename_fields_to_latest(record):
@@ -484,11 +571,17 @@ def rename_fields_to_latest(record):
                 record[new] = maybe_convert_other_to_description(record[old])
             del record[old]
 
-def parse_file(pfif_utf8_file, rename_fields=True):
-    """Reads a UTF-8-encoded PFIF file to give a list of person records and a
-    list of note records.  Each record is a plain dictionary of strings,
-    with PFIF 1.4 field names as keys if rename_fields is True; otherwise,
-    the field names are kept as is in the input XML file."""
+def parse_file_in_batches(pfif_utf8_file, rename_fields=True,
+                          batch_size=PARSE_BATCH_SIZE):
+    """Reads a UTF-8-encoded PFIF file incrementally, generating a list of
+    person records and a list of note records for each batch of up to
+    batch_size records as they are parsed, so the whole document and all its
+    records never have to be in memory at once.  Records are in document
+    order, except that a note enclosed in a <person> comes after the person.
+    Importing each batch's persons before its notes therefore never sees a
+    note before its enclosing person.  Each record is a plain dictionary of
+    strings, with PFIF 1.4 field names as keys if rename_fields is True;
+    otherwise, the field names are kept as is in the input XML file."""
     handler = Handler(rename_fields)
     parser = xml.sax.make_parser()
     parser.setFeature(xml.sax.handler.feature_namespaces, True)
@@ -497,11 +590,27 @@ def parse_file(pfif_utf8_file, rename_fields=True):
     parser.setFeature(xml.sax.handler.feature_external_pes, False)
     parser.setFeature(xml.sax.handler.feature_external_ges, False)
     parser.setContentHandler(handler)
-    parser.parse(pfif_utf8_file)
-    if rename_fields:
-        for record in handler.person_records + handler.note_records:
-            rename_fields_to_latest(record)
-    return handler.person_records, handler.note_records
+    while True:
+        data = pfif_utf8_file.read(PARSE_CHUNK_SIZE)
+        if not data:
+            break
+        parser.feed(data)
+        while handler.count_records() >= batch_size:
+            yield handler.take_records(batch_size)
+    parser.close()
+    while handler.count_records():
+        yield handler.take_records(batch_size)
+
+def parse_file(pfif_utf8_file, rename_fields=True):
+    """Reads a UTF-8-encoded PFIF file to give a list of person records and a
+    list of note records.  Each record is a plain dictionary of strings,
+    with PFIF 1.4 field names as keys if rename_fields is True; otherwise,
+    the field names are kept as is in the input XML file."""
+    person_records, note_records = [], []
+    for persons, notes in parse_file_in_batches(pfif_utf8_file, rename_fields):
+        person_records += persons
+        note_records += notes
+    return person_records, note_records
 
 def parse(pfif_text, rename_fields=True):
     """Takes the text of a PFIF document, as a Unicode string or UTF-8 string,
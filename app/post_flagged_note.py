@@ -63,7 +63,7 @@ class Handler(utils.BaseHandler):
 
         person = model.Person.get(self.repo, note.person_record_id)
         note.author_email = self.params.author_email
-        db.put([note])
+        model.put_and_count([note])
         # i18n: Subject line of an e-mail message that asks the note
         # author that he wants to post the note.
         subject = _('[Person Finder] Confirm your note on "%(full_name)s"'
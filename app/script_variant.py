@@ -1,15 +1,98 @@
 # coding:utf-8
 
+import compact_dictionary
 import jautils
 
 from unidecode import unidecode
 
+import collections
+import functools
 import os.path
 import re
 import logging
+
+# Maximum number of distinct words whose romanizations are cached in each
+# process, per romanization method.
+ROMANIZATION_CACHE_SIZE = 20000
+
+
+class LruCache(object):
+    """A bounded in-memory cache that evicts the least recently used entry
+    when it is full.  Keeps hit, miss and eviction counts so that the admin
+    dashboard can show how well the cache is doing."""
+
+    def __init__(self, name, max_items):
+        self.name = name
+        self.max_items = max_items
+        self.storage = collections.OrderedDict()
+        self.hit_count = 0
+        self.miss_count = 0
+        self.evict_count = 0
+
+    def get(self, key, default=None):
+        """Gets the value for the key and marks it as most recently used."""
+        if key not in self.storage:
+            self.miss_count += 1
+            return default
+        self.hit_count += 1
+        value = self.storage.pop(key)
+        self.storage[key] = value
+        return value
+
+    def put(self, key, value):
+        """Adds the key/value pair, evicting the least recently used entry
+        if the cache is full."""
+        self.storage.pop(key, None)
+        self.storage[key] = value
+        if len(self.storage) > self.max_items:
+            self.storage.popitem(last=False)
+            self.evict_count += 1
+
+    def clear(self):
+        self.storage.clear()
+
+    def stats(self):
+        return {'name': self.name,
+                'items_count': len(self.storage),
+                'max_items': self.max_items,
+                'hit_count': self.hit_count,
+                'miss_count': self.miss_count,
+                'evict_count': self.evict_count}
+
+
+# All the romanization caches in this process.
+ROMANIZATION_CACHES = []
+
+
+def cache_romanizations(function):
+    """Decorator that memoizes a romanization method in an LruCache.  Each
+    call returns a new list, because callers may modify the result."""
+    cache = LruCache(function.__name__, ROMANIZATION_CACHE_SIZE)
+    ROMANIZATION_CACHES.append(cache)
+
+    @functools.wraps(function)
+    def wrapper(word, *args, **kwargs):
+        key = (word, args, tuple(sorted(kwargs.items())))
+        romanizations = cache.get(key)
+        if romanizations is None:
+            romanizations = function(word, *args, **kwargs)
+            cache.put(key, romanizations)
+        return list(romanizations)
+    wrapper.cache = cache
+    wrapper.uncached = function
+    return wrapper
+
+
+def get_romanization_cache_stats():
+    """Returns a list of stats dictionaries, one for each romanization
+    cache in this process."""
+    return [cache.stats() for cache in ROMANIZATION_CACHES]
+
+
 def read_dictionary(file_name):
     """
-    Reads dictionary file.
+    Reads dictionary file.  This is the source format for
+    japanese_name_location_dict.bin; see tools/make_dictionary_file.py.
     Args:
         file_name: file name.
                    format: kanji + '\t' + yomigana
@@ -33,7 +116,8 @@ def read_dictionary(file_name):
         return None
     return dictionary
 
-JAPANESE_NAME_LOCATION_DICTIONARY = read_dictionary('japanese_name_location_dict.txt')
+JAPANESE_NAME_LOCATION_DICTIONARY = compact_dictionary.load(
+    'japanese_name_location_dict.bin')
 
 def has_kanji(word):
     """
@@ -67,6 +151,7 @@ def romanize_single_japanese_word(word):
     return [word]
 
 
+@cache_romanizations
 def romanize_japanese_word(word, for_index=True):
     """
     This method romanizes a Japanese text chunk using a dictionary.
@@ -126,6 +211,7 @@ def romanize_japanese_word(word, for_index=True):
     return list(words)
 
 
+@cache_romanizations
 def romanize_word_by_unidecode(word):
     """
     This method romanizes all languages by unidecode.
@@ -146,6 +232,7 @@ def romanize_word_by_unidecode(word):
     return [romanized_word.strip()]
 
 
+@cache_romanizations
 def romanize_search_query(word):
     """
     This method romanizes all languages for search query.
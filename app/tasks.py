@@ -32,6 +32,10 @@ import utils
 CPU_MEGACYCLES_PER_REQUEST = 1000
 EXPIRED_TTL = datetime.timedelta(delete.EXPIRED_TTL_DAYS, 0, 0)
 FETCH_LIMIT = 100
+# How long a pending update is kept after it was last written, so that the
+# records written with it have time to show up in (eventually consistent)
+# queries before the update is deleted.
+PENDING_UPDATE_DELAY = datetime.timedelta(minutes=1)
 
 
 
@@ -68,20 +72,14 @@ class ScanForExpired(utils.BaseHandler):
                 query.with_cursor(self.params.cursor)
             cursor = self.params.cursor
             try:
-                for person in query:
+                persons = query.fetch(FETCH_LIMIT)
+                while persons:
                     # query.cursor() returns a cursor which returns the entity
-                    # next to this "person" as the first result.
+                    # next to the last Person in this batch as the first result.
                     next_cursor = query.cursor()
-                    was_expired = person.is_expired
-                    person.put_expiry_flags()
-                    if (utils.get_utcnow() - person.get_effective_expiry_date()
-                        > EXPIRED_TTL):
-                        person.wipe_contents()
-                    else:
-                        # treat this as a regular deletion.
-                        if person.is_expired and not was_expired:
-                            delete.delete_person(self, person)
+                    self.expire_persons(persons)
                     cursor = next_cursor
+                    persons = query.with_cursor(cursor).fetch(FETCH_LIMIT)
             except runtime.DeadlineExceededError:
                 self.schedule_next_task(cursor)
             except datastore_errors.Timeout:
@@ -92,6 +90,48 @@ class ScanForExpired(utils.BaseHandler):
             for repo in model.Repo.list():
                 self.add_task_for_repo(repo, self.task_name(), self.ACTION)
 
+    def expire_persons(self, persons):
+        """Updates the expiry flags on a batch of Persons, and wipes or
+        deletes them as needed.  This does the same as calling
+        put_expiry_flags(), then wipe_contents() or delete.delete_person() on
+        each Person, but fetches all their Notes in parallel, stores and
+        deletes everything in one batch each, and queues up all the deletion
+        notices at once."""
+        notes_by_person = model.Note.get_by_person_record_ids(
+            self.repo, [person.record_id for person in persons],
+            filter_expired=False)
+        entities_to_put = []
+        entities_to_delete = []
+        notices = []
+        for person in persons:
+            notes = notes_by_person[person.record_id]
+            was_expired = person.is_expired
+            changed_entities = person.update_expiry_flags(notes)
+            if (utils.get_utcnow() - person.get_effective_expiry_date()
+                > EXPIRED_TTL):
+                # Wipe the record (see Person.wipe_contents); its Notes are
+                # deleted, so there's no need to store their flags.
+                entities_to_delete += person.get_related_entities(notes)
+                person.clear_contents()
+                entities_to_put.append(person)
+            elif person.is_expired and not was_expired:
+                # treat this as a regular deletion (see delete.delete_person).
+                if person.is_original():
+                    notices += delete.make_delete_notices(self, person, notes)
+                    person.expiry_date = utils.get_utcnow()
+                    entities_to_put += changed_entities
+                else:
+                    person.remove_from_indexes()
+                    entities_to_delete += person.get_related_entities(notes)
+                    entities_to_delete.append(person)
+            else:
+                entities_to_put += changed_entities
+        if entities_to_put:
+            model.put_and_count(entities_to_put)
+        if entities_to_delete:
+            model.delete_and_count(entities_to_delete)
+        self.send_mails(notices)
+
 class DeleteExpired(ScanForExpired):
     """Scan for person records with expiry date thats past."""
     ACTION = 'tasks/delete_expired'
@@ -112,6 +152,88 @@ class DeleteOld(ScanForExpired):
     def query(self):
         return model.Person.potentially_expired_records(self.repo)
 
+def delete_unchanged(updates):
+    """Deletes the given PendingStatusUpdates or PendingClusterUpdates,
+    except those that have been written again since they were read or
+    within the last PENDING_UPDATE_DELAY, which are left for the next run."""
+    # The timestamps are set by the datastore clock, not utils.get_utcnow().
+    cutoff = datetime.datetime.utcnow() - PENDING_UPDATE_DELAY
+    stored_updates = db.get([update.key() for update in updates])
+    db.delete([update.key() for update, stored in zip(updates, stored_updates)
+               if stored and stored.timestamp == update.timestamp and
+               stored.timestamp < cutoff])
+
+
+class PendingUpdateBase(utils.BaseHandler):
+    """A base handler for tasks that process the pending updates (entities
+    of the kind MODEL) in each repository in batches, calling
+    update_persons() for each batch."""
+    repo_required = False
+    MODEL = None  # Each subclass should set the kind of the pending updates.
+    TASK_NAME = ''  # Each subclass should set the name of its tasks.
+    ACTION = ''  # Each subclass should set the action path that it handles.
+
+    def get(self):
+        if self.repo:
+            query = self.MODEL.all().filter('repo =', self.repo)
+            try:
+                updates = query.fetch(FETCH_LIMIT)
+                while updates:
+                    self.update_persons(updates)
+                    query.with_cursor(query.cursor())
+                    updates = query.fetch(FETCH_LIMIT)
+            except runtime.DeadlineExceededError:
+                self.add_task_for_repo(self.repo, self.TASK_NAME, self.ACTION)
+        else:
+            for repo in model.Repo.list():
+                self.add_task_for_repo(repo, self.TASK_NAME, self.ACTION)
+
+    def update_persons(self, updates):
+        """Subclasses should implement this.  This will be called once for
+        each batch of pending updates; it should update the Persons they
+        name and then remove the updates that have been handled."""
+
+
+class UpdatePendingStatus(PendingUpdateBase):
+    """Recomputes latest_status for the Persons with a PendingStatusUpdate,
+    i.e. those whose status Notes have been written, hidden, unhidden,
+    expired or deleted since the last run.  (UpdateStatus and
+    UpdateDeadStatus do the same for every Person in the repository.)"""
+    MODEL = model.PendingStatusUpdate
+    TASK_NAME = 'update-pending-status'
+    ACTION = 'tasks/update_pending_status'
+
+    def update_persons(self, updates):
+        persons = [person for person in model.Person.get_all(
+                       self.repo, [update.person_record_id
+                                   for update in updates])
+                   if not person.is_expired]
+        notes_by_person = model.Note.get_by_person_record_ids(
+            self.repo, [person.record_id for person in persons])
+        changed_persons = [
+            person for person in persons
+            if person.set_latest_status_from_notes(
+                notes_by_person[person.record_id])]
+        if changed_persons:
+            model.put_and_count(changed_persons)
+        # Delete the updates only now, and only the settled ones, so that a
+        # Note that the Note query missed leaves its update for the next run.
+        delete_unchanged(updates)
+
+
+class UpdatePendingClusters(PendingUpdateBase):
+    """Brings the model.DuplicateClusters of the Persons with a
+    PendingClusterUpdate up to date."""
+    MODEL = model.PendingClusterUpdate
+    TASK_NAME = 'update-pending-clusters'
+    ACTION = 'tasks/update_pending_clusters'
+
+    def update_persons(self, updates):
+        model.DuplicateCluster.update(
+            self.repo, [update.person_record_id for update in updates])
+        delete_unchanged(updates)
+
+
 class CleanUpInTestMode(utils.BaseHandler):
     """If the repository is in "test mode", this task deletes all entries older
     than DELETION_AGE_SECONDS (defined below), regardless of their actual
@@ -205,7 +327,7 @@ class CleanUpInTestMode(utils.BaseHandler):
         self.__listener = listener
 
 
-def run_count(make_query, update_counter, counter):
+def run_count(make_query, update_counters, counter):
     """Scans the entities matching a query up to FETCH_LIMIT.
     
     Returns False if we finished counting all entries."""
@@ -219,8 +341,7 @@ def run_count(make_query, update_counter, counter):
         return False
 
     # Pass the entities to the counting function.
-    for entity in entities:
-        update_counter(counter, entity)
+    update_counters(counter, entities)
 
     # Remember where we left off.
     counter.last_key = str(entities[-1].key())
@@ -235,6 +356,9 @@ class CountBase(utils.BaseHandler):
 
     SCAN_NAME = ''  # Each subclass should choose a unique scan_name.
     ACTION = ''  # Each subclass should set the action path that it handles.
+    # True for scans whose counts are kept live between scans (see
+    # model.CounterShard); a completed scan replaces the live changes.
+    LIVE_COUNTS = False
 
     def get(self):
         if self.repo:  # Do some counting.
@@ -246,11 +370,15 @@ class CountBase(utils.BaseHandler):
                     # Batch the db updates.
                     for _ in xrange(100):
                         entities_remaining = run_count(
-                            self.make_query, self.update_counter, counter)
+                            self.make_query, self.update_counters, counter)
                         if not entities_remaining:
                             break
                     # And put the updates at once.
                     counter.put()
+                if self.LIVE_COUNTS:
+                    # The scan counted the changes made before it started.
+                    model.CounterShard.discard_before(
+                        self.repo, self.SCAN_NAME, counter.generation)
             except runtime.DeadlineExceededError:
                 # Continue counting in another task.
                 self.add_task_for_repo(self.repo, self.SCAN_NAME, self.ACTION)
@@ -267,59 +395,84 @@ class CountBase(utils.BaseHandler):
         each entity that matches the query; it should call increment() on
         the counter object for whatever accumulators it wants to increment."""
 
+    def update_counters(self, counter, entities):
+        """This is called once for each batch of entities that match the query,
+        and calls update_counter() on each of them.  Subclasses can override
+        this to process a whole batch at once."""
+        for entity in entities:
+            self.update_counter(counter, entity)
+
 
 class CountPerson(CountBase):
     SCAN_NAME = 'person'
     ACTION = 'tasks/count/person'
+    LIVE_COUNTS = True
 
     def make_query(self):
         return model.Person.all().filter('repo =', self.repo)
 
-    def update_counter(self, counter, person):
-        found = ''
-        if person.latest_found is not None:
-            found = person.latest_found and 'TRUE' or 'FALSE'
-
-        counter.increment('all')
-        counter.increment('original_domain=' + (person.original_domain or ''))
-        counter.increment('sex=' + (person.sex or ''))
-        counter.increment('home_country=' + (person.home_country or ''))
-        counter.increment('photo=' + (person.photo_url and 'present' or ''))
-        counter.increment('num_notes=%d' % len(person.get_notes()))
-        counter.increment('status=' + (person.latest_status or ''))
-        counter.increment('found=' + found)
-        if person.author_email:  # author e-mail address present?
-            counter.increment('author_email')
-        if person.author_phone:  # author phone number present?
-            counter.increment('author_phone')
-        counter.increment(
-            'linked_persons=%d' % len(person.get_linked_persons()))
+    def update_counters(self, counter, persons):
+        # The Persons come in key order, which is record ID order within a
+        # repository, so one query gets the Notes for the whole batch and
+        # one batch get checks which linked Persons exist, instead of
+        # running note queries for each Person.
+        record_ids = [person.record_id for person in persons]
+        notes_by_person = model.Note.get_by_person_record_id_range(
+            self.repo, min(record_ids), max(record_ids))
+        linked_person_ids = set(
+            note.linked_person_record_id
+            for notes in notes_by_person.values() for note in notes
+            if note.linked_person_record_id)
+        existing_person_ids = set(
+            person.record_id for person in
+            model.Person.get_all(self.repo, list(linked_person_ids)))
+        for person in persons:
+            self.update_counter(
+                counter, person, notes_by_person.get(person.record_id, []),
+                existing_person_ids)
+
+    def update_counter(self, counter, person, notes, existing_person_ids):
+        """Counts one Person, given its unexpired Notes and the set of record
+        IDs among the Persons they link to that exist."""
+        linked_person_ids = [note.linked_person_record_id for note in notes
+                             if note.linked_person_record_id]
+
+        for name in person.get_count_names():
+            counter.increment(name)
+        counter.increment('num_notes=%d' % len(notes))
+        counter.increment('linked_persons=%d' % len(
+            [id for id in linked_person_ids if id in existing_person_ids]))
 
 
 class CountNote(CountBase):
     SCAN_NAME = 'note'
     ACTION = 'tasks/count/note'
+    LIVE_COUNTS = True
 
     def make_query(self):
         return model.Note.all().filter('repo =', self.repo)
 
     def update_counter(self, counter, note):
-        author_made_contact = ''
-        if note.author_made_contact is not None:
-            author_made_contact = note.author_made_contact and 'TRUE' or 'FALSE'
-
-        counter.increment('all')
-        counter.increment('status=' + (note.status or ''))
-        counter.increment('original_domain=' + (note.original_domain or ''))
-        counter.increment('author_made_contact=' + author_made_contact)
-        if note.last_known_location:  # last known location specified?
-            counter.increment('last_known_location')
-        if note.author_email:  # author e-mail address present?
-            counter.increment('author_email')
-        if note.author_phone:  # author phone number present?
-            counter.increment('author_phone')
-        if note.linked_person_record_id:  # linked to another person?
-            counter.increment('linked_person')
+        for name in note.get_count_names():
+            counter.increment(name)
+
+
+class UpdateDuplicateClusters(CountBase):
+    """Builds the model.DuplicateClusters from the duplicate links in all the
+    Notes.  The clusters are kept up to date as records are written, so this
+    only needs to run once for records stored before clusters existed.
+    (This is a migration task, not a counting task.)"""
+    SCAN_NAME = 'update-duplicate-clusters'
+    ACTION = 'tasks/count/update_duplicate_clusters'
+
+    def make_query(self):
+        return model.Note.all().filter('repo =', self.repo)
+
+    def update_counters(self, counter, notes):
+        model.DuplicateCluster.merge(self.repo, [
+            (note.person_record_id, note.linked_person_record_id)
+            for note in notes
+            if model.DuplicateCluster.is_link(note.get_count_names())])
 
 
 class AddReviewedProperty(CountBase):
@@ -357,7 +510,9 @@ class UpdateDeadStatus(CountBase):
 
 class UpdateStatus(CountBase):
     """This task scans Person records, looks for the last non-hidden Note, and
-    updates latest_status.  (This is a cleanup task, not a counting task.)"""
+    updates latest_status.  (This is a cleanup task, not a counting task.)
+    UpdatePendingStatus keeps latest_status up to date as Notes change, so
+    this only needs to run to repair records stored before it existed."""
     SCAN_NAME = 'update-status'
     ACTION = 'tasks/count/update_status'
 
@@ -376,6 +531,17 @@ class Reindex(CountBase):
     def make_query(self):
         return model.Person.all().filter('repo =', self.repo)
 
-    def update_counter(self, counter, person):
-        person.update_index(['old', 'new'])
-        person.put()
+    def update_counters(self, counter, persons):
+        import indexing
+        # If the repository has no token statistics when the scan starts
+        # (e.g. they were evicted from memcache), rebuild them by counting
+        # every Person in this scan as newly indexed.  The decision is kept
+        # on the Counter as a plain property, not as a count.
+        if (not counter.last_key and
+            not indexing.TokenStats.get_document_count(self.repo)):
+            counter.rebuild_token_stats = True
+        if getattr(counter, 'rebuild_token_stats', False):
+            for person in persons:
+                person.names_prefixes = []
+        model.Person.update_indexes(persons, ['old', 'new'])
+        model.put_and_count(persons)
@@ -603,6 +603,7 @@ class BaseHandler(webapp.RequestHandler):
         'query': strip,
         'query_type': strip,
         'read_permission': validate_checkbox_as_bool,
+        'recount': validate_int,
         'referrer': strip,
         'resource_bundle': validate_resource_name,
         'resource_bundle_default': validate_resource_name,
@@ -741,14 +742,31 @@ class BaseHandler(webapp.RequestHandler):
 
     def send_mail(self, to, subject, body):
         """Sends e-mail using a sender address that's allowed for this app."""
-        app_id = get_app_name()
-        sender = 'Do not reply <do-not-reply@%s.%s>' % (app_id, EMAIL_DOMAIN)
         logging.info('Add mail task: recipient %r, subject %r' % (to, subject))
         taskqueue.add(queue_name='send-mail', url='/global/admin/send_mail',
-                      params={'sender': sender,
-                              'to': to,
-                              'subject': subject,
-                              'body': body})
+                      params=self.get_mail_params(to, subject, body))
+
+    def send_mails(self, messages):
+        """Sends e-mail like send_mail() for each (to, subject, body) in
+        messages, with one call to the task queue for each batch of up to
+        taskqueue.MAX_TASKS_PER_ADD messages."""
+        tasks = []
+        for to, subject, body in messages:
+            logging.info('Add mail task: recipient %r, subject %r' %
+                         (to, subject))
+            tasks.append(taskqueue.Task(
+                url='/global/admin/send_mail',
+                params=self.get_mail_params(to, subject, body)))
+        queue = taskqueue.Queue('send-mail')
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+    def get_mail_params(self, to, subject, body):
+        """Gets the parameters for a send-mail task, using a sender address
+        that's allowed for this app."""
+        app_id = get_app_name()
+        sender = 'Do not reply <do-not-reply@%s.%s>' % (app_id, EMAIL_DOMAIN)
+        return {'sender': sender, 'to': to, 'subject': subject, 'body': body}
 
     def get_captcha_html(self, error_code=None, use_ssl=False):
         """Generates the necessary HTML to display a CAPTCHA validation box."""
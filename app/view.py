@@ -92,12 +92,16 @@ class Handler(BaseHandler):
             linked_persons = person.get_all_linked_persons()
         except datastore_errors.NeedIndexError:
             linked_persons = []
+        # Fetch the notes on all the linked persons in parallel.
+        try:
+            linked_notes_by_person = Note.get_by_person_record_ids(
+                self.repo, [p.record_id for p in linked_persons])
+        except datastore_errors.NeedIndexError:
+            linked_notes_by_person = {}
         linked_person_info = []
         for linked_person in linked_persons:
-            try:
-                linked_notes = linked_person.get_notes()
-            except datastore_errors.NeedIndexError:
-                linked_notes = []
+            linked_notes = linked_notes_by_person.get(
+                linked_person.record_id, [])
             for note in linked_notes:
                 self.__add_fields_to_note(note)
             linked_person_info.append(dict(
@@ -235,7 +239,7 @@ class Handler(BaseHandler):
                 spam_score=spam_score,
                 confirmed=False)
             # Write the new NoteWithBadWords to the datastore
-            db.put(note)
+            put_and_count(note)
             UserActionLog.put_new('add', note, copy_properties=False)
             # When the note is detected as spam, we do not update person record
             # or log action. We ask the note author for confirmation first.
@@ -260,7 +264,7 @@ class Handler(BaseHandler):
                 photo=photo,
                 photo_url=photo_url)
             # Write the new regular Note to the datastore
-            db.put(note)
+            put_and_count(note)
             UserActionLog.put_new('add', note, copy_properties=False)
 
         # Specially log 'believed_dead'.
@@ -281,7 +285,7 @@ class Handler(BaseHandler):
             # who subscribed to updates on this person
             subscribe.send_notifications(self, person, [note])
             # write the updated person record to datastore
-            db.put(person)
+            put_and_count(person)
 
         # If user wants to subscribe to updates, redirect to the subscribe page
         if self.params.subscribe:
@@ -0,0 +1,71 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for loading and looking up the Japanese name/location
+dictionary, as a dict of sets parsed from the .txt file and as a
+CompactDictionary."""
+
+import gc
+import random
+
+import benchmarks
+import compact_dictionary
+import script_variant
+
+NUM_LOOKUPS = 10000
+
+
+def get_resident_kb():
+    """Returns the resident set size of this process in KB (Linux only)."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def measure_resident_kb(load):
+    gc.collect()
+    before = get_resident_kb()
+    dictionary = load()
+    gc.collect()
+    return dictionary, get_resident_kb() - before
+
+
+def run():
+    load_text = lambda: script_variant.read_dictionary(
+        'japanese_name_location_dict.txt')
+    load_compact = lambda: compact_dictionary.load(
+        'japanese_name_location_dict.bin')
+
+    print '%-40s %13s %13s' % ('', 'text', 'compact')
+    benchmarks.report('load', benchmarks.measure(load_text, 3),
+                      benchmarks.measure(load_compact, 3))
+
+    text, text_kb = measure_resident_kb(load_text)
+    compact, compact_kb = measure_resident_kb(load_compact)
+    print '%-40s %10d KB %10d KB' % ('resident memory', text_kb, compact_kb)
+
+    rand = random.Random(0)
+    keys = rand.sample(sorted(text), NUM_LOOKUPS // 2)
+    keys += [key + u'x' for key in keys]  # misses
+
+    def lookup(dictionary):
+        for key in keys:
+            if key in dictionary:
+                dictionary[key]
+    benchmarks.report('%d lookups' % len(keys),
+                      benchmarks.measure(lambda: lookup(text)),
+                      benchmarks.measure(lambda: lookup(compact)))
@@ -0,0 +1,148 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for full_text_search documents and queries."""
+
+import datetime
+
+from google.appengine.api import search as appengine_search
+from google.appengine.ext import db
+
+import benchmarks
+import full_text_search
+import model
+
+REPO = 'bench'
+LEGACY_INDEX_NAME = 'bench_legacy'
+
+# The same kinds of records as in test_full_text_search.py.
+CORPUS = [
+    dict(given_name=u'Iori', family_name=u'Minase',
+         full_name=u'Iori Minase', alternate_names=u'Iorin'),
+    dict(given_name=u'Chihaya', family_name=u'Kisaragi',
+         full_name=u'Chihaya Kisaragi', home_street=u'Kunaideme72',
+         home_city=u'Arao', home_state=u'Kumamoto',
+         home_postal_code=u'864-0003', home_neighborhood=u'Araokeibajou',
+         home_country=u'Japan'),
+    dict(given_name=u'あずさ', family_name=u'三浦', full_name=u'三浦 あずさ',
+         home_city=u'横浜'),
+    dict(given_name=u'рицуко', family_name=u'акидуки',
+         full_name=u'акидуки рицуко', home_city=u'тоттори'),
+    dict(given_name=u'Rin', family_name=u'Shibuya',
+         full_name=u'Rin Shibuya', home_city=u'shinjuku'),
+    dict(given_name=u'Rin', family_name=u'Tosaka',
+         full_name=u'Rin Tosaka', home_city=u'Shibuya'),
+    dict(given_name=u'雪歩', family_name=u'萩原', full_name=u'萩原 雪歩'),
+    dict(given_name=u'真', family_name=u'菊地', full_name=u'菊地 真',
+         home_city=u'東京'),
+    dict(given_name=u'眞', family_name=u'菊地', full_name=u'菊地 眞'),
+    dict(given_name=u'', family_name=u'', full_name=u'音無小鳥'),
+]
+QUERIES = [u'Rin Shibuya', u'菊地 真', u'hagiwara', u'Chihaya Arao', u'Iori']
+
+
+def create_legacy_document(person):
+    """Builds a document the way create_document() used to, with each
+    romanized name repeated REPEAT_COUNT_FOR_RANK (5) times for ranking."""
+    document = full_text_search.create_document(person)
+    fields = [field for field in document.fields
+              if not field.name.startswith('names_romanized_by_')]
+    for method in full_text_search.ROMANIZE_METHODS:
+        names = []
+        for field_name in full_text_search.NAME_FIELD_NAMES:
+            for index, value in enumerate(method(getattr(person, field_name))):
+                names.append(value)
+                # create_fields_for_rank() was passed a single string, so it
+                # emitted five fields for each of its characters.
+                for char_index, char in enumerate(value):
+                    for x in xrange(5):
+                        fields.append(appengine_search.TextField(
+                            name='%s_romanized_by_%s_%d_%d_for_rank_%d' % (
+                                field_name, method.__name__, index,
+                                char_index, x),
+                            value=char))
+        full_names = full_text_search.create_full_name_list_without_space(
+            method(person.given_name), method(person.family_name))
+        for index, full_name in enumerate(full_names):
+            fields.append(appengine_search.TextField(
+                name='no_space_full_name_romanized_by_%s_%d' % (
+                    method.__name__, index), value=full_name))
+        names.extend(full_names)
+        fields.append(appengine_search.TextField(
+            name='names_romanized_by_' + method.__name__,
+            value=':'.join(name for name in names if name)))
+    return appengine_search.Document(doc_id=document.doc_id, fields=fields)
+
+
+def legacy_search(query_txt, max_results):
+    """Runs the two queries that search() used to run on the legacy index."""
+    index = appengine_search.Index(name=LEGACY_INDEX_NAME)
+    options = appengine_search.QueryOptions(
+        limit=max_results,
+        sort_options=appengine_search.SortOptions(
+            expressions=full_text_search.create_sort_expressions(),
+            match_scorer=appengine_search.MatchScorer()),
+        returned_fields=['record_id'] +
+            full_text_search.ROMANIZED_NAME_FIELD_NAMES)
+    results_list = []
+    for query in [full_text_search.create_non_romanized_query(query_txt),
+                  full_text_search.create_romanized_query_txt(query_txt)]:
+        results_list.append(index.search(appengine_search.Query(
+            query_string=query + ' AND (repo: ' + REPO + ')',
+            options=options)))
+    return full_text_search.get_person_ids_from_results(
+        query_txt, results_list)
+
+
+def document_size(document):
+    return sum(len(field.name) + len(field.value.encode('utf-8'))
+               for field in document.fields)
+
+
+def run():
+    persons = []
+    for i, fields in enumerate(CORPUS):
+        person = model.Person.create_original_with_record_id(
+            REPO, 'bench/%d' % i, entry_date=datetime.datetime.utcnow(),
+            **fields)
+        persons.append(person)
+    db.put(persons)
+
+    legacy_documents = [create_legacy_document(p) for p in persons]
+    documents = [full_text_search.create_document(p) for p in persons]
+    print '%-40s %13s %13s' % ('', 'before', 'after')
+    print '%-40s %13d %13d' % (
+        'fields per document (mean)',
+        sum(len(d.fields) for d in legacy_documents) / len(persons),
+        sum(len(d.fields) for d in documents) / len(persons))
+    print '%-40s %13d %13d' % (
+        'bytes per document (mean)',
+        sum(document_size(d) for d in legacy_documents) / len(persons),
+        sum(document_size(d) for d in documents) / len(persons))
+
+    legacy_index = appengine_search.Index(name=LEGACY_INDEX_NAME)
+    index = appengine_search.Index(
+        name=full_text_search.PERSON_LOCATION_FULL_TEXT_INDEX_NAME)
+    benchmarks.report('index put (whole corpus)',
+                      benchmarks.measure(lambda: legacy_index.put(
+                          legacy_documents), 5),
+                      benchmarks.measure(lambda: index.put(documents), 5))
+    for query in QUERIES:
+        benchmarks.report(
+            'query %s' % query.encode('utf-8'),
+            benchmarks.measure(lambda: legacy_search(query, 100), 5),
+            benchmarks.measure(
+                lambda: full_text_search.search(REPO, query, 100), 5))
@@ -0,0 +1,41 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for jautils.hiragana_to_romaji over the dictionary readings."""
+
+import benchmarks
+import jautils
+from test_jautils import read_dictionary_readings, reference_hiragana_to_romaji
+
+
+def run():
+    readings = read_dictionary_readings()
+    for reading in readings:
+        assert jautils.hiragana_to_romaji(reading) == \
+            reference_hiragana_to_romaji(reading), reading
+
+    def before():
+        for reading in readings:
+            reference_hiragana_to_romaji(reading)
+
+    def after():
+        for reading in readings:
+            jautils.hiragana_to_romaji(reading)
+
+    print '%d readings from japanese_name_location_dict.txt' % len(readings)
+    print '%-40s %13s %13s' % ('', 'table scan', 'dict lookup')
+    benchmarks.report('hiragana_to_romaji', benchmarks.measure(before, 3),
+                      benchmarks.measure(after, 3))
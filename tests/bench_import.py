@@ -0,0 +1,65 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for importer.import_records with new original records, which
+each need a unique ID."""
+
+from google.appengine.ext import db
+
+import benchmarks
+import importer
+import model
+
+REPO = 'bench'
+DOMAIN = 'bench.personfinder.google.org'
+NUM_RECORDS = 2000
+
+
+def create_id_by_put():
+    """The old UniqueId.create_id(), which wrote an entity for every ID."""
+    unique_id = model.UniqueId()
+    unique_id.put()
+    return unique_id.key().id()
+
+
+def make_records():
+    return [{'given_name': 'Given%d' % i, 'family_name': 'Family%d' % i,
+             'full_name': 'Given%d Family%d' % (i, i)}
+            for i in xrange(NUM_RECORDS)]
+
+
+def import_all():
+    records = make_records()
+    written, skipped, total = importer.import_records(
+        REPO, DOMAIN, importer.create_person, records)
+    assert written == NUM_RECORDS, skipped[:1]
+    db.delete(model.Person.all(keys_only=True).filter('repo =', REPO))
+
+
+def run():
+    print '%d new Person records per import' % NUM_RECORDS
+    print '%-40s %13s %13s' % ('', 'put per ID', 'ID pool')
+    create_id = model.UniqueId.create_id
+    model.UniqueId.create_id = staticmethod(create_id_by_put)
+    try:
+        before = benchmarks.measure(import_all, 3)
+    finally:
+        model.UniqueId.create_id = staticmethod(create_id)
+    db.delete(model.UniqueId.all(keys_only=True))
+    after = benchmarks.measure(import_all, 3)
+    benchmarks.report('import_records', before, after)
+    print '%-40s %10.1f/s %10.1f/s' % (
+        'throughput', NUM_RECORDS * 1000 / before, NUM_RECORDS * 1000 / after)
@@ -0,0 +1,119 @@
+#!/usr/bin/python2.7
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for parsing PFIF with pfif.Handler, over the test PFIF files
+with their records repeated SCALE times."""
+
+import glob
+import os
+import re
+import StringIO
+import xml.sax
+import xml.sax.handler
+
+import benchmarks
+import pfif
+
+SCALE = 1000
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def reference_check_pfif_tag(name, parent=None):
+    """The old check_pfif_tag(), which tried each PFIF version in turn."""
+    return pfif.PFIF_1_4.check_tag(name, parent) or \
+        pfif.PFIF_1_3.check_tag(name, parent) or \
+        pfif.PFIF_1_2.check_tag(name, parent) or \
+        pfif.PFIF_1_1.check_tag(name, parent)
+
+
+class ReferenceHandler(pfif.Handler):
+    """pfif.Handler as it was before tags were looked up in PFIF_FIELD_TAGS
+    and cached on the tag stack."""
+
+    def startElementNS(self, tag, qname, attrs):
+        self.tags.append(tag)
+        if reference_check_pfif_tag(tag) == 'person':
+            self.person = {}
+            self.in_person = True
+            self.enclosed_notes = []
+        elif reference_check_pfif_tag(tag) == 'note':
+            self.note = {}
+
+    def endElementNS(self, tag, qname):
+        assert self.tags.pop() == tag
+        if reference_check_pfif_tag(tag) == 'person':
+            self.person_records.append(self.person)
+            if 'person_record_id' in self.person:
+                for note in self.enclosed_notes:
+                    note['person_record_id'] = self.person['person_record_id']
+            self.note_records += self.enclosed_notes
+            self.in_person = False
+            self.enclosed_notes = []
+        elif reference_check_pfif_tag(tag) == 'note':
+            if self.in_person:
+                self.enclosed_notes.append(self.note)
+            else:
+                self.note_records.append(self.note)
+
+    def characters(self, content):
+        if content and len(self.tags) >= 2:
+            parent, tag = self.tags[-2], self.tags[-1]
+            if reference_check_pfif_tag(parent) == 'person':
+                self.append_to_field(self.person, tag,
+                    reference_check_pfif_tag(tag, 'person'), content)
+            elif reference_check_pfif_tag(parent) == 'note':
+                self.append_to_field(self.note, tag,
+                    reference_check_pfif_tag(tag, 'note'), content)
+
+
+def read_scaled_documents():
+    """Reads the test PFIF files, repeating the records in each one."""
+    documents = []
+    for path in sorted(glob.glob(os.path.join(TESTS_DIR, '*.pfif-*.xml'))):
+        match = re.match(r'(?s)(.*?<pfif:pfif[^>]*>)(.*)(</pfif:pfif>.*)',
+                         open(path).read())
+        head, records, tail = match.groups()
+        documents.append(head + records * SCALE + tail)
+    return documents
+
+
+def parse(document, handler_class):
+    handler = handler_class()
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    parser.setContentHandler(handler)
+    parser.parse(StringIO.StringIO(document))
+    return handler.person_records, handler.note_records
+
+
+def run():
+    documents = read_scaled_documents()
+    for document in documents:
+        assert parse(document, pfif.Handler) == \
+            parse(document, ReferenceHandler)
+
+    def before():
+        for document in documents:
+            parse(document, ReferenceHandler)
+
+    def after():
+        for document in documents:
+            parse(document, pfif.Handler)
+
+    print '%d test PFIF files, records repeated %d times (%.1f MB)' % (
+        len(documents), SCALE, sum(map(len, documents)) / 1e6)
+    print '%-40s %13s %13s' % ('', 'per version', 'tag table')
+    benchmarks.report('pfif.Handler', benchmarks.measure(before, 3),
+                      benchmarks.measure(after, 3))
@@ -0,0 +1,148 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for indexing.rank_and_order over a 400-candidate result set."""
+
+import datetime
+import random
+import re
+
+import benchmarks
+import indexing
+import model
+from text_query import TextQuery
+
+NUM_CANDIDATES = 400
+
+GIVEN_NAMES = [u'Jean', u'Marie', u'Pierre', u'Rose', u'太郎', u'花子',
+               u'José', u'Zoë', u'Ana María', u'美咲']
+FAMILY_NAMES = [u'Joseph', u'Pierre', u'Louis', u'Saint-Fleur', u'山田',
+                u'佐藤', u'Müller', u'García López', u'鈴木', u'Dupont']
+
+
+class CmpResults():
+    """The cmp-based comparator that rank_and_order used to use, which
+    normalizes the names of each Person inside the sort."""
+
+    def __init__(self, query):
+        self.query = query
+        self.query_words_set = set(query.words)
+
+    def __call__(self, p1, p2):
+        if ((p1.primary_full_name and
+             p1.primary_full_name == p2.primary_full_name) or
+            ((p1.given_name or p1.family_name) and
+             p1.given_name == p2.given_name and
+             p1.family_name == p2.family_name)):
+            return 0
+        self.set_ranking_attr(p1)
+        self.set_ranking_attr(p2)
+        r1 = self.rank(p1)
+        r2 = self.rank(p2)
+        if r1 == r2:
+            return cmp(p1._normalized_full_name.normalized,
+                       p2._normalized_full_name.normalized)
+        else:
+            return cmp(r2, r1)
+
+    def set_ranking_attr(self, person):
+        if not hasattr(person, '_normalized_given_name'):
+            person._normalized_given_name = TextQuery(person.given_name)
+            person._normalized_family_name = TextQuery(person.family_name)
+            person._normalized_full_name = TextQuery(person.full_name)
+            person._name_words = set(person._normalized_full_name.words)
+            person._alt_name_words = set(
+                    TextQuery(person.alternate_names).words)
+
+    def rank(self, person):
+        ordered_words = self.query.normalized.split()
+        if (ordered_words ==
+            person._normalized_given_name.words +
+            person._normalized_family_name.words):
+            return 10
+        if (re.match(ur'^[\u3400-\u9fff]$', person.family_name) and
+            ordered_words in [[person.family_name + person.given_name],
+                              [person.family_name, person.given_name]]):
+            return 10
+        if (re.match(ur'^[\u3400-\u9fff]+$', person.family_name) and
+            ordered_words in [[person.family_name + person.given_name],
+                              [person.family_name, person.given_name]]):
+            return 9.5
+        if (ordered_words ==
+            person._normalized_family_name.words +
+            person._normalized_given_name.words):
+            return 9
+        if (re.match(ur'^[\u3400-\u9fff]$', person.given_name) and
+            ordered_words in [[person.given_name + person.family_name],
+                              [person.given_name, person.family_name]]):
+            return 9
+        if (re.match(ur'^[\u3400-\u9fff]+$', person.given_name) and
+            ordered_words in [[person.given_name + person.family_name],
+                              [person.given_name, person.family_name]]):
+            return 8.5
+        if person._name_words == self.query_words_set:
+            return 8
+        if self.query.normalized in [
+            person._normalized_given_name.normalized,
+            person._normalized_family_name.normalized]:
+            return 7
+        if person._name_words.issuperset(self.query_words_set):
+            return 6
+        matched_words = person._name_words.union(
+            person._alt_name_words).intersection(self.query_words_set)
+        return min(5, 1 + len(matched_words))
+
+
+def create_candidates(rand):
+    persons = []
+    for i in xrange(NUM_CANDIDATES):
+        given_name = rand.choice(GIVEN_NAMES)
+        family_name = rand.choice(FAMILY_NAMES)
+        person = model.Person.create_original_with_record_id(
+            'bench', 'bench/%d' % i, given_name=given_name,
+            family_name=family_name,
+            full_name=given_name + u' ' + family_name,
+            alternate_names=rand.choice(FAMILY_NAMES),
+            entry_date=datetime.datetime.utcnow())
+        indexing.update_index_properties(person)
+        persons.append(person)
+    return persons
+
+
+def run():
+    persons = create_candidates(random.Random(0))
+    print '%d candidates, times are medians per search' % NUM_CANDIDATES
+    print '%-40s %13s %13s' % ('', 'cmp sort', 'key sort')
+    for query_txt in [u'Jean Pierre', u'山田 太郎', u'Marie']:
+        query = TextQuery(query_txt)
+
+        def cmp_sort():
+            # Fresh copies, since CmpResults caches on the entities.
+            results = [model.Person(key_name=p.key().name(), repo=p.repo,
+                                    given_name=p.given_name,
+                                    family_name=p.family_name,
+                                    full_name=p.full_name,
+                                    alternate_names=p.alternate_names,
+                                    entry_date=p.entry_date)
+                       for p in persons]
+            results.sort(CmpResults(query))
+
+        def key_sort():
+            indexing.rank_and_order(list(persons), query, 100)
+
+        benchmarks.report(query_txt.encode('utf-8'),
+                          benchmarks.measure(cmp_sort, 5),
+                          benchmarks.measure(key_sort, 5))
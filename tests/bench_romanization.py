@@ -0,0 +1,74 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for the script_variant romanization caches."""
+
+import bisect
+import random
+
+import benchmarks
+import script_variant
+
+NUM_NAMES = 5000
+VOCABULARY_SIZE = 2000
+
+
+def zipf_sampler(rand, words):
+    """Returns a function that picks words with Zipf-distributed frequencies
+    (the k-th word is picked with probability proportional to 1/k), which is
+    roughly how surnames and given names are distributed."""
+    cumulative = []
+    total = 0.0
+    for k in xrange(1, len(words) + 1):
+        total += 1.0 / k
+        cumulative.append(total)
+    return lambda: words[bisect.bisect(cumulative, rand.random() * total)]
+
+
+def run():
+    rand = random.Random(0)
+    dictionary = script_variant.JAPANESE_NAME_LOCATION_DICTIONARY
+    vocabulary = rand.sample(sorted(dictionary), VOCABULARY_SIZE)
+    pick = zipf_sampler(rand, vocabulary)
+    # create_document() romanizes the given name, the family name and the
+    # full name of each record.
+    names = []
+    for i in xrange(NUM_NAMES):
+        family_name, given_name = pick(), pick()
+        names += [given_name, family_name, family_name + given_name]
+
+    methods = [script_variant.romanize_japanese_word,
+               script_variant.romanize_word_by_unidecode,
+               script_variant.romanize_search_query]
+    print '%d records with names from a Zipf distribution over %d words' % (
+        NUM_NAMES, VOCABULARY_SIZE)
+    print '%-40s %13s %13s' % ('', 'uncached', 'cached')
+    for method in methods:
+        def uncached():
+            for name in names:
+                method.uncached(name)
+
+        def cached():
+            method.cache.clear()
+            for name in names:
+                method(name)
+
+        benchmarks.report(method.__name__, benchmarks.measure(uncached, 3),
+                          benchmarks.measure(cached, 3))
+    for stats in script_variant.get_romanization_cache_stats():
+        lookups = stats['hit_count'] + stats['miss_count']
+        print '%-40s hit rate %.1f%%' % (
+            stats['name'], 100.0 * stats['hit_count'] / max(lookups, 1))
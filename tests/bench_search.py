@@ -0,0 +1,72 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for indexing.search: datastore filters vs. the inverted index."""
+
+import datetime
+import random
+
+from google.appengine.ext import db
+
+import benchmarks
+import config
+import indexing
+import jautils
+import model
+from text_query import TextQuery
+
+REPO = 'bench'
+NUM_PERSONS = 2000
+
+# Popular name characters, so that queries share many postings.
+NAME_CHARS = sorted(jautils.NAME_CHAR_POPULARITY_MAP.keys())[:60]
+
+
+def create_persons(rand):
+    persons = []
+    for i in xrange(NUM_PERSONS):
+        family_name = u''.join(rand.choice(NAME_CHARS) for j in xrange(3))
+        given_name = u''.join(rand.choice(NAME_CHARS) for j in xrange(3))
+        person = model.Person.create_original(
+            REPO, given_name=given_name, family_name=family_name,
+            full_name=family_name + u' ' + given_name,
+            entry_date=datetime.datetime.utcnow())
+        indexing.update_index_properties(person)
+        persons.append(person)
+    db.put(persons)
+    return persons
+
+
+def run():
+    rand = random.Random(0)
+    persons = create_persons(rand)
+    print '%d persons, times are medians per query' % NUM_PERSONS
+    print '%-40s %13s %13s' % ('', 'datastore', 'inverted')
+    for num_words in [2, 4, 6]:
+        sample = rand.sample(persons, 10)
+        queries = [(p.family_name + p.given_name)[:num_words] for p in sample]
+
+        def search_all():
+            for query in queries:
+                indexing.search(REPO, TextQuery(query), 100)
+
+        config.set_for_repo(REPO, enable_inverted_index=False)
+        before = benchmarks.measure(search_all, 5) / len(queries)
+        config.set_for_repo(REPO, enable_inverted_index=True)
+        search_all()  # Builds the index outside the measurement.
+        after = benchmarks.measure(search_all, 5) / len(queries)
+        benchmarks.report('%d-word CJK query' % num_words, before, after)
+    config.set_for_repo(REPO, enable_inverted_index=False)
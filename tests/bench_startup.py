@@ -0,0 +1,67 @@
+#!/usr/bin/python2.7
+# encoding: utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark for the cold-start cost of each action: the wall time to
+import main and the action's handler module in a fresh Python process, and
+which of the search-only modules that pulls in."""
+
+import subprocess
+import sys
+
+import main
+
+# Modules that only search and indexing need.  Other actions shouldn't
+# have to load them.
+SEARCH_MODULES = ['external_search', 'full_text_search', 'indexing',
+                  'jautils', 'script_variant', 'text_query', 'unidecode']
+
+COLD_START_SCRIPT = '''
+import sys, time
+start = time.time()
+import main
+__import__(sys.argv[1])
+print (time.time() - start) * 1000
+print ' '.join(name for name in sys.argv[2:] if name in sys.modules)
+'''
+
+REPEAT = 3
+
+
+def cold_start(module_name):
+    """Imports main and the given module in REPEAT fresh processes.  Returns
+    the median time in milliseconds and the search modules that got
+    loaded."""
+    times = []
+    for i in xrange(REPEAT):
+        output = subprocess.check_output(
+            [sys.executable, '-c', COLD_START_SCRIPT, module_name] +
+            SEARCH_MODULES)
+        elapsed, loaded = (output.split('\n') + [''])[:2]
+        times.append(float(elapsed))
+    times.sort()
+    return times[len(times) // 2], loaded
+
+
+def run():
+    actions_by_module = {}
+    for action, handler in main.HANDLER_CLASSES.items():
+        module_name = handler.split('.')[0]
+        actions_by_module.setdefault(module_name, []).append(action or '/')
+    print '%-24s %10s  %s' % ('module', 'cold start', 'search modules loaded')
+    for module_name in sorted(actions_by_module):
+        elapsed, loaded = cold_start(module_name)
+        print '%-24s %7.1f ms  %s' % (module_name, elapsed, loaded or '-')
+        print '    %s' % ', '.join(sorted(actions_by_module[module_name]))
@@ -0,0 +1,70 @@
+#!/usr/bin/python2.7
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs the benchmarks in tests/bench_*.py, with stubs for the App Engine APIs.
+
+Each benchmark module defines a run() function that prints its own report.
+Instead of running this script directly, use the 'benchmarks' shell script,
+which sets up the PYTHONPATH and other necessary environment variables."""
+
+import glob
+import os
+import sys
+import time
+
+from google.appengine.ext import testbed
+
+
+def measure(function, repeat=20):
+    """Calls function() 'repeat' times and returns the median wall time of a
+    single call, in milliseconds."""
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def report(label, before_ms, after_ms):
+    """Prints one line comparing two timings."""
+    print '%-40s %10.3f ms %10.3f ms %7.1fx' % (
+        label, before_ms, after_ms, before_ms / max(after_ms, 1e-6))
+
+
+def main(names):
+    tb = testbed.Testbed()
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_search_stub()
+    tb.init_taskqueue_stub()
+
+    # Benchmarks run with the app directory as the working directory, like
+    # the appserver (e.g. so the dictionary files can be found).
+    os.chdir(os.environ['APP_DIR'])
+    if not names:
+        names = sorted(os.path.basename(path)[:-3] for path in glob.glob(
+            os.path.join(os.environ['TESTS_DIR'], 'bench_*.py')))
+    for name in names:
+        print
+        print '--- %s' % name
+        __import__(name).run()
+    tb.deactivate()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
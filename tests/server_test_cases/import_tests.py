@@ -247,6 +247,26 @@ class ImportTests(ServerTestsBase):
         assert note.source_date == datetime.datetime(2013, 2, 26, 9, 10, 0)
         self.verify_api_log(ApiActionLog.WRITE, person_records=1, note_records=1)
 
+    def test_import_note_before_person_in_later_batch(self):
+        """Verifies a Note entry is imported when its Person entry is in a
+        later batch of rows."""
+        self._write_csv_file([
+            'person_record_id,full_name,source_date,note_record_id,author_name',
+            'test.google.com/person100,,2013-02-26T09:10:00Z,' +
+            'test.google.com/note1,_test_author_name',
+            ] + [
+            'test.google.com/person%d,_test_full_name,2013-02-26T09:10:00Z,,'
+            % i for i in range(101)
+            ])
+        doc = self.go('/haiti/api/import')
+        form = doc.last('form')
+        doc = self.s.submit(form, key='test_key', content=open(self.filename))
+        assert 'Person records Imported 101 of 101' in re.sub(
+            '\\s+', ' ', doc.text)
+        assert 'Note records Imported 1 of 1' in re.sub('\\s+', ' ', doc.text)
+        note = Note.all().get()
+        assert note.person_record_id == 'test.google.com/person100'
+
     def test_import_note_for_non_existent_person(self):
         """Verifies a Note entry is not imported if it points to a non-existent
         person_record_id."""
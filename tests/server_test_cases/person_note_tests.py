@@ -3157,6 +3157,31 @@ _feed_profile_url2</pfif:profile_urls>
                       'min_entry_date=2000-01-01T03:03:04Z')
         assert_ids(4, 5, 6, 7, 8, 9, 10, 11, 12, 13)
 
+    def test_person_feed_next_link(self):
+        """Follow the next page links in the person feed."""
+        db.put([Person(
+            key_name='haiti:test.google.com/person.%d' % i,
+            repo='haiti',
+            entry_date=datetime.datetime(2000, 1, 1, 1, 1, 1),
+            full_name='_test_full_name.%d' % i,
+        ) for i in range(1, 8)])  # Create 7 persons with the same entry_date.
+
+        ids = []
+        doc = self.go('/haiti/feeds/person?max_results=3' +
+                      '&min_entry_date=2000-01-01T01:01:01Z')
+        while True:
+            ids += re.findall(r'record_id>test.google.com/person.(\d+)',
+                              doc.content)
+            match = re.search(r'<link rel="next">([^<]*)</link>', doc.content)
+            if not match:
+                break
+            doc = self.s.go(match.group(1).replace('&amp;', '&'))
+        assert sorted(map(int, ids)) == range(1, 8)
+
+        # A malformed cursor is rejected.
+        doc = self.go('/haiti/feeds/person?cursor=xyz')
+        assert self.s.status == 400
+
     def test_note_feed_parameters(self):
         """Test the max_results, skip, min_entry_date, and person_record_id
         parameters."""
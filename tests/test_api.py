@@ -58,3 +58,11 @@ class APITests(unittest.TestCase):
             home_state='California',
             entry_date=datetime.datetime(2010, 1, 1))
         assert handler.render_person(person) == 'John Smith / From: California'
+
+    def test_generate_lines(self):
+        text = 'a,b\r\nc\rd\n\ne,"f"\r\ng'
+        for size in [1, 2, 3, 5, len(text)]:
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            assert list(api.generate_lines(chunks)) == text.splitlines()
+        assert list(api.generate_lines([])) == []
+        assert list(api.generate_lines(['a\r', '\n'])) == ['a']
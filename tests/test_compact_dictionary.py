@@ -0,0 +1,97 @@
+# coding:utf-8
+# Copyright 2016 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for compact_dictionary.py"""
+
+import os
+import StringIO
+import unittest
+
+import compact_dictionary
+import script_variant
+
+
+def make_compact_dictionary(dictionary):
+    f = StringIO.StringIO()
+    compact_dictionary.write(dictionary, f)
+    return compact_dictionary.CompactDictionary(f.getvalue())
+
+
+class CompactDictionaryTests(unittest.TestCase):
+
+    def test_lookup(self):
+        dictionary = make_compact_dictionary({
+            u'東京': [u'とうきょう'],
+            u'春香': [u'はるか', u'しゅんか'],
+            u'a': [u'b'],
+            u'ab': [],
+            u'\U00020b9f': [u'しかる'],
+        })
+        assert len(dictionary) == 5
+        assert dictionary[u'春香'] == set([u'はるか', u'しゅんか'])
+        assert dictionary.get(u'東京') == set([u'とうきょう'])
+        assert dictionary[u'\U00020b9f'] == set([u'しかる'])
+        assert u'a' in dictionary
+        assert dictionary[u'ab'] == set()
+        assert u'0' not in dictionary
+        assert u'東' not in dictionary
+        assert u'東京都' not in dictionary
+        assert u'' not in dictionary
+        assert dictionary.get(u'大阪') is None
+        self.assertRaises(KeyError, lambda: dictionary[u'大阪'])
+        assert list(dictionary) == [u'a', u'ab', u'春香', u'東京', u'\U00020b9f']
+
+    def test_blocks(self):
+        words = [u'%04d' % i for i in xrange(1000)]
+        dictionary = make_compact_dictionary(
+            dict((word, [word + u'!']) for word in words[::2]))
+        assert len(dictionary.block_keys) > 1
+        for i, word in enumerate(words):
+            assert (word in dictionary) == (i % 2 == 0)
+        assert list(dictionary) == words[::2]
+
+    def test_empty(self):
+        dictionary = make_compact_dictionary({})
+        assert len(dictionary) == 0
+        assert u'東京' not in dictionary
+        assert list(dictionary) == []
+
+    def test_bad_file(self):
+        self.assertRaises(compact_dictionary.FormatError,
+                          compact_dictionary.CompactDictionary, '')
+        self.assertRaises(compact_dictionary.FormatError,
+                          compact_dictionary.CompactDictionary,
+                          'NOTADICT\0\0\0\0\0\0\0\0')
+        f = StringIO.StringIO()
+        compact_dictionary.write({u'東京': [u'とうきょう']}, f)
+        self.assertRaises(compact_dictionary.FormatError,
+                          compact_dictionary.CompactDictionary,
+                          f.getvalue()[:-1])
+
+    def test_japanese_name_location_dict_is_up_to_date(self):
+        # japanese_name_location_dict.bin must be regenerated with
+        # tools/make_dictionary_file.py whenever the .txt file changes.
+        app_dir = os.path.dirname(script_variant.__file__)
+        expected = script_variant.read_dictionary(
+            os.path.join(app_dir, 'japanese_name_location_dict.txt'))
+        dictionary = compact_dictionary.load(
+            os.path.join(app_dir, 'japanese_name_location_dict.bin'))
+        assert len(dictionary) == len(expected)
+        for kanji, yomigana in expected.iteritems():
+            assert dictionary[kanji] == yomigana, kanji
+
+
+if __name__ == '__main__':
+    unittest.main()
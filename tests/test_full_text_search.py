@@ -354,3 +354,12 @@ class FullTextSearchTests(unittest.TestCase):
         full_text_search.delete_record_from_index(self.p4)
         results = full_text_search.search('haiti', 'Miki', 5)
         assert not results
+
+    def test_add_records_to_index(self):
+        persons = [self.p1, self.p2, self.p4, self.p8]
+        db.put(persons)
+        assert full_text_search.add_records_to_index(persons) == []
+        results = full_text_search.search('haiti', 'Miki', 5)
+        assert set([r.record_id for r in results]) == set(['haiti/1123'])
+        results = full_text_search.search('haiti', u'三浦', 5)
+        assert set([r.record_id for r in results]) == set(['haiti/0719'])
@@ -17,6 +17,7 @@
 import datetime
 import unittest
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import db
 from pytest import raises
 
@@ -205,6 +206,46 @@ class ImporterTests(unittest.TestCase):
         # Also confirm that 15 records were put into the datastore.
         assert model.Person.all().count() == 15
 
+    def test_import_records_reserves_ids_at_once(self):
+        # Records without a person_record_id become new original records,
+        # and their IDs are reserved for the whole batch in one call.
+        records = [{'given_name': 'given_name_%d' % i,
+                    'family_name': 'family_name_%d' % i,
+                    'source_date': '2010-01-01T01:23:45Z'}
+                   for i in range(5)]
+        sizes = []
+        allocate_ids = db.allocate_ids
+        def record_allocate_ids(model_key, size):
+            sizes.append(size)
+            return allocate_ids(model_key, size)
+
+        block_size = model.UniqueId.BLOCK_SIZE
+        model.UniqueId.BLOCK_SIZE = 3
+        model.UniqueId.next_id = model.UniqueId.end_id = 0
+        db.allocate_ids = record_allocate_ids
+        try:
+            importer.import_records(
+                'haiti', 'test_domain', importer.create_person, records)
+        finally:
+            db.allocate_ids = allocate_ids
+            model.UniqueId.BLOCK_SIZE = block_size
+        assert sizes == [5]
+
+    def test_import_records_from_generator(self):
+        # import_records reads through the records more than once, so a
+        # generator (as tools/import.py passes) must still be imported fully.
+        records = ({'given_name': 'given_name_%d' % i,
+                    'family_name': 'family_name_%d' % i,
+                    'person_record_id': 'test_domain/%d' % i,
+                    'source_date': '2010-01-01T01:23:45Z'}
+                   for i in range(3))
+        written, skipped, total = importer.import_records(
+            'haiti', 'test_domain', importer.create_person, records)
+        assert written == 3
+        assert skipped == []
+        assert total == 3
+        assert model.Person.all().count() == 3
+
     def test_import_note_records(self):
         # Prepare person records which the notes will be added to.
         for domain in ['test_domain', 'other_domain']:
@@ -458,5 +499,62 @@ class ImporterTests(unittest.TestCase):
         assert total == 1
         assert model.Note.all().count() == 0
 
+    def test_import_duplicate_note_records(self):
+        put_dummy_person_record('haiti', 'test_domain/person_1')
+        def make_record(note_id, text):
+            return {'person_record_id': 'test_domain/person_1',
+                    'note_record_id': 'test_domain/' + note_id,
+                    'source_date': '2010-01-01T01:23:45Z',
+                    'text': text}
+
+        importer.import_records(
+            'haiti', 'test_domain', importer.create_note,
+            [make_record('record_1', 'one')], False, True, None)
+        written, skipped, total = importer.import_records(
+            'haiti', 'test_domain', importer.create_note,
+            [make_record('record_2', 'one'), make_record('record_3', 'two')],
+            False, True, None, omit_duplicate_notes=True)
+
+        assert written == 1
+        assert skipped == [('This is a duplicate of an existing note',
+                            make_record('record_2', 'one'))]
+        assert model.Note.all().count() == 2
+
+    def test_put_batches_retries_transient_errors(self):
+        class FakePut(object):
+            def __init__(self, error):
+                self.error = error
+            def get_keys(self):
+                if self.error:
+                    raise self.error
+            def update_counts(self):
+                counted.append(self)
+
+        # The first attempt at each batch times out; 'bad' fails for good.
+        errors = {'a': [datastore_errors.Timeout()],
+                  'b': [datastore_errors.Timeout()],
+                  'bad': [datastore_errors.BadRequestError()]}
+        def put_and_count_async(batch):
+            return FakePut(errors[batch[0]] and errors[batch[0]].pop())
+
+        stored = []
+        counted = []
+        put_and_count_async_original = importer.put_and_count_async
+        put_retry_delay = importer.PUT_RETRY_DELAY
+        importer.put_and_count_async = put_and_count_async
+        importer.PUT_RETRY_DELAY = 0
+        try:
+            written, latencies = importer.put_batches(
+                [['a', 'a'], ['bad'], ['b']], stored.append)
+        finally:
+            importer.put_and_count_async = put_and_count_async_original
+            importer.PUT_RETRY_DELAY = put_retry_delay
+        assert written == 3
+        assert len(latencies) == 2
+        assert sorted(stored) == [['a', 'a'], ['b']]
+        assert len(counted) == 2
+        assert errors == {'a': [], 'b': [], 'bad': []}
+
+
 if __name__ == "__main__":
     unittest.main()
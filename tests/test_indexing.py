@@ -7,7 +7,9 @@
 
 __author__ = 'eyalf@google.com (Eyal Fink)'
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
+import config
 import datetime
 import indexing
 import logging
@@ -27,13 +29,14 @@ def create_person(given_name, family_name):
 class IndexingTests(unittest.TestCase):
     def setUp(self):
         db.delete(model.Person.all())
+        memcache.flush_all()
 
     def tearDown(self):
         db.delete(model.Person.all())
 
     def add_persons(self, *persons):
         for p in persons:
-            indexing.update_index_properties(p)
+            indexing.update_index_properties(p, token_stats=True)
             db.put(p)
 
     def get_matches(self, query, limit=100):
@@ -71,6 +74,19 @@ class IndexingTests(unittest.TestCase):
         assert ['%s %s'%(p.given_name, p.family_name) for p in sorted] == \
             ['abc efg', 'ABC EFG', 'ABC efghij']
 
+    def test_rank_and_order_with_ranking_names(self):
+        res = [create_person(given_name='Bryan', family_name='abcef'),
+               create_person(given_name='Bryan abc', family_name='efg'),
+               create_person(given_name='abc', family_name='Bryan'),
+               create_person(given_name='Bryan', family_name='abc')]
+        for p in res:
+            indexing.update_index_properties(p)
+        assert res[1].ranking_names == ['BRYAN ABC', 'EFG', 'BRYAN ABC EFG', '']
+
+        sorted = indexing.rank_and_order(res, TextQuery('Bryan abc'), 100)
+        assert ['%s %s'%(p.given_name, p.family_name) for p in sorted] == \
+            ['Bryan abc', 'abc Bryan', 'Bryan abc efg', 'Bryan abcef']
+
     def test_cjk_ranking_1(self):
         # This is Jackie Chan's Chinese name.  His family name is CHAN and given
         # name is KONG + SANG; the usual Chinese order is CHAN + KONG + SANG.
@@ -149,6 +165,69 @@ class IndexingTests(unittest.TestCase):
         assert indexing.sort_query_words(
             ['CCC', 'BB', 'AA', 'A']) == ['CCC', 'AA', 'BB', 'A']
 
+    def test_sort_query_words_with_token_stats(self):
+        token_stats = indexing.TokenStats(
+            1000, {'AAA': 500, 'BB': 3, 'CC': 20})
+        # Sorted by document frequency, with unknown words first.
+        assert indexing.sort_query_words(
+            ['AAA', 'BB', 'CC', 'DD'], token_stats) == ['DD', 'BB', 'CC', 'AAA']
+        # Without statistics, the old heuristics apply.
+        assert indexing.sort_query_words(
+            ['AAA', 'BB', 'CC', 'DD'], None) == ['AAA', 'BB', 'CC', 'DD']
+
+    def test_token_stats(self):
+        indexing.TokenStats.MIN_DOCUMENTS, min_documents = (
+            1, indexing.TokenStats.MIN_DOCUMENTS)
+        try:
+            persons = [create_person(given_name='Bryan', family_name='abc'),
+                       create_person(given_name='Bryan', family_name='efg')]
+            self.add_persons(*persons)
+            token_stats = indexing.TokenStats.load(
+                'test', ['BRYAN', 'AB', 'EFG', 'XYZ'])
+            assert token_stats.documents == 2
+            assert token_stats.frequencies == {'BRYAN': 2, 'AB': 1, 'EFG': 1}
+            assert indexing.TokenStats.load('other', ['BRYAN']) is None
+
+            # Re-indexing only counts the tokens that changed.
+            persons[1].family_name = 'abd'
+            indexing.update_index_properties(persons[1], token_stats=True)
+            indexing.update_index_properties(persons[1], token_stats=True)
+            token_stats = indexing.TokenStats.load('test', ['AB', 'EFG'])
+            assert token_stats.documents == 2
+            assert token_stats.frequencies == {'AB': 2, 'EFG': 0}
+
+            # Deleting a Person removes its tokens.
+            persons[1].delete_related_entities(delete_self=True)
+            token_stats = indexing.TokenStats.load('test', ['BRYAN', 'AB'])
+            assert token_stats.documents == 1
+            assert token_stats.frequencies == {'BRYAN': 1, 'AB': 1}
+
+            # Batches are counted in one go.
+            model.Person.update_indexes(
+                [create_person(given_name='Bryan', family_name='xyz'),
+                 create_person(given_name='Ann', family_name='xyz')], ['new'])
+            token_stats = indexing.TokenStats.load('test', ['BRYAN', 'XYZ'])
+            assert token_stats.documents == 3
+            assert token_stats.frequencies == {'BRYAN': 2, 'XYZ': 2}
+        finally:
+            indexing.TokenStats.MIN_DOCUMENTS = min_documents
+
+    def test_search_skips_common_words(self):
+        indexing.TokenStats.MIN_DOCUMENTS, min_documents = (
+            1, indexing.TokenStats.MIN_DOCUMENTS)
+        try:
+            self.add_persons(
+                create_person(given_name='Bryan', family_name='abc'),
+                create_person(given_name='Bryan', family_name='efg'),
+                create_person(given_name='Bryan', family_name='hij'))
+            # BRYAN is in every Person, so it isn't used as a filter, but the
+            # results must still match it.
+            assert self.get_matches('Bryan efg') == [('Bryan', 'efg')]
+            assert self.get_matches('efg') == [('Bryan', 'efg')]
+            assert self.get_matches('Ann efg') == []
+        finally:
+            indexing.TokenStats.MIN_DOCUMENTS = min_documents
+
     def test_search(self):
         persons = [create_person(given_name='Bryan', family_name='abc'),
                    create_person(given_name='Bryan', family_name='abcef'),
@@ -240,6 +319,84 @@ class IndexingTests(unittest.TestCase):
         # Regression test (this used to throw an exception).
         assert indexing.search('test', TextQuery(''), 100) == []
 
+    def test_inverted_index(self):
+        config.set_for_repo('test', enable_inverted_index=True)
+        indexing._inverted_indexes.clear()
+        try:
+            self.add_persons(
+                create_person(given_name=u'\u5609\u5e73',
+                              family_name=u'\u4f59'),
+                create_person(given_name=u'\u6d9b\u5e73',
+                              family_name=u'\u80e1'),
+            )
+            assert self.get_matches(u'\u5e73') == [
+                (u'\u5609\u5e73', u'\u4f59'),
+                (u'\u6d9b\u5e73', u'\u80e1')
+            ]
+            assert self.get_matches(u'\u4f59\u5609\u5e73') == \
+                [(u'\u5609\u5e73', u'\u4f59')]
+            assert self.get_matches(u'\u4f59\u6d9b') == []
+
+            # A Person written after the index was built is found through
+            # update_index().
+            person = create_person(given_name=u'\u5609', family_name=u'\u80e1')
+            person.update_index(['new'])
+            db.put(person)
+            assert self.get_matches(u'\u80e1\u5609') == \
+                [(u'\u5609', u'\u80e1')]
+
+            # An expired Person drops out of the index on the next sync.
+            person.is_expired = True
+            db.put(person)
+            assert self.get_matches(u'\u80e1\u5609') == []
+        finally:
+            config.set_for_repo('test', enable_inverted_index=False)
+            indexing._inverted_indexes.clear()
+
+    def test_inverted_index_lookup(self):
+        index = indexing.InvertedIndex('test')
+        persons = [create_person(given_name='Bryan', family_name='abc'),
+                   create_person(given_name='Bryan', family_name='efg')]
+        for p in persons:
+            indexing.update_index_properties(p)
+            index.add(p)
+        assert index.lookup(['BRYAN'], 10) == sorted(
+            p.record_id for p in persons)
+        assert index.lookup(['BRYAN', 'EF'], 10) == [persons[1].record_id]
+        assert index.lookup(['BRYAN', 'XYZ'], 10) == []
+        index.remove(persons[1].record_id)
+        assert index.lookup(['EF'], 10) == []
+        assert 'EF' not in index.postings
+
+    def test_inverted_index_sync_in_batches(self):
+        persons = [create_person(given_name='Bryan', family_name=name)
+                   for name in ['abc', 'efg', 'hij']]
+        self.add_persons(*persons)
+        index = indexing.InvertedIndex('test')
+        index.SYNC_BATCH_SIZE = 1
+        index.sync(max_batches=2)
+        assert not index.complete
+        assert len(index.lookup(['BRYAN'])) == 2
+        index.sync(max_batches=2)
+        assert index.complete
+        assert len(index.lookup(['BRYAN'])) == 3
+
+    def test_search_inverted_index(self):
+        persons = [create_person(given_name='Bryan', family_name=name)
+                   for name in ['abc', 'efg', 'hij']]
+        self.add_persons(*persons)
+        index = indexing.InvertedIndex('test')
+        index.sync()
+
+        # A Person deleted elsewhere is dropped from the index, and doesn't
+        # count against the fetch limit.
+        deleted_id = sorted(p.record_id for p in persons)[0]
+        db.delete([p for p in persons if p.record_id == deleted_id])
+        found = indexing.search_inverted_index(index, ['BRYAN'], 2)
+        assert len(found) == 2
+        assert deleted_id not in [p.record_id for p in found]
+        assert deleted_id not in index.tokens
+
 
 if __name__ == '__main__':
     logging.basicConfig( stream=sys.stderr )
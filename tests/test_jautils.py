@@ -8,9 +8,48 @@
 __author__ = 'ryok@google.com (Ryo Kawaguchi)'
 
 import jautils
+import os
+import re
 import unittest
 
 
+def reference_hiragana_to_romaji(string):
+    """The original implementation of jautils.hiragana_to_romaji, which scans
+    the whole table at each position.  The optimized one must match it."""
+    remaining = string
+    result = u''
+    while remaining:
+        longest = 0
+        longest_data = None
+        for (hira, rom, next) in jautils.HIRAGANA_TO_ROMAJI:
+            if remaining.startswith(hira) and len(hira) > longest:
+                longest_data = (hira, rom, next)
+                longest = len(hira)
+        if longest == 0:
+            # erroneous info
+            result += remaining[0]
+            remaining = remaining[1:]
+        else:
+            result += longest_data[1]
+            remaining = longest_data[2] + remaining[len(longest_data[0]):]
+    for (pat, rep) in jautils.HIRAGANA_TO_ROMAJI_POST_PROCESS:
+        result = re.sub(pat, rep, result)
+    return result
+
+
+def read_dictionary_readings(step=1):
+    """Returns every step-th hiragana reading in the name/location dictionary
+    (the test corpus for hiragana_to_romaji)."""
+    path = os.path.join(os.path.dirname(jautils.__file__),
+                        'japanese_name_location_dict.txt')
+    readings = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if i % step == 0:
+                readings.append(line.rstrip('\n').split('\t')[1].decode('utf-8'))
+    return readings
+
+
 class JaUtilsTests(unittest.TestCase):
     def test_should_normalize(self):
         assert jautils.should_normalize(u'abc') == False
@@ -85,6 +124,15 @@ class JaUtilsTests(unittest.TestCase):
         assert jautils.hiragana_to_romaji(
             u'ひらがな カタカナ') == u'HIRAGANA カタカナ'
 
+    def test_hiragana_to_romaji_matches_reference(self):
+        words = [u'おおの', u'こうのう', u'おうう', u'ああああ', u'っう゛ぁ',
+                 u'うぉっち', u'ゔぃっき', u'ちぇっく', u'AAOU', u'んーあ']
+        words += [hira for (hira, rom, next) in jautils.HIRAGANA_TO_ROMAJI]
+        words += read_dictionary_readings(step=50)
+        for word in words:
+            assert jautils.hiragana_to_romaji(word) == \
+                reference_hiragana_to_romaji(word), word
+
     def test_get_additional_tokens(self):
         assert jautils.get_additional_tokens([u'ABC']) == set()
         assert jautils.get_additional_tokens(set([u'ABC'])) == set()
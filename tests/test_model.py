@@ -15,6 +15,7 @@
 """Tests for model.py."""
 
 from datetime import datetime
+from google.appengine.api import memcache
 from google.appengine.ext import db
 import unittest
 import model
@@ -252,7 +253,16 @@ class ModelTests(unittest.TestCase):
         assert len(self.p2.get_linked_person_ids()) == \
             len(self.p2.get_linked_persons())
 
+    def build_duplicate_clusters(self):
+        notes = [self.n1_1, self.n1_2, self.n1_3, self.n2_1, self.n2_2,
+                 self.n3_1, self.n3_2]
+        model.DuplicateCluster.merge('haiti', [
+            (note.person_record_id, note.linked_person_record_id)
+            for note in notes if note.linked_person_record_id])
+
     def test_all_linked_persons(self):
+        self.build_duplicate_clusters()
+        self.to_delete += model.DuplicateCluster.all().fetch(10)
         p1_linked = self.p1.get_all_linked_persons()
         p2_linked = self.p2.get_all_linked_persons()
         p3_linked = self.p3.get_all_linked_persons()
@@ -267,6 +277,42 @@ class ModelTests(unittest.TestCase):
         assert p1_linked_ids == p2_linked_ids
         assert p1_linked_ids == p3_linked_ids
 
+    def test_duplicate_clusters(self):
+        def get_linked_ids(person):
+            return sorted(p.record_id for p in person.get_all_linked_persons())
+
+        def update_pending_clusters():
+            updates = model.PendingClusterUpdate.all().filter(
+                'repo =', 'haiti').fetch(100)
+            model.DuplicateCluster.update(
+                'haiti', [update.person_record_id for update in updates])
+            db.delete(updates)
+
+        self.build_duplicate_clusters()
+        assert get_linked_ids(self.p1) == sorted(
+            [self.p2.record_id, self.p3.record_id])
+
+        # Hiding all the links to and from p3 splits it off the cluster.
+        for note in [self.n1_3, self.n2_2, self.n3_1, self.n3_2]:
+            note = db.get(note.key())
+            note.hidden = True
+            model.put_and_count(note)
+        update_pending_clusters()
+        assert get_linked_ids(self.p1) == [self.p2.record_id]
+        assert get_linked_ids(self.p2) == [self.p1.record_id]
+        assert get_linked_ids(self.p3) == []
+
+        # Unhiding one of them joins it again.
+        note = db.get(self.n3_1.key())
+        note.hidden = False
+        model.put_and_count(note)
+        update_pending_clusters()
+        assert get_linked_ids(self.p3) == sorted(
+            [self.p1.record_id, self.p2.record_id])
+
+        self.to_delete += model.DuplicateCluster.all().fetch(10)
+        model.CounterShard.reset('haiti', 'note')
+
 
     def test_subscription(self):
         sd = 'haiti'
@@ -360,6 +406,111 @@ class ModelTests(unittest.TestCase):
         counter.increment(u'arbitrary \xef characters \u5e73 here')
         counter.put()  # without encode_count_name, this threw an exception
 
+    def test_unique_id(self):
+        block_size = model.UniqueId.BLOCK_SIZE
+        model.UniqueId.BLOCK_SIZE = 3
+        try:
+            ids = [model.UniqueId.create_id() for i in xrange(10)]
+            model.UniqueId.reserve(5)
+            ids += [model.UniqueId.create_id() for i in xrange(6)]
+            assert len(set(ids)) == len(ids)
+            # IDs handed out by this process can't be allocated again.
+            start, end = db.allocate_ids(
+                db.Key.from_path(model.UniqueId.kind(), 1), 10)
+            assert not set(ids) & set(range(start, end + 1))
+            # No entities are written.
+            assert model.UniqueId.all().count() == 0
+        finally:
+            model.UniqueId.BLOCK_SIZE = block_size
+
+    def test_live_counts(self):
+        def get_count(name):
+            memcache.flush_all()
+            return model.Counter.get_count('haiti', 'person.' + name)
+
+        person = model.Person.create_original(
+            'haiti', given_name='Live', family_name='Count', sex='female',
+            entry_date=get_utcnow())
+        model.put_and_count(person)
+        assert get_count('all') == 1
+        assert get_count('sex=female') == 1
+
+        # Changing a counted property moves the count.
+        person = model.Person.get('haiti', person.record_id)
+        person.sex = 'male'
+        model.put_and_count([person])
+        assert get_count('all') == 1
+        assert get_count('sex=female') == 0
+        assert get_count('sex=male') == 1
+
+        # Writing a clone over the stored record doesn't count it twice.
+        clone = model.Person.create_clone(
+            'haiti', person.record_id, given_name='Live', family_name='Count',
+            sex='male', entry_date=get_utcnow())
+        model.put_and_count(clone)
+        assert get_count('all') == 1
+
+        model.delete_and_count(person)
+        assert get_count('all') == 0
+        assert get_count('sex=male') == 0
+        model.CounterShard.reset('haiti', 'person')
+
+    def test_put_and_count_empty(self):
+        assert model.put_and_count([]) == []
+        assert model.put_and_count_async([]).get_result() == []
+        model.delete_and_count([])
+        assert model.PendingStatusUpdate.all().count() == 0
+
+    def test_note_review_counts(self):
+        def get_count(name):
+            memcache.flush_all()
+            return model.Counter.get_count('haiti', 'note.' + name)
+
+        note = model.Note.create_original(
+            'haiti', person_record_id=self.p1.record_id,
+            entry_date=get_utcnow())
+        model.put_and_count(note)
+        assert get_count('hidden=FALSE,reviewed=FALSE') == 1
+
+        note.reviewed = True
+        model.put_and_count(note)
+        assert get_count('hidden=FALSE,reviewed=FALSE') == 0
+        assert get_count('hidden=FALSE,reviewed=TRUE') == 1
+
+        note.hidden = True
+        model.put_and_count(note)
+        assert get_count('hidden=FALSE,reviewed=TRUE') == 0
+        assert get_count('hidden=TRUE') == 1
+
+        model.delete_and_count(note)
+        assert get_count('hidden=TRUE') == 0
+        model.CounterShard.reset('haiti', 'note')
+
+    def test_counter_shard(self):
+        model.CounterShard.apply_deltas('haiti', 'note', {'all': 2, 'x': 0})
+        model.CounterShard.apply_deltas('haiti', 'note', {'all': -1, 'y': 1})
+        assert model.CounterShard.get_deltas('haiti', 'note') == {
+            'all': 1, 'y': 1}
+        model.CounterShard.reset('haiti', 'note')
+        assert model.CounterShard.get_deltas('haiti', 'note') == {}
+
+        # A completed scan is the baseline for the live changes.  It replaces
+        # the changes made before it started, but not those made during it.
+        model.CounterShard.apply_deltas('haiti', 'note', {'all': 5})
+        counter = model.Counter.get_unfinished_or_create('haiti', 'note')
+        counter.increment('all')
+        counter.increment('all')
+        model.CounterShard.apply_deltas('haiti', 'note', {'all': 1})
+        counter.put()
+        model.CounterShard.discard_before('haiti', 'note', counter.generation)
+        memcache.flush_all()
+        assert model.Counter.get_count('haiti', 'note.all') == 3
+        model.CounterShard.reset('haiti', 'note')
+        memcache.flush_all()
+        assert model.Counter.get_count('haiti', 'note.all') == 2
+        db.delete(model.CounterShard.all(keys_only=True))
+        counter.delete()
+
 
 if __name__ == '__main__':
     unittest.main()
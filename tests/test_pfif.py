@@ -881,6 +881,13 @@ class PfifTests(unittest.TestCase):
             'description:_test_description\nsome_field: _test_some_value') == \
             'description:_test_description\nsome_field: _test_some_value'
 
+    def test_xml_escape(self):
+        """Tests xml_escape with and without characters to change."""
+        assert pfif.xml_escape(u'_test_text') == u'_test_text'
+        assert pfif.xml_escape(u'\u00e1\n\t') == u'\u00e1\n\t'
+        assert pfif.xml_escape(u'a & <b>') == u'a &amp; &lt;b&gt;'
+        assert pfif.xml_escape(u'a\x00b\x0bc\ufffe') == u'abc'
+
     def test_parse_strings(self):
         """Tests XML parsing for each test case."""
         for test_name, test_case in TEST_CASES:
@@ -905,6 +912,26 @@ class PfifTests(unittest.TestCase):
             assert note_records == test_case.note_records, (test_name +
                 ':\n' + pprint_diff(test_case.note_records, note_records))
 
+    def test_parse_file_in_batches(self):
+        """Tests that parsing in batches gives the same records as
+        parse_file, in batches of the requested size."""
+        for test_name, test_case in TEST_CASES:
+            if not test_case.do_parse_test:
+                continue
+            for batch_size in [1, 2, 3]:
+                person_records, note_records = [], []
+                for persons, notes in pfif.parse_file_in_batches(
+                    StringIO.StringIO(test_case.xml), batch_size=batch_size):
+                    assert 0 < len(persons) + len(notes) <= batch_size
+                    person_records += persons
+                    note_records += notes
+                assert person_records == test_case.person_records, (
+                    test_name + ':\n' + pprint_diff(
+                        test_case.person_records, person_records))
+                assert note_records == test_case.note_records, (
+                    test_name + ':\n' + pprint_diff(
+                        test_case.note_records, note_records))
+
     def test_write_file(self):
         """Tests writing of XML files for each test case."""
         for test_name, test_case in TEST_CASES:
@@ -44,3 +44,34 @@ class ScriptVariantTests(unittest.TestCase):
         assert u'TENKAI' in results
         # Chinese romanization.
         assert u'Tian Hai' in results
+
+    def test_romanization_cache(self):
+        cache = script_variant.romanize_japanese_word.cache
+        cache.clear()
+        hit_count = cache.hit_count
+        miss_count = cache.miss_count
+        results = script_variant.romanize_japanese_word(u'雪歩')
+        assert cache.miss_count == miss_count + 1
+        # Modifying the returned list doesn't affect the cached value.
+        results.append(u'XXX')
+        assert script_variant.romanize_japanese_word(u'雪歩') == results[:-1]
+        assert cache.hit_count == hit_count + 1
+        # for_index is part of the cache key.
+        script_variant.romanize_japanese_word(u'雪歩', for_index=False)
+        assert cache.miss_count == miss_count + 2
+        # The method name is kept, since it names the full-text search fields.
+        assert script_variant.romanize_japanese_word.__name__ == (
+            'romanize_japanese_word')
+
+    def test_lru_cache(self):
+        cache = script_variant.LruCache('test', 2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert cache.get('a') == 1
+        cache.put('c', 3)  # Evicts 'b', the least recently used.
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.stats() == {
+            'name': 'test', 'items_count': 2, 'max_items': 2,
+            'hit_count': 3, 'miss_count': 1, 'evict_count': 1}
@@ -106,6 +106,71 @@ class TasksTests(unittest.TestCase):
             self.mox.UnsetStubs()
 
 
+    def test_count_person(self):
+        # Another Note on p1 that links to a Person that doesn't exist.
+        n1_2 = model.Note.create_original(
+            'haiti',
+            person_record_id=self.p1.record_id,
+            linked_person_record_id='haiti.personfinder.google.org/person.0',
+            entry_date=get_utcnow(),
+            source_date=datetime.datetime(2010, 1, 3))
+        db.put(n1_2)
+        self.to_delete.append(n1_2)
+
+        self.initialize_handler(tasks.CountPerson).get()
+        self.to_delete += model.Counter.all().fetch(10)
+        get_count = lambda name: model.Counter.get_count('haiti', name)
+        assert get_count('person.all') == 2
+        assert get_count('person.num_notes=0') == 1  # p2
+        assert get_count('person.num_notes=2') == 1  # p1
+        assert get_count('person.linked_persons=0') == 1  # p2
+        assert get_count('person.linked_persons=1') == 1  # p1
+
+    def test_update_pending_status(self):
+        def run_update_pending_status_task():
+            self.initialize_handler(tasks.UpdatePendingStatus).get()
+            return db.get(self.key_p1).latest_status
+
+        # A PendingStatusUpdate is kept until it has settled.
+        note = db.get(self.n1_1.key())
+        note.hidden = True
+        model.put_and_count(note)
+        assert run_update_pending_status_task() is None
+        assert model.PendingStatusUpdate.all().count() == 1
+        note.hidden = False
+        model.put_and_count(note)
+        assert run_update_pending_status_task() == 'believed_missing'
+
+        pending_update_delay = tasks.PENDING_UPDATE_DELAY
+        tasks.PENDING_UPDATE_DELAY = datetime.timedelta(0)
+        try:
+            self.initialize_handler(tasks.UpdatePendingStatus).get()
+
+            self.p1.latest_status = 'believed_missing'
+            db.put(self.p1)
+
+            # Nothing has changed, so nothing is updated.
+            assert model.PendingStatusUpdate.all().count() == 0
+            assert run_update_pending_status_task() == 'believed_missing'
+
+            # Hiding the Note with the status leaves the Person with no status.
+            note = db.get(self.n1_1.key())
+            note.hidden = True
+            model.put_and_count(note)
+            assert model.PendingStatusUpdate.all().count() == 1
+            assert run_update_pending_status_task() is None
+            assert model.PendingStatusUpdate.all().count() == 0
+
+            # Unhiding it restores the status.
+            note.hidden = False
+            model.put_and_count(note)
+            assert run_update_pending_status_task() == 'believed_missing'
+        finally:
+            tasks.PENDING_UPDATE_DELAY = pending_update_delay
+        self.to_delete += model.PendingClusterUpdate.all().fetch(10)
+        model.CounterShard.reset('haiti', 'note')
+        model.CounterShard.reset('haiti', 'person')
+
     def test_delete_expired(self):
         """Test the flagging and deletion of expired records."""
 
@@ -167,36 +232,41 @@ class TasksTests(unittest.TestCase):
         assert model.Note.get('haiti', self.note_id)
         assert db.get(self.photo_key)
 
+        # The deletion notices are queued up in one batch.
         self.mox = mox.Mox()
-        self.mox.StubOutWithMock(taskqueue, 'add')
-        taskqueue.add(queue_name='send-mail',
-                      url='/global/admin/send_mail',
-                      params=mox.IsA(dict))
+        self.mox.StubOutWithMock(taskqueue, 'Queue', use_mock_anything=True)
+        queue = self.mox.CreateMockAnything()
+        taskqueue.Queue('send-mail').AndReturn(queue)
+        queue.add(mox.Func(lambda tasks: [task.url for task in tasks] ==
+                           ['/global/admin/send_mail']))
         self.mox.ReplayAll()
         run_delete_expired_task()
         self.mox.VerifyAll()
+        self.mox.UnsetStubs()
 
-        # Confirm that DeleteExpired set is_expired and updated the timestamps
-        # on self.p1, but did not wipe its fields or delete the Note or Photo.
+        # Confirm that DeleteExpired set is_expired, set the expiry_date to
+        # the deletion time and updated the timestamps on self.p1, but did not
+        # wipe its fields or delete the Note or Photo.
         assert model.Person.all().count() == 1
         assert_past_due_count(1)
         assert db.get(self.key_p1).source_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).entry_date == datetime.datetime(2010, 2, 2)
-        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 1)
+        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).is_expired == True
         assert model.Note.get('haiti', self.note_id) is None  # Note is hidden
         assert db.get(self.n1_1.key())  # but the Note entity still exists
         assert db.get(self.photo_key)
 
-        # Advance past the end of the expiration grace period of self.p1.
-        set_utcnow_for_test(datetime.datetime(2010, 2, 5))
+        # Advance past the end of the expiration grace period of self.p1,
+        # which starts when it was deleted.
+        set_utcnow_for_test(datetime.datetime(2010, 2, 6))
 
         # Confirm that nothing has changed yet.
         assert model.Person.all().count() == 1
         assert_past_due_count(1)
         assert db.get(self.key_p1).source_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).entry_date == datetime.datetime(2010, 2, 2)
-        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 1)
+        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).is_expired == True
         assert model.Note.get('haiti', self.note_id) is None  # Note is hidden
         assert db.get(self.n1_1.key())  # but the Note entity still exists
@@ -210,7 +280,7 @@ class TasksTests(unittest.TestCase):
         assert_past_due_count(1)
         assert db.get(self.key_p1).source_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).entry_date == datetime.datetime(2010, 2, 2)
-        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 1)
+        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).is_expired == True
         assert db.get(self.key_p1).given_name is None
         assert model.Note.get('haiti', self.note_id) is None  # Note is hidden
@@ -225,7 +295,7 @@ class TasksTests(unittest.TestCase):
         assert_past_due_count(2)
         assert db.get(self.key_p1).source_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).entry_date == datetime.datetime(2010, 2, 2)
-        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 1)
+        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p2).source_date == datetime.datetime(2010, 1, 1)
         assert db.get(self.key_p2).entry_date == datetime.datetime(2010, 1, 1)
         assert db.get(self.key_p2).expiry_date == datetime.datetime(2010, 3, 1)
@@ -239,7 +309,7 @@ class TasksTests(unittest.TestCase):
         assert db.get(self.key_p1).given_name is None
         assert db.get(self.key_p1).source_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p1).entry_date == datetime.datetime(2010, 2, 2)
-        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 1)
+        assert db.get(self.key_p1).expiry_date == datetime.datetime(2010, 2, 2)
         assert db.get(self.key_p2).is_expired == True
         assert db.get(self.key_p2).given_name is None
         assert db.get(self.key_p2).source_date == datetime.datetime(2010, 3, 15)
@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Runs the unit tests, with stubs for the datastore API.
+"""Runs the unit tests, with stubs for the datastore and memcache APIs.
 
 Instead of running this script directly, use the 'unit_tests' shell script,
 which sets up the PYTHONPATH and other necessary environment variables."""
@@ -24,11 +24,14 @@ import sys
 
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
 
 # Create a new apiproxy and temp datastore to use for this test suite
 apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
 temp_db = datastore_file_stub.DatastoreFileStub('x', None, None, trusted=True)
 apiproxy_stub_map.apiproxy.RegisterStub('datastore', temp_db)
+apiproxy_stub_map.apiproxy.RegisterStub(
+    'memcache', memcache_stub.MemcacheServiceStub())
 
 # An application id is required to access the datastore, so let's create one
 os.environ['APPLICATION_ID'] = 'personfinder-unittest'
@@ -57,10 +57,10 @@ class Mapper(object):
                 to_put.extend(map_updates)
                 to_delete.extend(map_deletes)
             if to_put:
-                db.put(to_put)
+                put_and_count(to_put)
                 logging.info('entities written: %d' % len(to_put))
             if to_delete:
-                db.delete(to_delete)
+                delete_and_count(to_delete)
                 logging.info('entities deleted: %d' % len(to_delete))
             q = self.get_query()
             q.filter("__key__ >", entities[-1].key())
@@ -72,7 +72,7 @@ class Reindexer(Mapper):
     def map(self, entity):
         # This updates both old and new index and we need it for now,
         # as first stage of deployment.
-        entity.update_index(['old','new'])
+        entity.update_index(['old','new'], token_stats=True)
         # Use the next line to index only with new index
         #indexing.update_index_properties(entity)
         return [entity], []
@@ -98,7 +98,7 @@ def expand_id(repo, id):
 def clear_found(id):
     person = get_person(id)
     person.found = False
-    db.put(person)
+    put_and_count(person)
 
 def get_person(repo, id):
     return Person.get(repo, expand_id(repo, id))
@@ -21,8 +21,10 @@ import csv
 import optparse
 import os
 import re
+import StringIO
 import sys
 import time
+import xml.sax.saxutils
 
 # This script is in a tools directory below the root project directory.
 TOOLS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -117,22 +119,30 @@ writers = {
 }
 
 
+# Matches the link to the next page of a Person Finder feed.
+NEXT_LINK_RE = re.compile(r'<link rel="next">([^<]*)</link>')
+
 def fetch_records(parser, url, **params):
-    """Fetches and parses one batch of records from an Atom feed."""
+    """Fetches and parses one batch of records from an Atom feed.  Returns
+    the records and the URL of the next batch, or None if the feed doesn't
+    link to a next batch."""
     query = urllib.urlencode(dict((k, v) for k, v in params.items() if v))
     if query:
         url += ('?' in url and '&' or '?') + query
     for attempt in range(5):
         try:
-            return parser.parse_file(urllib.urlopen(url))
+            content = urllib.urlopen(url).read()
+            records = parser.parse_file(StringIO.StringIO(content))
         except:
             continue
+        match = NEXT_LINK_RE.search(content)
+        return records, match and xml.sax.saxutils.unescape(match.group(1))
     raise RuntimeError('Failed to fetch %r after 5 attempts' % url)
 
 def download_file(type, parser, writer, url, key=None):
     """Fetches and writes one batch of records."""
     start_time = time.time()
-    records = fetch_records(parser, url, key=key)
+    records, next_url = fetch_records(parser, url, key=key)
     writer.write(records)
     speed = len(records)/float(time.time() - start_time)
     log('Fetched %d %s record%s (%.1f rec/s).\n' %
@@ -140,28 +150,24 @@ def download_file(type, parser, writer, url, key=None):
 
 def download_since(type, parser, writer, url, min_entry_date, key=None):
     """Fetches and writes batches of records repeatedly until all records
-    with an entry_date >= min_entry_date are retrieved."""
+    with an entry_date >= min_entry_date are retrieved.  Each batch after
+    the first is fetched from the next page link in the previous batch,
+    which continues from a cursor instead of skipping records."""
     start_time = time.time()
-    total = skip = 0
-    last_min_entry_date = None
-    while True:
+    total = 0
+    params = dict(key=key, max_results=200, min_entry_date=min_entry_date)
+    while url:
         log('%s records with entry_date >= %s: ' %
             (type.capitalize(), min_entry_date))
-        records = fetch_records(parser, url, key=key, max_results=200,
-                                min_entry_date=min_entry_date, skip=skip)
+        records, url = fetch_records(parser, url, **params)
+        # The next page link already carries all the query parameters.
+        params = {}
         if not records:
             break
         writer.write(records)
         total += len(records)
         speed = total/float(time.time() - start_time)
         log('%d (total %d, %.1f rec/s).\n' % (len(records), total, speed))
-        min_entry_date = max(r['entry_date'] for r in records)
-        next_skip = len([r for r in records if r['entry_date'] == min_entry_date])
-        if min_entry_date == last_min_entry_date:
-          skip += next_skip
-        else:
-          last_min_entry_date = min_entry_date
-          skip = next_skip
     log('Done.\n')
 
 def main(*args):
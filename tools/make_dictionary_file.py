@@ -4,11 +4,28 @@
 
 How to use this tool:
   $ git clone https://github.com/google/mozc.git
-  $ tools/make_dictionary_file.py mozc/src/data/dictionary_oss/dictionary*.txt > app/japanese_name_location_dict.txt
+  $ tools/make_dictionary_file.py mozc/src/data/dictionary_oss/dictionary*.txt
+
+This writes app/japanese_name_location_dict.txt and compiles it into
+app/japanese_name_location_dict.bin, which is the file the app loads (see
+app/compact_dictionary.py).  To recompile the .bin file from an edited .txt
+file, run the tool with no arguments:
+  $ tools/make_dictionary_file.py
 """
 
+import os
 import sys
 
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(PROJECT_DIR, 'app')
+sys.path.insert(0, APP_DIR)
+
+import compact_dictionary
+import script_variant
+
+TEXT_FILE_NAME = os.path.join(APP_DIR, 'japanese_name_location_dict.txt')
+COMPACT_FILE_NAME = os.path.join(APP_DIR, 'japanese_name_location_dict.bin')
+
 def make_dictionary(input_file_names, output_file_name, numbers):
     """Makes dictionary and writes it to output_file_name.
 
@@ -43,12 +60,22 @@ def make_jp_name_location_dictionary(input_file_names):
     # 1846: id for family names in mozc dictionary
     # 1847 ~ 1850: ids for location names in mozc dictionary
     numbers = [1845, 1846, 1847, 1848, 1849, 1850]
-    make_dictionary(input_file_names, 'app/japanese_name_location_dict.txt', numbers)
+    make_dictionary(input_file_names, TEXT_FILE_NAME, numbers)
+
+
+def make_compact_dictionary(text_file_name, output_file_name):
+    """Compiles a dictionary file in the text format written by
+    make_dictionary into the format read by compact_dictionary.load."""
+    dictionary = script_variant.read_dictionary(text_file_name)
+    with open(output_file_name, 'wb') as output_file:
+        compact_dictionary.write(dictionary, output_file)
 
 
 def main():
     dictionaries = sys.argv[1:]
-    make_jp_name_location_dictionary(dictionaries)
+    if dictionaries:
+        make_jp_name_location_dictionary(dictionaries)
+    make_compact_dictionary(TEXT_FILE_NAME, COMPACT_FILE_NAME)
 
 
 if __name__ == '__main__':
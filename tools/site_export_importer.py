@@ -34,7 +34,6 @@ import logging
 import optparse
 import pfif
 import sys
-import StringIO
 import zipfile
 
 # personfinder modules
@@ -49,19 +48,8 @@ def open_file_inside_zip(zip_path):
         raise IOError('zip archive had %d entries (expected 1)' % entry_count)
     zip_entry = export_zip.infolist()[0]
     logging.info('Reading from zip entry: %s', zip_entry.filename)
-    return StringIO.StringIO(export_zip.read(zip_entry.filename))
-
-
-def next_n(a_list, batch_size):
-    """Generator that yields the next batch_size items from a_list."""
-    batch = []
-    for item in a_list:
-        batch.append(item)
-        if len(batch) == batch_size:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
+    # Decompress the entry as it is read, rather than all at once.
+    return export_zip.open(zip_entry.filename)
 
 
 def maybe_add_required_keys(a_dict, required_keys, dummy_value=u'?'):
@@ -104,39 +92,27 @@ def create_note(note_dict):
         return None
 
 
-def maybe_update_index(entity):
-    if hasattr(entity, 'update_index'):
-          entity.update_index(['old', 'new'])
-
-
-def add_entities(entity_dicts, create_function, batch_size, kind, store_all):
+def add_entities(entity_dicts, create_function):
     """Adds the data in entity_dicts to storage as entities created by
-    calling create_function.  Uses next_n to group the entity_dicts into
-    batches that get stored using model.db.put(...), after being converted
-    into entities using create_function.
+    calling create_function, using one call to model.put_and_count(...).
 
     Args:
-        entity_dicts: an iterable of dictionaries containing data to be stored
+        entity_dicts: a list of dictionaries containing data to be stored
         create_function: a function that converts a dictionary to a new entity
-        batch_size: size of the batches used to write the entities to storage
-        kind: the text name of the entities for logging
     """
-    batch_count = (len(entity_dicts) + batch_size - 1)/batch_size
-    for i, batch in enumerate(next_n(entity_dicts, batch_size)):
-        entities = [create_function(d) for d in batch]
-        entities = [e for e in entities if e]
-        for e in entities:
-            maybe_update_index(e)
-        db.put(entities)
-        if i % 10 == 0 or i == batch_count - 1:
-            logging.info('%s update: just added batch %d/%d', kind, i + 1,
-                         batch_count)
+    entities = [create_function(d) for d in entity_dicts]
+    entities = [e for e in entities if e]
+    Person.update_indexes(
+        [e for e in entities if isinstance(e, Person)], ['old', 'new'])
+    put_and_count(entities)
 
 def import_site_export(export_path, remote_api_host,
                        app_id, batch_size, store_all):
     # Log in, then use the pfif parser to parse the export file.  Use the
     # importer methods to convert the dicts to entities then add them as in
     # import.py, but less strict, to ensure that all exported data is available.
+    # The records are parsed and added in batches, so the export never has to
+    # fit in memory.
     remote_api.connect(remote_api_host, app_id)
     logging.info('%s: importing exported records from %s',
                  remote_api_host, export_path)
@@ -144,18 +120,23 @@ def import_site_export(export_path, remote_api_host,
         export_fd = open(export_path)
     else:
         export_fd = open_file_inside_zip(export_path)
-    persons, notes = pfif.parse_file(export_fd)
-    logging.info('loaded %d persons, %d notes', len(persons), len(notes))
+    person_count = note_count = 0
+    for i, (persons, notes) in enumerate(
+        pfif.parse_file_in_batches(export_fd, batch_size=int(batch_size))):
+        if not store_all:
+            persons = [d for d in persons
+                       if is_clone(d.get('person_record_id'))]
+            notes = [d for d in notes if is_clone(d.get('note_record_id'))]
+        add_entities(persons, create_person)
+        add_entities(notes, create_note)
+        person_count += len(persons)
+        note_count += len(notes)
+        if i % 10 == 0:
+            logging.info('just added batch %d: %d persons, %d notes so far',
+                         i + 1, person_count, note_count)
     if not store_all:
-        persons = [d for d in persons if is_clone(d.get('person_record_id'))]
-        notes = [d for d in notes if is_clone(d.get('note_record_id'))]
-        logging.info(
-            '... down to %d persons, %d notes after excluding %r records',
-            len(persons), len(notes), HOME_DOMAIN)
-    logging.info('... adding persons')
-    add_entities(persons, create_person, batch_size, 'person', store_all)
-    logging.info('... adding notes')
-    add_entities(notes, create_note, batch_size, 'note', store_all)
+        logging.info('excluded records in the home domain %r', HOME_DOMAIN)
+    logging.info('added %d persons, %d notes', person_count, note_count)
 
 def parse_command_line():
     parser = optparse.OptionParser()